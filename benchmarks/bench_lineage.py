@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of lineage parsing from Tree of Life taxon_info responses.
+* objectpath: the former implementation, two recursive queries per rank
+* single pass: Obtain_Lineage.parse, one walk over the response
+
+Responses are read from json files, or from the response cache,
+where every taxon_info request of an import is recorded.
+
+    Example:
+    python benchmarks/bench_lineage.py
+    python benchmarks/bench_lineage.py --cache /tmp/aad_response_cache.sqlite --repeat 200
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+from data_import.Tree_of_Life import Obtain_Lineage  # noqa: E402
+
+
+def objectpath_lineage(taxon_info):
+    """The objectpath implementation replaced by Obtain_Lineage.parse"""
+    import objectpath
+    tree_obj = objectpath.Tree(taxon_info)
+
+    def get_taxon_by_rank(rank):
+        obj_name = tuple(tree_obj.execute(
+            '$..*[@.rank is "%s"]["name"]' % rank))
+        if obj_name:
+            name = obj_name[0]
+            ott_id = tuple(tree_obj.execute(
+                '$..*[@.rank is "%s"]["ott_id"]' % rank))[0]
+            return {'name': name, 'ott_id': ott_id}
+        else:
+            return None
+
+    lineage = dict()
+    lineage['unique_name'] = tree_obj.execute("$.*['unique_name']")
+    for rank in Obtain_Lineage.RANKS:
+        lineage[rank] = get_taxon_by_rank(rank)
+    return lineage
+
+
+def load_files(paths):
+    responses = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            responses.append(json.load(f))
+    return responses
+
+
+def load_cache(path):
+    db = sqlite3.connect(path)
+    rows = db.execute(
+        "SELECT body FROM response WHERE source = 'tree_of_life' AND url LIKE '%taxon_info'")
+    return [json.loads(body) for body, in rows]
+
+
+def bench(name, parse, responses, repeat):
+    seconds = min(timeit.repeat(
+        lambda: [parse(r) for r in responses], number=repeat, repeat=3))
+    per_response = seconds / (repeat * len(responses)) * 1e6
+    print("%-12s %10.1f us per response" % (name, per_response))
+    return per_response
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare lineage parsing implementations.')
+    parser.add_argument('files', nargs='*',
+                        default=[os.path.join(HERE, 'taxon_info_sample.json')],
+                        help='taxon_info responses in json format')
+    parser.add_argument('--cache', help='read the responses from a response cache file instead')
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    responses = load_cache(args.cache) if args.cache else load_files(args.files)
+    if not responses:
+        sys.exit("No taxon_info responses found")
+    print("%d responses, %d runs" % (len(responses), args.repeat))
+
+    single_pass = bench('single pass', Obtain_Lineage.parse, responses, args.repeat)
+    try:
+        import objectpath  # noqa: F401
+    except ImportError:
+        sys.exit("objectpath is not installed, skipping the comparison")
+    for response in responses:
+        old, new = objectpath_lineage(response), Obtain_Lineage.parse(response)
+        if any(old[rank] != new[rank] for rank in Obtain_Lineage.RANKS):
+            print("Different lineage for %s" % response.get('unique_name'))
+    former = bench('objectpath', objectpath_lineage, responses, args.repeat)
+    print("speedup %.1fx" % (former / single_pass))
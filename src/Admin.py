@@ -5,19 +5,24 @@ Audiogrambase http API.
 Created on 28.01.2019
 @author: Alvaro Ortiz Troncoso, Museum fuer Naturkunde Berlin
 """
-from flask import Flask, request, render_template, url_for, jsonify, Response, flash, redirect, send_file
+from flask import Flask, request, render_template, url_for, jsonify, Response, flash, redirect, send_file, make_response, stream_with_context
 from flask_cors import CORS
 from functools import wraps
 import configparser
 import simplejson
 import logging
 import os
+import uuid
 from werkzeug.utils import secure_filename
 from AdminQuery import *
-#from data_import.Importer import Importer
-from data_import.DOI import Obtain_Citation, Obtain_Citation_Short
+from data_import.Importer import Importer
+from data_import.DOI import Obtain_Publication
 from data_import.Tree_of_Life import Obtain_OTT_ID, Obtain_Lineage
 from data_import.Backup import Backup
+from data_import.ResponseCache import ResponseCache
+from data_import.KnownTaxa import KnownTaxa
+from data_import.HttpClient import HttpClient
+from Jobs import JobRunner
 
 configPath = "/src/.env"
 """Path to configuration file."""
@@ -60,6 +65,32 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
+#######################
+# Conditional GET     #
+#######################
+
+
+def conditional(query_class, param, build):
+    """
+    Answers a read request with 304 Not Modified when the client's
+    If-None-Match header matches the current ETag of query_class,
+    otherwise calls build() to produce the response and tags it.
+
+    The ETag changes whenever a change of one of the tables read by
+    query_class is recorded in the change journal, and at least every
+    ETAG_MAX_AGE seconds, so unchanged resources skip the query and the
+    JSON encoding. Browsers revalidate with If-None-Match automatically
+    because of the no-cache directive.
+    """
+    etag = query_class(admin_config).etag(param)
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(build())
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 ##################
 # API Start page #
 ##################
@@ -80,19 +111,111 @@ def start():
 @requires_auth
 def backup_download():
     """
-    Backup all audiogram data
+    Backup all audiogram data, streamed while the database is dumped
+
+    Parameters
+    ----------
+    compress: string, optional, gzip or zstd
+    async: 1, optional, dump to a file in a background job, see jobs()
+
+    Returns
+    -------
+    The dump, with headers
+    X-Estimated-Size: size of the data in the database in bytes
+    X-Backup-Position: change journal position, for differential backups
+    or json {'job': job id} when async
     """
+    compress = request.args.get('compress') or None
+    if request.args.get('async') == '1':
+        if compress not in BACKUP_FILES:
+            return 'False'
+        return jsonify({'job': JobRunner.shared().submit('backup', backup_job, compress)})
     backup = Backup(admin_config)
-    filename = backup.create()
-    if filename:
-        return send_file(filename, attachment_filename='backup.sql')
-    else:
+    try:
+        chunks = backup.stream(compress)
+    except ValueError as e:
+        fapp.logger.info(e)
         return 'False'
+    filename, mimetype = BACKUP_FILES[compress]
+    resp = Response(stream_with_context(chunks), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    resp.headers['X-Backup-Position'] = str(backup.position)
+    size = backup.estimated_size()
+    if size is not None:
+        resp.headers['X-Estimated-Size'] = str(size)
+    return resp
+
+
+BACKUP_FILES = {
+    None: ('backup.sql', 'application/sql'),
+    'gzip': ('backup.sql.gz', 'application/gzip'),
+    'zstd': ('backup.sql.zst', 'application/zstd')}
+"""File name and mimetype of a backup per compression."""
+
+
+def backup_job(job, compress):
+    """Dumps the database to the result file of the job."""
+    return Backup(admin_config).save(job.result_path, compress, job.progress)
+
+
+@fapp.route("/admin/v1/backup_diff.sql", methods=['GET'])
+@requires_auth
+def backup_diff_download():
+    """
+    Differential backup, the rows changed since a full or differential backup
+
+    Parameters
+    ----------
+    since: int, X-Backup-Position of the previous backup
+    compress: string, optional, gzip or zstd
+
+    Returns
+    -------
+    The diff, with an X-Backup-Position header: position to pass as since to the next diff
+    """
+    compress = request.args.get('compress') or None
+    backup = Backup(admin_config)
+    try:
+        since = int(request.args.get('since'))
+        chunks = backup.diff(since, compress)
+    except (TypeError, ValueError) as e:
+        fapp.logger.info(e)
+        return 'False'
+    filename, mimetype = {
+        None: ('backup_diff_%d.sql', 'application/sql'),
+        'gzip': ('backup_diff_%d.sql.gz', 'application/gzip'),
+        'zstd': ('backup_diff_%d.sql.zst', 'application/zstd')}[compress]
+    resp = Response(stream_with_context(chunks), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s' % (filename % backup.position)
+    resp.headers['X-Backup-Position'] = str(backup.position)
+    return resp
+
+
+def restore_job(job, filepath, diffs, workers):
+    """Restores a backup uploaded to filepath, see Backup.restore()."""
+    try:
+        report = Backup(admin_config).restore(filepath, workers, diffs, job.progress)
+    finally:
+        # tables may have been replaced
+        AdminQuery.cache.clear()
+        for path in [filepath] + diffs:
+            os.remove(path)
+    return {'tables': len(report['tables']), 'diffs': len(diffs),
+            'position': report['position'], 'seconds': report['seconds']}
 
 
 @fapp.route("/admin/v1/backup_restore", methods=['GET', 'POST'])
 @requires_auth
 def backup_restore():
+    """
+    Restores a backup in a background job, see jobs().
+    A backup rejected by Restore fails the job with the reason as error, the live tables are unchanged.
+
+    Parameters
+    ----------
+    file: full backup, .sql, .sql.gz or .sql.zst as downloaded from backup.sql
+    diff: differential backups, optional, same extensions
+    """
     UPLOAD_FOLDER = '/tmp'
     if request.method == 'POST':
         if 'file' not in request.files:
@@ -102,13 +225,29 @@ def backup_restore():
         if file.filename == '':
             flash('No file')
             return redirect(request.url)
-        if file and allowed_file(file.filename):
-            filename = 'backup.sql'
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
+        if file and backup_extension(file.filename):
+            # unique names, another restore may be queued
+            prefix = os.path.join(UPLOAD_FOLDER, 'backup_%s' % uuid.uuid4().hex)
+            # the extension tells Restore to decompress
+            filepath = prefix + backup_extension(file.filename)
             file.save(filepath)
-            flash('File uploaded')
-            backup = Backup(admin_config)
-            resp = backup.restore()
+            # differential backups, ordered by Restore
+            diffs = []
+            for i, diff in enumerate(request.files.getlist('diff')):
+                if diff.filename == '':
+                    continue
+                if not backup_extension(diff.filename):
+                    logging.warning('file extension not allowed %s' % diff.filename)
+                    continue
+                diffpath = '%s_diff_%d%s' % (prefix, i, backup_extension(diff.filename))
+                diff.save(diffpath)
+                diffs.append(diffpath)
+            workers = admin_config.getint(
+                'DEFAULT', 'RESTORE_WORKERS', fallback=4)
+            job_id = JobRunner.shared().submit(
+                'restore', restore_job, filepath, diffs, workers, exclusive=True)
+            flash('File uploaded, restoring in job %s' % job_id)
+            return render_template('upload_backup.html', job=job_id)
         else:
             logging.warning('file extension not allowed %s' % file.filename)
 
@@ -126,6 +265,16 @@ def upload_audiogram():
     """
     Uploads a new audiogram from the UI.
 
+    Parameters
+    ----------
+    file: csv file
+    mode: string, "import" loads the file into the database in a background job, otherwise it is only previewed
+
+    Returns
+    -------
+    json lines of the preview, see Importer.preview,
+    or json {'job': job id}, see jobs(); the job result has the rows and seconds per table loaded
+
     Example
     ---------
     https://animalaudiograms.museumfuernaturkunde.berlin/admin/v1/create_audiogram
@@ -144,16 +293,39 @@ def upload_audiogram():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             filepath = os.path.join(fapp.config['UPLOAD_FOLDER'], filename)
+            if request.form.get('mode') == 'import':
+                # unique name, the file is read when the job runs
+                filepath = os.path.join(fapp.config['UPLOAD_FOLDER'], '%s_%s' % (
+                    uuid.uuid4().hex, filename))
             file.save(filepath)
             flash('File uploaded')
-            importer = Importer()
-            resp = importer.as_json(filepath)
-            #sql_string = importer.convert(filepath)
-            # importer.import_sql(sql_string)
-            return jsonify(resp)
+            importer = Importer(admin_config)
+            if request.form.get('mode') == 'import':
+                return jsonify({'job': JobRunner.shared().submit(
+                    'import', import_job, filepath, exclusive=True)})
+            # stream the preview as json lines, while the file is read
+            return Response(stream_with_context(importer.as_json(filepath)),
+                            mimetype='application/x-ndjson')
     return render_template('upload_audiogram.html')
 
 
+def import_job(job, filepath):
+    """Loads an uploaded spreadsheet into the database, see Importer.import_file()."""
+    try:
+        return Importer(admin_config).import_file(filepath, job.progress)
+    finally:
+        AdminQuery.cache.clear()
+        os.remove(filepath)
+
+
+def backup_extension(filename):
+    """Returns the extension of a backup file as written by the backup downloads, or None."""
+    for extension in ('.sql', '.sql.gz', '.sql.zst'):
+        if filename.lower().endswith(extension):
+            return extension
+    return None
+
+
 def allowed_file(filename):
     """Checks the extension of the file."""
     ALLOWED_EXTENSIONS = {'csv', 'sql'}
@@ -162,6 +334,48 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+########################
+# Jobs #
+########################
+
+
+@fapp.route("/admin/v1/jobs/<job_id>", methods=['GET'])
+@requires_auth
+def jobs(job_id):
+    """
+    State of a background job
+
+    Returns
+    -------
+    json {'id', 'kind', 'state': queued|running|done|failed, 'stage', 'percent',
+    'created', 'started', 'finished', 'queued_seconds', 'run_seconds', 'result', 'error'}
+    | 'False' string for an unknown job
+
+    Example
+    ---------
+    https://animalaudiograms.museumfuernaturkunde.berlin/admin/v1/jobs/6f1c2b...
+    """
+    job = JobRunner.shared().get(job_id)
+    if job is None:
+        return 'False'
+    return jsonify(job)
+
+
+@fapp.route("/admin/v1/jobs/<job_id>/result", methods=['GET'])
+@requires_auth
+def job_result(job_id):
+    """Downloads the file made by a finished backup job | 'False' string"""
+    runner = JobRunner.shared()
+    path = runner.result_file(job_id)
+    if path is None:
+        return 'False'
+    compress = runner.get(job_id)['result']['compress']
+    filename, mimetype = BACKUP_FILES[compress]
+    resp = send_file(path, mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return resp
+
+
 ###################
 # Animal metadata #
 ###################
@@ -190,10 +404,13 @@ def edit_animal_metadata():
     if 'expId' not in request.args:
         return render_template('edit_animal_metadata.html')
     expId = int(request.args['expId'])
-    check = CheckQuery(admin_config).run(expId)
-    if len(check) != 1:
-        return 'False'
-    return jsonify(AnimalQuery(admin_config).run(expId))
+
+    def build():
+        check = CheckQuery(admin_config).run(expId)
+        if len(check) != 1:
+            return 'False'
+        return jsonify(AnimalQuery(admin_config).run(expId))
+    return conditional(AnimalQuery, expId, build)
 
 
 @fapp.route("/admin/v1/save_animal", methods=['GET'])
@@ -256,7 +473,7 @@ def create_data_point():
 
     Returns
     ----------
-    'True'|'False' string
+    id of the new data point JSON
 
     Example
     ---------
@@ -267,8 +484,7 @@ def create_data_point():
             &sound_pressure_level_reference=${this.sound_pressure_level_reference}
             &sound_pressure_level_reference_method=${this.sound_pressure_level_reference_method}
     """
-    CreateDataPointQuery(admin_config).run(request.args)
-    return 'True'
+    return jsonify(CreateDataPointQuery(admin_config).run(request.args))
 
 
 @fapp.route("/admin/v1/save_data_point", methods=['GET'])
@@ -335,6 +551,44 @@ def delete_data_point():
     return 'True'
 
 
+@fapp.route("/admin/v1/data_points/batch", methods=['POST'])
+@requires_auth
+def batch_data_points():
+    """
+    Creates, saves and deletes the data points of an audiogram in one request.
+
+    Parameters (JSON body)
+    ----------
+    audiogram_experiment_id : int, required
+       id of the audiogram the data points belong to
+    create : list of data points without id
+    update : list of data points with id
+    delete : list of data point ids
+
+    Data points have the same fields as in create_data_point and save_data_point.
+
+    Returns
+    ----------
+    [{"created": int, "updated": int, "deleted": int}] JSON | 'False' string
+
+    Example
+    ---------
+    POST /admin/v1/data_points/batch
+    {"audiogram_experiment_id": 24,
+     "create": [{"testtone_frequency_in_khz": 1.0, "sound_pressure_level_in_decibel": 90, ...}],
+     "update": [{"id": 301, "testtone_frequency_in_khz": 2.0, ...}],
+     "delete": [302, 303]}
+    """
+    diff = request.get_json(silent=True)
+    if not diff or 'audiogram_experiment_id' not in diff:
+        return 'False'
+    try:
+        return jsonify(BatchDataPointsQuery(admin_config).run(diff))
+    except Exception as e:
+        logging.warning(e)
+        return 'False'
+
+
 @fapp.route("/admin/v1/edit_data_points", methods=['GET'])
 @requires_auth
 def edit_data_points():
@@ -358,10 +612,13 @@ def edit_data_points():
     if 'id' not in request.args:
         return render_template('edit_data_points.html')
     id = int(request.args['id'])
-    check = CheckQuery(admin_config).run(id)
-    if len(check) != 1:
-        return 'False'
-    return jsonify(DataPointsQuery(admin_config).run(id))
+
+    def build():
+        check = CheckQuery(admin_config).run(id)
+        if len(check) != 1:
+            return 'False'
+        return jsonify(DataPointsQuery(admin_config).run(id))
+    return conditional(DataPointsQuery, id, build)
 
 
 ##########################
@@ -392,10 +649,13 @@ def edit_experiment_metadata():
     if 'id' not in request.args:
         return render_template('edit_experiment_metadata.html')
     id = int(request.args['id'])
-    check = CheckQuery(admin_config).run(id)
-    if len(check) != 1:
-        return 'False'
-    return jsonify(ExperimentQuery(admin_config).run(id))
+
+    def build():
+        check = CheckQuery(admin_config).run(id)
+        if len(check) != 1:
+            return 'False'
+        return jsonify(ExperimentQuery(admin_config).run(id))
+    return conditional(ExperimentQuery, id, build)
 
 
 @fapp.route("/admin/v1/save_experiment", methods=['GET'])
@@ -436,7 +696,7 @@ def save_experiment():
 
     Returns
     ----------
-    'True'|'False' string
+    [{"id": id of the new audiogram}] JSON when id is 0 | 'True'|'False' string
 
     Example
     ---------
@@ -472,9 +732,8 @@ def save_experiment():
         return False
     try:
         if int(request.args['id']) == 0:
-            resp = InsertExperimentQuery(admin_config).run(request.args)
-            max_id = resp[0]['max(id)']
-            resp = jsonify(resp)
+            # returns the id of the new experiment
+            resp = jsonify(InsertExperimentQuery(admin_config).run(request.args))
         else:
             SaveExperimentQuery(admin_config).run(request.args)
             resp = 'True'
@@ -522,10 +781,76 @@ def delete_experiment():
 ###################
 
 
+@fapp.route("/admin/v1/pool_stats", methods=['GET'])
+@requires_auth
+def pool_stats():
+    """
+    Returns the database connection pool counters.
+
+    Returns
+    ----------
+    A dict in json format:
+    # size : int maximum number of connections
+    # in_use : int connections currently borrowed by a query
+    # idle : int open connections waiting to be reused
+    # created, reused, recycled, broken, waits, timeouts : int counters since start
+    """
+    return jsonify(AdminQuery.pool_stats())
+
+
+@fapp.route("/admin/v1/cache_stats", methods=['GET'])
+@requires_auth
+def cache_stats():
+    """
+    Returns the query result cache counters.
+
+    Returns
+    ----------
+    A dict in json format:
+    # entries : int results currently cached
+    # max_entries : int cache size
+    # hits, misses, evictions, invalidations : int counters since start
+    """
+    return jsonify(AdminQuery.cache_stats())
+
+
+@fapp.route("/admin/v1/response_cache_stats", methods=['GET'])
+@requires_auth
+def response_cache_stats():
+    """
+    Returns the counters of the Tree of Life, DOI and Wikidata response cache.
+
+    Returns
+    ----------
+    A dict in json format:
+    # entries : int responses currently cached
+    # max_entries : int cache size
+    # offline : bool true when the APIs are not called
+    # hits, misses, expired, evictions : int counters since start
+    """
+    return jsonify(ResponseCache.shared().stats())
+
+
+@fapp.route("/admin/v1/http_stats", methods=['GET'])
+@requires_auth
+def http_stats():
+    """
+    Returns the latency of the Tree of Life, DOI and Wikidata API calls.
+
+    Returns
+    ----------
+    A dict in json format, per host:
+    # calls, errors, retries : int counters since start
+    # total_seconds, mean_seconds, max_seconds : float request latency
+    """
+    return jsonify(HttpClient.shared().stats())
+
+
 @fapp.route("/admin/v1/list_spl_reference", methods=['GET'])
 @requires_auth
 def list_spl_reference():
-    return jsonify(ListSPLReference(admin_config).run(None))
+    return conditional(ListSPLReference, None, lambda: jsonify(
+        ListSPLReference(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/all_species_vernacular", methods=['GET'])
@@ -550,8 +875,8 @@ def get_all_taxa_vernacular():
     http://localhost:9082/api/v1/all_species_vernacular
     Returns a list of species currently recorded in the database.
     """
-    species = AllTaxaVernacularQuery(admin_config).run(id)
-    return jsonify(species)
+    return conditional(AllTaxaVernacularQuery, None, lambda: jsonify(
+        AllTaxaVernacularQuery(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/all_facilities", methods=['GET'])
@@ -575,8 +900,8 @@ def get_all_facilities():
     http://localhost:9082/api/v1/all_facilities
     Returns a list of facilities currently recorded in the database.
     """
-    facilities = AllFacilitiesQuery(admin_config).run(id)
-    return jsonify(facilities)
+    return conditional(AllFacilitiesQuery, None, lambda: jsonify(
+        AllFacilitiesQuery(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/all_measurement_methods", methods=['GET'])
@@ -602,8 +927,8 @@ def get_all_measurement_methods():
     http://localhost:9082/api/v1/all_methods
     Returns a list of measurement methods currently recorded in the database.
     """
-    methods = AllMeasurementMethodsQuery(admin_config).run(id)
-    return jsonify(methods)
+    return conditional(AllMeasurementMethodsQuery, None, lambda: jsonify(
+        AllMeasurementMethodsQuery(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/all_tone_methods", methods=['GET'])
@@ -627,8 +952,8 @@ def get_all_tone_methods():
     http://localhost:9082/api/v1/all_tone_methods
     Returns a list of tone methods currently recorded in the database.
     """
-    methods = AllToneMethodsQuery(admin_config).run(id)
-    return jsonify(methods)
+    return conditional(AllToneMethodsQuery, None, lambda: jsonify(
+        AllToneMethodsQuery(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/all_publications", methods=['GET'])
@@ -652,8 +977,8 @@ def all_publications():
     http://localhost:9082/api/v1/all_publications
     Returns a list of publications currently recorded in the database.
     """
-    publications = All_publications_query(admin_config).run(id)
-    return jsonify(publications)
+    return conditional(All_publications_query, None, lambda: jsonify(
+        All_publications_query(admin_config).run(None)))
 
 
 @fapp.route("/admin/v1/add_taxon", methods=['GET'])
@@ -723,7 +1048,6 @@ def save_publication():
     if 'doi' not in request.args:
         return render_template('add_publication.html')
     doi = request.args['doi']
-    publication = {}
     try:
         # all data is there, save in database
         if (
@@ -737,9 +1061,7 @@ def save_publication():
 
         # data is missing, get from DOI
         else:
-            publication['doi'] = doi
-            publication['citation_long'] = Obtain_Citation().run(doi)
-            publication['citation_short'] = Obtain_Citation_Short().run(doi)
+            publication = Obtain_Publication().run(doi)
             return jsonify(publication)
 
     except Exception as e:
@@ -756,8 +1078,9 @@ def read_publication():
     ----------
     id: int publication id in the database
     """
-    publication = Read_publication_query(admin_config).run(request.args['id'])
-    return jsonify(publication)
+    id = request.args['id']
+    return conditional(Read_publication_query, id, lambda: jsonify(
+        Read_publication_query(admin_config).run(id)))
 
 
 if __name__ == '__main__':
@@ -765,6 +1088,10 @@ if __name__ == '__main__':
         # Read the configuration file
         admin_config = configparser.ConfigParser()
         admin_config.read(configPath)
+        ResponseCache.configure(admin_config)
+        KnownTaxa.configure(admin_config)
+        HttpClient.configure(admin_config)
+        JobRunner.configure(admin_config)
         fapp.run(host='0.0.0.0')
     except Exception as e:
         fapp.logger.info(e)
@@ -2,6 +2,11 @@
 Admin queries.
 * Implements the template method pattern
 * Connects to the MySQL database using pymysql
+* Connections are borrowed from a process-wide pool and returned after each query
+* Results of lookup queries are cached in memory, writes invalidate them by table,
+  and entries are keyed by the change journal versions, so writes of other processes skip them
+* Read queries provide an ETag derived from the change counters of the tables they read
+* Writes record the changed rows in the change journal, for differential backups
 
 API requirements see:
 https://code.naturkundemuseum.berlin/Alvaro.Ortiz/Pinguine/wikis/Requirements-Audiogram-Frontend
@@ -10,8 +15,15 @@ Created on 28.01.2021
 @author: Alvaro.Ortiz for Museum fuer Naturkunde Berlin
 """
 import abc
-import pymysql
+import contextlib
+import hashlib
+import threading
+import time
 import logging
+from ConnectionPool import ConnectionPool
+from QueryCache import QueryCache
+from data_import.ChangeJournal import ChangeJournal
+from data_import.NestedSet import NestedSet
 
 
 class AdminQuery(abc.ABC):
@@ -20,26 +32,174 @@ class AdminQuery(abc.ABC):
     connection = None
     """Database connection."""
 
+    pool = None
+    """Connection pool shared by all queries in this process."""
+
+    _pool_lock = threading.Lock()
+
+    cache = QueryCache(max_entries=128)
+    """Result cache shared by all queries in this process."""
+
+    cache_ttl = 0
+    """Seconds to keep results of this query in the cache, 0 disables caching."""
+
+    tables_read = ()
+    """Tables this query reads from, cached results are invalidated when one of them changes."""
+
+    tables_written = ()
+    """Tables this query writes to."""
+
+    etag_max_age = 300
+    """Seconds after which ETags change anyway, for changes not recorded in the change journal."""
+
+    journal_ready = False
+    """Whether the change_journal table was created or found by this process."""
+
     def __init__(self, config):
         self.host = config.get('DEFAULT', 'DB_HOST')
         self.password = config.get('DEFAULT', 'DB_PASSWORD')
         self.username = config.get('DEFAULT', 'DB_USERNAME')
         self.database = config.get('DEFAULT', 'DB_DATABASE')
+        self.pool_size = config.getint('DEFAULT', 'DB_POOL_SIZE', fallback=5)
+        self.pool_timeout = config.getfloat(
+            'DEFAULT', 'DB_POOL_TIMEOUT', fallback=10)
+        self.pool_max_idle = config.getfloat(
+            'DEFAULT', 'DB_POOL_MAX_IDLE', fallback=300)
+        self.etag_max_age = config.getint(
+            'DEFAULT', 'ETAG_MAX_AGE', fallback=AdminQuery.etag_max_age)
 
     def run(self, param=None):
         """Runs the query implemented in the derived classes."""
-        self.connection = self._get_connection()
-        results = self._run(param)
-        return AdminQuery.jsonize(results)
+        if self.cache_ttl:
+            # the cache is per process, the journal sees the writes of all of them
+            key = (type(self).__name__, param, self.versions())
+            json_data = AdminQuery.cache.get(key)
+            if json_data is not None:
+                return json_data
+            generation = AdminQuery.cache.generation(self.tables_read)
+
+        pool = self._get_pool()
+        self.connection = pool.acquire()
+        failed = True
+        try:
+            if self.tables_written:
+                self._create_journal()
+            results = self._run(param)
+            failed = False
+        finally:
+            # a connection that raised may be in an unknown state, don't reuse it
+            pool.release(self.connection, discard=failed)
+            self.connection = None
+            if self.tables_written:
+                AdminQuery.cache.invalidate(self.tables_written)
+        json_data = AdminQuery.jsonize(results)
+
+        if self.cache_ttl:
+            AdminQuery.cache.put(
+                key, json_data, self.cache_ttl, self.tables_read, generation)
+        return json_data
 
     @abc.abstractmethod
     def _run(self, param=None):
         pass
 
-    def _get_connection(self):
-        """Open a database connection."""
-        return pymysql.connect(
-            self.host, self.username, self.password, self.database)
+    def _get_pool(self):
+        """Returns the process-wide connection pool, creating it on first use."""
+        with AdminQuery._pool_lock:
+            if AdminQuery.pool is None:
+                AdminQuery.pool = ConnectionPool(
+                    self.host, self.username, self.password, self.database,
+                    size=self.pool_size,
+                    timeout=self.pool_timeout,
+                    max_idle=self.pool_max_idle)
+            return AdminQuery.pool
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Unit of work: all statements executed on the yielded cursor
+        are committed together, or rolled back together on error.
+
+        Example
+        -------
+        with self.transaction() as cursor:
+            cursor.execute(...)
+            cursor.execute(...)
+        """
+        cursor = self.connection.cursor()
+        try:
+            yield cursor
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _create_journal(self):
+        """
+        Creates the change_journal table once per process.
+        Before the query runs, table definitions would commit an open transaction.
+        """
+        if AdminQuery.journal_ready:
+            return
+        with self.connection.cursor() as cursor:
+            ChangeJournal.create(cursor)
+        self.connection.commit()
+        AdminQuery.journal_ready = True
+
+    @classmethod
+    def journal(cls, cursor, table, op, key_column=None, key_values=()):
+        """
+        Records changed rows in change_journal, for differential backups (see Backup.diff).
+        Use the cursor of the change, so that the record is part of the same transaction.
+
+        Parameters
+        ----------
+        table: string, changed table
+        op: string, insert, update or delete
+        key_column: string, column identifying the changed rows, None when any row may have changed
+        key_values: values of key_column
+        """
+        ChangeJournal.record(cursor, table, op, key_column, key_values)
+
+    @classmethod
+    def pool_stats(cls):
+        """Returns the connection pool counters, or an empty dict before the first query."""
+        if cls.pool is None:
+            return {}
+        return cls.pool.stats()
+
+    def etag(self, param=None):
+        """
+        Version tag of this query's result for param.
+        Changes whenever a change of one of tables_read is recorded in the change journal,
+        by any process, and at least every etag_max_age seconds,
+        so that changes made outside the admin queries show up too.
+        """
+        window = int(time.time() // self.etag_max_age)
+        tag = '%s:%r:%r:%d' % (type(self).__name__, param, self.versions(), window)
+        return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+    def versions(self):
+        """Last change journal ids of tables_read, see ChangeJournal.versions()."""
+        pool = self._get_pool()
+        connection = pool.acquire()
+        failed = True
+        try:
+            with connection.cursor() as cursor:
+                versions = ChangeJournal.versions(cursor, self.tables_read)
+            # end the read, so the next call sees new changes
+            connection.commit()
+            failed = False
+        finally:
+            pool.release(connection, discard=failed)
+        return versions
+
+    @classmethod
+    def cache_stats(cls):
+        """Returns the result cache counters."""
+        return cls.cache.stats()
 
     @classmethod
     def jsonize(cls, results):
@@ -50,6 +210,14 @@ class AdminQuery(abc.ABC):
             json_data.append(dict(zip(results['headers'], result)))
         return json_data
 
+    @classmethod
+    def inserted(cls, cursor):
+        """Result object holding the key generated by the last insert on cursor.
+
+        Insert queries return this, so that jsonize() yields [{'id': <new id>}].
+        """
+        return {'headers': ['id'], 'results': [[cursor.lastrowid]]}
+
     @classmethod
     def check_params(cls, param):
         """Check param dictionary for NaN's or undefined's or empty strings, replace by None's"""
@@ -60,6 +228,8 @@ class AdminQuery(abc.ABC):
 class CheckQuery(AdminQuery):
     """Checks whether audiogram exists."""
 
+    tables_read = ('audiogram_experiment',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -75,6 +245,8 @@ class CheckQuery(AdminQuery):
 class DataPointsQuery(AdminQuery):
     """Get data points for experiment id."""
 
+    tables_read = ('audiogram_data_point', 'audiogram_experiment')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -96,6 +268,8 @@ class DataPointsQuery(AdminQuery):
 class CreateDataPointQuery(AdminQuery):
     """Creates a new data point."""
 
+    tables_written = ('audiogram_data_point',)
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
         with self.connection as cursor:
@@ -127,12 +301,17 @@ class CreateDataPointQuery(AdminQuery):
                     'audiogram_experiment_id': param['audiogram_experiment_id']
                 }
             )
-        return {'headers': ['response'], 'results': []}
+            resp = AdminQuery.inserted(cursor)
+            AdminQuery.journal(cursor, 'audiogram_data_point', 'insert',
+                               'id', [cursor.lastrowid])
+            return resp
 
 
 class SaveAnimalQuery(AdminQuery):
     """Edits the details of an existing animal."""
 
+    tables_written = ('individual_animal', 'test_animal')
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
 
@@ -165,6 +344,20 @@ class SaveAnimalQuery(AdminQuery):
                     'individual_name': param['individual_name']
                 }
             )
+            cursor.execute(
+                """
+                select
+                   individual_animal_id
+                from
+                   test_animal
+                where
+                   audiogram_experiment_id=%(expId)s
+                """,
+                {'expId': param['expId']})
+            AdminQuery.journal(cursor, 'individual_animal', 'update', 'id',
+                               [row[0] for row in cursor.fetchall()])
+            AdminQuery.journal(cursor, 'test_animal', 'update',
+                               'audiogram_experiment_id', [param['expId']])
 
         return {'headers': ['response'], 'results': []}
 
@@ -172,6 +365,8 @@ class SaveAnimalQuery(AdminQuery):
 class SaveDataPointQuery(AdminQuery):
     """Edits the values of an existing data point."""
 
+    tables_written = ('audiogram_data_point',)
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
         cols = []
@@ -225,12 +420,16 @@ class SaveDataPointQuery(AdminQuery):
                     'sound_pressure_level_reference_method': param['sound_pressure_level_reference_method']
                 }
             )
+            AdminQuery.journal(cursor, 'audiogram_data_point', 'update',
+                               'id', [param['id']])
         return {'headers': ['response'], 'results': []}
 
 
 class DeleteDataPointQuery(AdminQuery):
     """Deletes a data point."""
 
+    tables_written = ('audiogram_data_point',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -238,12 +437,118 @@ class DeleteDataPointQuery(AdminQuery):
                 delete from audiogram_data_point where id=%(id)s;
                 """,  # noqa: E501
                 {'id': param})
+            AdminQuery.journal(cursor, 'audiogram_data_point', 'delete',
+                               'id', [param])
         return {'headers': ['response'], 'results': []}
 
 
+class BatchDataPointsQuery(AdminQuery):
+    """Creates, edits and deletes the data points of one audiogram in a single transaction.
+
+    param is a dict:
+    {
+        'audiogram_experiment_id': int,
+        'create': [data point dicts without id],
+        'update': [data point dicts with id],
+        'delete': [data point ids]
+    }
+    Data point dicts use the same keys as CreateDataPointQuery and SaveDataPointQuery.
+    """
+
+    tables_written = ('audiogram_data_point',)
+
+    value_keys = [
+        'testtone_duration_in_millisecond',
+        'testtone_frequency_in_khz',
+        'sound_pressure_level_in_decibel',
+        'sound_pressure_level_reference',
+        'sound_pressure_level_reference_method'
+    ]
+
+    def _run(self, param=None):
+        exp_id = int(param['audiogram_experiment_id'])
+        creates = [self._values(point, exp_id)
+                   for point in param.get('create', [])]
+        updates = [self._values(point, exp_id, int(point['id']))
+                   for point in param.get('update', [])]
+        deletes = [{'id': int(id), 'audiogram_experiment_id': exp_id}
+                   for id in param.get('delete', [])]
+
+        with self.transaction() as cursor:
+            if creates:
+                cursor.executemany(
+                    """
+                    insert into audiogram_data_point(
+                        testtone_duration_in_millisecond,
+                        testtone_frequency_in_khz,
+                        sound_pressure_level_in_decibel,
+                        sound_pressure_level_reference_id,
+                        sound_pressure_level_reference_method,
+                        audiogram_experiment_id
+                    )
+                    values (
+                        %(testtone_duration_in_millisecond)s,
+                        %(testtone_frequency_in_khz)s,
+                        %(sound_pressure_level_in_decibel)s,
+                        %(sound_pressure_level_reference)s,
+                        %(sound_pressure_level_reference_method)s,
+                        %(audiogram_experiment_id)s
+                    )
+                    """,
+                    creates)
+            if updates:
+                # data points can only be edited through the audiogram they belong to
+                cursor.executemany(
+                    """
+                    update
+                       audiogram_data_point
+                    set
+                       testtone_duration_in_millisecond=%(testtone_duration_in_millisecond)s,
+                       testtone_frequency_in_khz=%(testtone_frequency_in_khz)s,
+                       sound_pressure_level_in_decibel=%(sound_pressure_level_in_decibel)s,
+                       sound_pressure_level_reference_id=%(sound_pressure_level_reference)s,
+                       sound_pressure_level_reference_method=%(sound_pressure_level_reference_method)s
+                    where
+                       id=%(id)s
+                    and
+                       audiogram_experiment_id=%(audiogram_experiment_id)s
+                    """,
+                    updates)
+            if deletes:
+                cursor.executemany(
+                    """
+                    delete from
+                       audiogram_data_point
+                    where
+                       id=%(id)s
+                    and
+                       audiogram_experiment_id=%(audiogram_experiment_id)s
+                    """,
+                    deletes)
+            # new data points have no known id, record the whole audiogram
+            AdminQuery.journal(cursor, 'audiogram_data_point', 'update',
+                               'audiogram_experiment_id', [exp_id])
+        return {
+            'headers': ['created', 'updated', 'deleted'],
+            'results': [[len(creates), len(updates), len(deletes)]]
+        }
+
+    def _values(self, point, exp_id, id=None):
+        """Statement parameters for one data point, missing values become NULL."""
+        point = AdminQuery.check_params(point)
+        values = {key: point.get(key) for key in self.value_keys}
+        values['audiogram_experiment_id'] = exp_id
+        if id is not None:
+            values['id'] = id
+        return values
+
+
 class ListSPLReference(AdminQuery):
     """Lists all entries in sound_pressure_level_reference table."""
 
+    cache_ttl = 3600
+    tables_read = ('sound_pressure_level_reference',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -259,6 +564,9 @@ class ListSPLReference(AdminQuery):
 class ExperimentQuery(AdminQuery):
     """Get experiment metadata for experiment id."""
 
+    tables_read = ('audiogram_experiment', 'audiogram_publication',
+                   'individual_animal', 'test_animal')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -303,59 +611,60 @@ class ExperimentQuery(AdminQuery):
             all_results = cursor.fetchall()
         return {'headers': row_headers, 'results': all_results}
 
-    def _insert_animal(self, ott_id, exp_id):
+    def _insert_animal(self, cursor, ott_id, exp_id):
+        """Inserts a new animal and relates it to the experiment, using the caller's transaction."""
         # insert a new animal
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                insert into
-                   individual_animal(
-                       taxon_id)
-                   values(%(ott_id)s)
-                """,
-                {
-                    'ott_id': ott_id
-                }
-            )
-        with self.connection as cursor:
-            cursor.execute(
-                """select max(id) from individual_animal"""
-            )
-            max_animal = cursor.fetchone()
+        cursor.execute(
+            """
+            insert into
+               individual_animal(
+                   taxon_id)
+               values(%(ott_id)s)
+            """,
+            {
+                'ott_id': ott_id
+            }
+        )
+        animal_id = cursor.lastrowid
 
         # delete old entry if present
-            cursor.execute(
-                """
-                delete from test_animal where audiogram_experiment_id=%(exp_id)s
-                """,
-                {
-                    'exp_id': exp_id,
-                }
-            )
+        cursor.execute(
+            """
+            delete from test_animal where audiogram_experiment_id=%(exp_id)s
+            """,
+            {
+                'exp_id': exp_id,
+            }
+        )
 
         # relate to experiment
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                insert into
-                   test_animal(
-                       audiogram_experiment_id, individual_animal_id)
-                   values(%(max_exp)s,%(max_animal)s)
-                """,
-                {
-                    'max_exp': exp_id,
-                    'max_animal': max_animal
-                }
-            )
+        cursor.execute(
+            """
+            insert into
+               test_animal(
+                   audiogram_experiment_id, individual_animal_id)
+               values(%(exp_id)s,%(animal_id)s)
+            """,
+            {
+                'exp_id': exp_id,
+                'animal_id': animal_id
+            }
+        )
+        AdminQuery.journal(cursor, 'individual_animal', 'insert', 'id', [animal_id])
+        AdminQuery.journal(cursor, 'test_animal', 'update',
+                           'audiogram_experiment_id', [exp_id])
 
 
 class InsertExperimentQuery(ExperimentQuery):
     """Adds a new experiment."""
 
+    tables_written = ('audiogram_experiment', 'audiogram_publication',
+                      'individual_animal', 'test_animal')
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
-        # insert experiment metadata
-        with self.connection as cursor:
+        # insert experiment, publication and animal in one transaction
+        with self.transaction() as cursor:
             cursor.execute(
                 """
                 insert into
@@ -439,38 +748,39 @@ class InsertExperimentQuery(ExperimentQuery):
                     'measurement_type': param['measurement_type'],
                 }
             )
-        with self.connection as cursor:
-            cursor.execute(
-                """select max(id) from audiogram_experiment"""
-            )
-            row_headers = [x[0] for x in cursor.description]
-            max_exp = cursor.fetchone()
-        # insert a new publication
-        with self.connection as cursor:
+            resp = AdminQuery.inserted(cursor)
+            exp_id = cursor.lastrowid
+            # insert a new publication
             cursor.execute(
                 """
                 insert into
                    audiogram_publication(
                        audiogram_experiment_id, publication_id)
-                   values(%(max_exp)s, %(citation_id)s)
+                   values(%(exp_id)s, %(citation_id)s)
                 """,
                 {
-                    'max_exp': max_exp,
+                    'exp_id': exp_id,
                     'citation_id': param['citation_id']
                 }
             )
-        # insert a new animal
-        self._insert_animal(param['ott_id'], max_exp)
-        return {'headers': row_headers, 'results': [max_exp]}
+            AdminQuery.journal(cursor, 'audiogram_experiment', 'insert', 'id', [exp_id])
+            AdminQuery.journal(cursor, 'audiogram_publication', 'insert',
+                               'audiogram_experiment_id', [exp_id])
+            # insert a new animal
+            self._insert_animal(cursor, param['ott_id'], exp_id)
+        return resp
 
 
 class SaveExperimentQuery(ExperimentQuery):
     """Edits the details of an existing experiment."""
 
+    tables_written = ('audiogram_experiment', 'audiogram_publication',
+                      'individual_animal', 'test_animal')
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
-        # update publication
-        with self.connection as cursor:
+        with self.transaction() as cursor:
+            # update publication
             cursor.execute(
                 """
                 update
@@ -486,8 +796,7 @@ class SaveExperimentQuery(ExperimentQuery):
                 }
             )
 
-        # update metadata
-        with self.connection as cursor:
+            # update metadata
             cursor.execute(
                 """
                 update
@@ -548,40 +857,44 @@ class SaveExperimentQuery(ExperimentQuery):
                     'id': param['id']
                 }
             )
+            AdminQuery.journal(cursor, 'audiogram_experiment', 'update', 'id', [param['id']])
+            AdminQuery.journal(cursor, 'audiogram_publication', 'update',
+                               'audiogram_experiment_id', [param['id']])
             # check if animal has changed
-            if int(param['ott_id']) != self._read_taxon(param['id']):
+            if int(param['ott_id']) != self._read_taxon(cursor, param['id']):
                 # if animal has changed, insert new entry, don't update old one
-                self._insert_animal(param['ott_id'], param['id'])
+                self._insert_animal(cursor, param['ott_id'], param['id'])
 
         return {'headers': ['response'], 'results': []}
 
-    def _read_taxon(self, exp_id):
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                select
-                   taxon_id
-                from
-                   individual_animal,test_animal
-                where
-                   test_animal.audiogram_experiment_id=%(exp_id)s
-                and
-                   test_animal.individual_animal_id=individual_animal.id;
-                """,
-                {
-                    'exp_id': exp_id
-                }
-            )
-            row_headers = [x[0] for x in cursor.description]
-            ott_id = cursor.fetchone()[0]
-            return ott_id
+    def _read_taxon(self, cursor, exp_id):
+        cursor.execute(
+            """
+            select
+               taxon_id
+            from
+               individual_animal,test_animal
+            where
+               test_animal.audiogram_experiment_id=%(exp_id)s
+            and
+               test_animal.individual_animal_id=individual_animal.id;
+            """,
+            {
+                'exp_id': exp_id
+            }
+        )
+        ott_id = cursor.fetchone()[0]
+        return ott_id
 
 
 class DeleteQuery(AdminQuery):  # pylint: disable=too-few-public-methods
     """Deletes an audiogram from the database."""
 
+    tables_written = ('audiogram_experiment', 'audiogram_data_point', 'audiogram_publication',
+                      'test_animal', 'publication', 'facility', 'individual_animal')
+
     def _run(self, param=None):
-        with self.connection as cursor:
+        with self.transaction() as cursor:
             # delete experiment
             cursor.execute(
                 """
@@ -657,6 +970,13 @@ class DeleteQuery(AdminQuery):  # pylint: disable=too-few-public-methods
                 )
                 """
             )
+            AdminQuery.journal(cursor, 'audiogram_experiment', 'delete', 'id', [param])
+            for table in ('audiogram_data_point', 'audiogram_publication', 'test_animal'):
+                AdminQuery.journal(cursor, table, 'delete',
+                                   'audiogram_experiment_id', [param])
+            # rows left without audiogram, any of them may be gone
+            for table in ('publication', 'facility', 'individual_animal'):
+                AdminQuery.journal(cursor, table, 'delete')
 
         return {'headers': ['response'], 'results': []}
 
@@ -664,6 +984,8 @@ class DeleteQuery(AdminQuery):  # pylint: disable=too-few-public-methods
 class AnimalQuery(AdminQuery):
     """Get details of animal(s) involved in this experiment."""
 
+    tables_read = ('audiogram_experiment', 'test_animal', 'individual_animal', 'taxon')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -700,6 +1022,9 @@ class AllTaxaVernacularQuery(AdminQuery):
     for the time being: return only species and subspecies
     """
 
+    cache_ttl = 300
+    tables_read = ('taxon', 'individual_animal')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -728,6 +1053,9 @@ class AllTaxaVernacularQuery(AdminQuery):
 class AllFacilitiesQuery(AdminQuery):
     """Get all facilities in the database."""
 
+    cache_ttl = 300
+    tables_read = ('facility',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -749,6 +1077,9 @@ class AllFacilitiesQuery(AdminQuery):
 class AllMeasurementMethodsQuery(AdminQuery):
     """Get method id and full method name for all measurement methods in the database."""
 
+    cache_ttl = 300
+    tables_read = ('audiogram_experiment', 'method')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -778,6 +1109,9 @@ class AllMeasurementMethodsQuery(AdminQuery):
 class AllToneMethodsQuery(AdminQuery):
     """Get method id and full method name for all measurement methods in the database."""
 
+    cache_ttl = 300
+    tables_read = ('audiogram_experiment', 'method')
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -805,6 +1139,9 @@ class AllToneMethodsQuery(AdminQuery):
 class All_publications_query(AdminQuery):
     """Get publication id and short citation for all publications in the database."""
 
+    cache_ttl = 300
+    tables_read = ('publication',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -826,6 +1163,8 @@ class All_publications_query(AdminQuery):
 class Read_publication_query(AdminQuery):
     """Get publication id and short citation for all publications in the database."""
 
+    tables_read = ('publication',)
+
     def _run(self, param=None):
         with self.connection as cursor:
             cursor.execute(
@@ -852,6 +1191,8 @@ class Read_publication_query(AdminQuery):
 class Add_publication_query(AdminQuery):
     """Adds a publication to the database."""
 
+    tables_written = ('publication',)
+
     def _run(self, param=None):
         param = AdminQuery.check_params(param)
         try:
@@ -875,14 +1216,11 @@ class Add_publication_query(AdminQuery):
                         'citation_short': param['citation_short']
                     }
                 )
-            # When added, return id of added publication
-            with self.connection as cursor:
-                cursor.execute(
-                    """select max(id) from publication"""
-                )
-                row_headers = [x[0] for x in cursor.description]
-                all_results = cursor.fetchall()
-            return {'headers': row_headers, 'results': all_results}
+                # When added, return id of added publication
+                resp = AdminQuery.inserted(cursor)
+                AdminQuery.journal(cursor, 'publication', 'insert',
+                                   'id', [cursor.lastrowid])
+                return resp
         except Exception as e:
             logging.warning(e)
             # When error, return false
@@ -890,167 +1228,163 @@ class Add_publication_query(AdminQuery):
 
 
 class Add_taxon_query(AdminQuery):
-    """Adds a taxon to the database."""
+    """Adds a taxon to the database.
+
+    Missing ranks are inserted top-down, each new taxon becomes the last child
+    of its parent and the nested set indexes (lft, rgt) are shifted in place.
+    """
+
+    tables_written = ('taxon',)
 
     def _run(self, params=None):
         params = AdminQuery.check_params(params)
+        self._rebuild = False
         try:
-            # phylum
-            if not self._check_taxon_present(params['phylum']):
-                self._insert_taxon(
-                    params['phylum_ott_id'],
-                    params['phylum'],
-                    'phylum',
-                    None,
-                    None)
-
-            # class
-            if not self._check_taxon_present(params['class']):
-                self._insert_taxon(
-                    params['class_ott_id'],
-                    params['class'],
-                    'class',
-                    params['phylum_ott_id'],
-                    None)
-
-            # order
-            if not self._check_taxon_present(params['order']):
-                self._insert_taxon(
-                    params['order_ott_id'],
-                    params['order'],
-                    'order',
-                    params['class_ott_id'],
-                    None)
-
-            # family
-            if not self._check_taxon_present(params['family']):
-                self._insert_taxon(
-                    params['family_ott_id'],
-                    params['family'],
-                    'family',
-                    params['order_ott_id'],
-                    None)
-
-            # genus
-            if not self._check_taxon_present(params['genus']):
-                self._insert_taxon(
-                    params['genus_ott_id'],
-                    params['genus'],
-                    'genus',
-                    params['family_ott_id'],
-                    None)
-
-            # species
-            if not self._check_taxon_present(params['unique_name']):
+            with self.transaction() as cursor:
+                # phylum
+                if not self._check_taxon_present(cursor, params['phylum']):
+                    self._insert_taxon(
+                        cursor,
+                        params['phylum_ott_id'],
+                        params['phylum'],
+                        'phylum',
+                        None,
+                        None)
+
+                # class
+                if not self._check_taxon_present(cursor, params['class']):
+                    self._insert_taxon(
+                        cursor,
+                        params['class_ott_id'],
+                        params['class'],
+                        'class',
+                        params['phylum_ott_id'],
+                        None)
+
+                # order
+                if not self._check_taxon_present(cursor, params['order']):
+                    self._insert_taxon(
+                        cursor,
+                        params['order_ott_id'],
+                        params['order'],
+                        'order',
+                        params['class_ott_id'],
+                        None)
+
+                # family
+                if not self._check_taxon_present(cursor, params['family']):
+                    self._insert_taxon(
+                        cursor,
+                        params['family_ott_id'],
+                        params['family'],
+                        'family',
+                        params['order_ott_id'],
+                        None)
+
+                # genus
+                if not self._check_taxon_present(cursor, params['genus']):
+                    self._insert_taxon(
+                        cursor,
+                        params['genus_ott_id'],
+                        params['genus'],
+                        'genus',
+                        params['family_ott_id'],
+                        None)
+
+                # species
+                if self._check_taxon_present(cursor, params['unique_name']):
+                    # taxon is already in database
+                    raise Exception('Already in database')
                 self._insert_taxon(
+                    cursor,
                     params['species_ott_id'],
                     params['unique_name'],
                     'species',
                     params['genus_ott_id'],
                     params['vernacular_name'])
-                return {'headers': ['response'], 'results': [[True]]}
 
-            # taxon is already in database
-            else:
-                raise Exception('Already in database')
+                # the tree had no usable indexes, number all taxa
+                if self._rebuild:
+                    RebuildNestedSetQuery.rebuild(cursor)
+                # the indexes of other taxa were shifted
+                AdminQuery.journal(cursor, 'taxon', 'update')
+            return {'headers': ['response'], 'results': [[True]]}
         except Exception as e:
             logging.warning(e)
             # When error, return false
             return {'headers': ['response'], 'results': [[False], [str(e)]]}
-        finally:
-            self._make_nested_set()
-
-    def _make_nested_set(self):
-        """Adds left and right indexes to make an nested set out of the taxonomic tree."""
-        root_ott_id = self._get_root()
-        index = 1
-        # root['lft'] = index
-        index = self._nested_set_recurse(index, root_ott_id)
-        # root['rgt'] = index
-
-    def _nested_set_recurse(self, index, parent_ott_id):
-        """Recurse the nodes of the tree, adding left and right indexes."""
-        index += 1
-        children = self._get_child_nodes(parent_ott_id)
-        for taxon in children:
-            ott_id = taxon[0]
-            self._set_lft(ott_id, index)
-        #    taxon['lft'] = index
-            index = self._nested_set_recurse(index, taxon)
-        #    taxon['rgt'] = index
-            self._set_rgt(ott_id, index)
-            index += 1
-        return index
-
-    def _set_lft(self, ott_id, index):
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                    update
-                       taxon
-                    set
-                       lft = %(lft)s
-                    where
-                       ott_id=%(ott_id)s
-                        """,
-                {
-                    'lft': index,
-                    'ott_id': ott_id
-                }
-            )
 
-    def _set_rgt(self, ott_id, index):
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                    update
-                       taxon
-                    set
-                       rgt = %(rgt)s
-                    where
-                       ott_id=%(ott_id)s
-                        """,
-                {
-                    'rgt': index,
-                    'ott_id': ott_id
-                }
-            )
+    def _make_room(self, cursor, parent):
+        """
+        Opens a gap for a new leaf at the end of parent's children.
 
-    def _get_child_nodes(self, parent_ott_id):
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                    select
-                       ott_id
-                    from
-                       taxon
-                    where
-                       parent=%(parent_ott_id)s
-                        """,
-                {
-                    'parent_ott_id': parent_ott_id
-                }
-            )
-            children_ott_id = cursor.fetchall()
-        return (children_ott_id)
+        Shifts all indexes right of the gap with two set-based updates.
 
-    def _get_root(self):
-        # get the ott_id of the root of the tree
-        with self.connection as cursor:
+        Return
+        ------
+        (lft, rgt) of the new leaf, or (None, None) when parent has no indexes
+        """
+        if parent is None:
+            # a new root goes after all existing trees
             cursor.execute(
                 """
                     select
-                       ott_id
+                       coalesce(max(rgt), 0)
                     from
                        taxon
-                    where
-                       rank='phylum'
                 """
             )
-            root_ott_id = cursor.fetchone()[0]
-        return (root_ott_id)
+            right = cursor.fetchone()[0] + 1
+            return right, right + 1
 
-    def _check_taxon_present(self, unique_name):
+        cursor.execute(
+            """
+                select
+                   rgt
+                from
+                   taxon
+                where
+                   ott_id=%(parent)s
+                for update
+            """,
+            {
+                'parent': parent
+            }
+        )
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            self._rebuild = True
+            return None, None
+        right = row[0]
+        cursor.execute(
+            """
+                update
+                   taxon
+                set
+                   rgt = rgt + 2
+                where
+                   rgt >= %(right)s
+            """,
+            {
+                'right': right
+            }
+        )
+        cursor.execute(
+            """
+                update
+                   taxon
+                set
+                   lft = lft + 2
+                where
+                   lft > %(right)s
+            """,
+            {
+                'right': right
+            }
+        )
+        return right, right + 1
+
+    def _check_taxon_present(self, cursor, unique_name):
         """
         Checks that taxon is not already in database
 
@@ -1059,48 +1393,73 @@ class Add_taxon_query(AdminQuery):
         True when taxon is present
         False when taxon is not present
         """
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                    select
-                       ott_id
-                    from
-                       taxon
-                    where
-                       unique_name=%(unique_name)s
-                """,
-                {
-                    'unique_name': unique_name
-                }
-            )
-            row_headers = [x[0] for x in cursor.description]
-            all_results = cursor.fetchall()
+        cursor.execute(
+            """
+                select
+                   ott_id
+                from
+                   taxon
+                where
+                   unique_name=%(unique_name)s
+            """,
+            {
+                'unique_name': unique_name
+            }
+        )
+        all_results = cursor.fetchall()
         return (len(all_results) != 0)
 
-    def _insert_taxon(self, ott_id, unique_name, rank, parent="NULL", vernacular_name="NULL"):
-        with self.connection as cursor:
-            cursor.execute(
-                """
-                        insert into taxon(
-                           ott_id,
-                           unique_name,
-                           rank,
-                           parent,
-                           vernacular_name_english
-                        )
-                        values (
-                           %(ott_id)s,
-                           %(unique_name)s,
-                           %(rank)s,
-                           %(parent)s,
-                           %(vernacular_name)s
-                        )
-                        """,
-                {
-                    'ott_id': ott_id,
-                    'unique_name': unique_name,
-                    'rank': rank,
-                    'parent': parent,
-                    'vernacular_name': vernacular_name
-                }
-            )
+    def _insert_taxon(self, cursor, ott_id, unique_name, rank, parent="NULL", vernacular_name="NULL"):
+        lft, rgt = self._make_room(cursor, parent)
+        cursor.execute(
+            """
+                    insert into taxon(
+                       ott_id,
+                       unique_name,
+                       rank,
+                       parent,
+                       vernacular_name_english,
+                       lft,
+                       rgt
+                    )
+                    values (
+                       %(ott_id)s,
+                       %(unique_name)s,
+                       %(rank)s,
+                       %(parent)s,
+                       %(vernacular_name)s,
+                       %(lft)s,
+                       %(rgt)s
+                    )
+                    """,
+            {
+                'ott_id': ott_id,
+                'unique_name': unique_name,
+                'rank': rank,
+                'parent': parent,
+                'vernacular_name': vernacular_name,
+                'lft': lft,
+                'rgt': rgt
+            }
+        )
+
+
+class RebuildNestedSetQuery(AdminQuery):
+    """Recomputes the nested set indexes (lft, rgt) of the whole taxon table.
+
+    Loads the tree with one select, numbers it in memory (see data_import.NestedSet)
+    and writes all indexes back with one update.
+    """
+
+    tables_written = ('taxon',)
+
+    def _run(self, param=None):
+        with self.transaction() as cursor:
+            count = RebuildNestedSetQuery.rebuild(cursor)
+            AdminQuery.journal(cursor, 'taxon', 'update')
+        return {'headers': ['taxa'], 'results': [[count]]}
+
+    @classmethod
+    def rebuild(cls, cursor):
+        """Renumbers all taxa using cursor, returns the number of taxa."""
+        return NestedSet.rebuild(cursor)
@@ -0,0 +1,134 @@
+"""
+Database connection pool.
+* Keeps a bounded number of pymysql connections open per process
+* Checks connections before handing them out, recycles idle ones
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import threading
+import time
+import logging
+import pymysql
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection becomes available within the timeout."""
+
+
+class ConnectionPool:
+    """A thread safe pool of pymysql connections."""
+
+    def __init__(self, host, username, password, database,
+                 size=5, timeout=10, max_idle=300):
+        """
+        @param size int, maximum number of connections open at the same time
+        @param timeout float, seconds to wait for a free connection
+        @param max_idle float, seconds after which an idle connection is closed instead of reused
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = []  # list of (connection, released_at), most recently used last
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'recycled': 0,
+            'broken': 0,
+            'waits': 0,
+            'timeouts': 0,
+        }
+
+    def acquire(self):
+        """Returns an open connection, creating one if none is idle."""
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while not self._idle and self._in_use >= self.size:
+                self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._lock.wait(remaining):
+                    if not self._idle and self._in_use >= self.size:
+                        self._stats['timeouts'] += 1
+                        raise PoolExhausted(
+                            "No database connection available after %ss" % self.timeout)
+            # reserve a slot, connecting happens outside the lock
+            self._in_use += 1
+            candidate = self._idle.pop() if self._idle else None
+
+        try:
+            connection = self._check(candidate)
+            if connection is None:
+                connection = self._connect()
+            return connection
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, connection, discard=False):
+        """Hands a connection back to the pool, or closes it when discard is set."""
+        if discard:
+            self._close(connection)
+        with self._lock:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append((connection, time.monotonic()))
+            self._lock.notify()
+
+    def stats(self):
+        """Returns the pool counters as a dict."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def close_all(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _check(self, candidate):
+        """Returns the idle connection if it is still usable, None otherwise."""
+        if candidate is None:
+            return None
+        connection, released_at = candidate
+        if time.monotonic() - released_at > self.max_idle:
+            self._count('recycled')
+            self._close(connection)
+            return None
+        try:
+            connection.ping(reconnect=False)
+        except Exception as e:
+            logging.warning(e)
+            self._count('broken')
+            self._close(connection)
+            return None
+        self._count('reused')
+        return connection
+
+    def _connect(self):
+        connection = pymysql.connect(
+            self.host, self.username, self.password, self.database)
+        self._count('created')
+        return connection
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
@@ -0,0 +1,243 @@
+"""
+Background jobs for backups, restores and imports.
+* Runs long work in a thread pool, outside the Flask request threads
+* Keeps the jobs in a SQLite file, so their state can be polled from any request and survives restarts
+* Jobs report their stage and percent done while running
+* Jobs writing to the database run one at a time, across the processes sharing the job file,
+  by a lock on a file next to it
+* Each job records the host and pid of the process running it, and the runner that queued it,
+  a starting runner fails the jobs of processes on its host that are gone
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import simplejson
+
+
+class Job:
+    """Handle passed to the work function of a job, to report progress."""
+
+    def __init__(self, runner, job_id):
+        self.runner = runner
+        self.id = job_id
+
+    @property
+    def result_path(self):
+        """File for a result too large for the job table, e.g. a backup, served by the jobs API."""
+        return os.path.join(self.runner.result_dir, self.id)
+
+    def progress(self, stage, percent=None):
+        """
+        @param stage String, e.g. 'load'
+        @param percent float 0-100 of the whole job, None to keep the last value
+        """
+        self.runner._update(self.id, stage=stage, percent=percent)
+
+
+class JobRunner:
+    """
+    A thread pool running jobs, and the SQLite table recording them.
+    Several processes on one host may share a job file, e.g. the workers of a WSGI server.
+    On start, jobs left queued or running by a process of this host that no longer runs are marked as failed.
+    """
+
+    STATES = ('queued', 'running', 'done', 'failed')
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _tokens = set()  # of the runners created in this process, their jobs are never orphaned
+    _settings = {'path': "/tmp/aad_jobs.sqlite",
+                 'result_dir': "/tmp/aad_jobs",
+                 'workers': 2,
+                 'retention_days': 7}
+
+    def __init__(self, path, result_dir, workers=2, retention_days=7):
+        """
+        @param path String, SQLite file of the job table
+        @param result_dir String, directory of result files
+        @param workers int, jobs running at the same time
+        @param retention_days float, finished jobs and their results are deleted after this time
+        """
+        self.path = path
+        self.result_dir = result_dir
+        self.retention = retention_days * 24 * 3600
+        self.lock_path = path + '.lock'
+        self.token = uuid.uuid4().hex
+        JobRunner._tokens.add(self.token)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        os.makedirs(result_dir, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job ("
+            "id TEXT PRIMARY KEY, kind TEXT, state TEXT, stage TEXT, percent REAL, "
+            "created REAL, started REAL, finished REAL, result TEXT, error TEXT, "
+            "host TEXT, pid INTEGER, runner TEXT)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(job)")]
+        for column, kind in (('host', 'TEXT'), ('pid', 'INTEGER'), ('runner', 'TEXT')):
+            if column not in columns:
+                self._db.execute("ALTER TABLE job ADD COLUMN %s %s" % (column, kind))
+        self._fail_orphans()
+
+    @classmethod
+    def configure(cls, config):
+        """
+        Sets up the shared runner from the admin configuration.
+        Options: JOBS_PATH, JOBS_RESULT_DIR, JOB_WORKERS, JOB_RETENTION_DAYS
+        """
+        with cls._shared_lock:
+            cls._settings = {
+                'path': config.get('DEFAULT', 'JOBS_PATH',
+                                   fallback=cls._settings['path']),
+                'result_dir': config.get('DEFAULT', 'JOBS_RESULT_DIR',
+                                         fallback=cls._settings['result_dir']),
+                'workers': config.getint('DEFAULT', 'JOB_WORKERS',
+                                         fallback=cls._settings['workers']),
+                'retention_days': config.getfloat('DEFAULT', 'JOB_RETENTION_DAYS',
+                                                  fallback=cls._settings['retention_days'])}
+            cls._shared = None
+
+    @classmethod
+    def shared(cls):
+        """The runner used by the admin API."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = JobRunner(**cls._settings)
+            return cls._shared
+
+    def submit(self, kind, work, *args, exclusive=False):
+        """
+        Queues a job.
+
+        @param kind String, e.g. 'backup', 'restore', 'import'
+        @param work callable(Job, *args) returning a json serializable result
+        @param exclusive bool, wait for other exclusive jobs of all processes, for jobs writing to the database
+        @return String, job id
+        """
+        self._prune()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO job (id, kind, state, stage, percent, created, host, pid, runner) "
+                "VALUES (?, ?, 'queued', 'queued', 0, ?, ?, ?, ?)",
+                (job_id, kind, time.time(), socket.gethostname(), os.getpid(), self.token))
+            self._db.commit()
+        self._executor.submit(self._run, Job(self, job_id), work, args, exclusive)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns a job as dict{'id', 'kind', 'state', 'stage', 'percent', 'created', 'started', 'finished',
+        'queued_seconds', 'run_seconds', 'result', 'error', 'host', 'pid', 'runner'}, or None when unknown.
+        """
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM job WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([column[0] for column in cursor.description], row))
+        job['result'] = simplejson.loads(job['result']) if job['result'] else None
+        now = time.time()
+        job['queued_seconds'] = (job['started'] or job['finished'] or now) - job['created']
+        job['run_seconds'] = (job['finished'] or now) - job['started'] if job['started'] else None
+        return job
+
+    def result_file(self, job_id):
+        """Returns the path of the result file of a finished job, or None."""
+        job = self.get(job_id)
+        path = os.path.join(self.result_dir, job_id)
+        if job is None or job['state'] != 'done' or not os.path.exists(path):
+            return None
+        return path
+
+    def _run(self, job, work, args, exclusive):
+        try:
+            with self._exclusive(job, exclusive):
+                self._update(job.id, state='running', stage='running', started=time.time())
+                result = work(job, *args)
+            self._update(job.id, state='done', stage='done', percent=100,
+                         finished=time.time(), result=simplejson.dumps(result))
+        except Exception as e:
+            logging.exception("Job %s failed" % job.id)
+            self._update(job.id, state='failed', finished=time.time(), error=str(e))
+
+    @contextlib.contextmanager
+    def _exclusive(self, job, exclusive):
+        """
+        Holds the lock file of the job file while an exclusive job runs.
+        Each job opens the file, so that the lock also excludes the other threads of this process,
+        and the lock is released when a process dies.
+        """
+        if not exclusive:
+            yield
+            return
+        job.progress('waiting')
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _update(self, job_id, **values):
+        values = {key: value for key, value in values.items() if value is not None}
+        with self._lock:
+            self._db.execute(
+                "UPDATE job SET %s WHERE id = ?" % ", ".join("%s = ?" % key for key in values),
+                list(values.values()) + [job_id])
+            self._db.commit()
+
+    def _prune(self):
+        """Deletes finished jobs past the retention time, and their result files."""
+        limit = time.time() - self.retention
+        with self._lock:
+            old = [row[0] for row in self._db.execute(
+                "SELECT id FROM job WHERE finished < ?", (limit,))]
+            self._db.executemany("DELETE FROM job WHERE id = ?", [(job_id,) for job_id in old])
+            self._db.commit()
+        for job_id in old:
+            path = os.path.join(self.result_dir, job_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fail_orphans(self):
+        """Marks the unfinished jobs of processes that are gone as failed."""
+        orphans = [job_id for job_id, host, pid, runner in self._db.execute(
+            "SELECT id, host, pid, runner FROM job WHERE state IN ('queued', 'running')")
+            if JobRunner._orphaned(host, pid, runner)]
+        self._db.executemany(
+            "UPDATE job SET state = 'failed', error = 'Interrupted by a restart', finished = ? "
+            "WHERE id = ? AND state IN ('queued', 'running')",
+            [(time.time(), job_id) for job_id in orphans])
+        self._db.commit()
+
+    @staticmethod
+    def _orphaned(host, pid, runner):
+        """True for a job of a process of this host that is gone, the jobs of other hosts are left alone."""
+        if host is None:
+            # written before owners were recorded
+            return True
+        if host != socket.gethostname():
+            return False
+        if pid == os.getpid():
+            # queued by a runner of this process, e.g. one replaced by configure(), it may still run;
+            # else left by the last process, which had the same pid, e.g. in a container
+            return runner not in JobRunner._tokens
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # a process of another user
+            return False
+        return False
@@ -0,0 +1,86 @@
+"""
+Query result cache.
+* Keeps query results in memory for a limited time
+* Evicts the least recently used entry when full
+* Entries are tagged with the tables they were read from, writes to a table invalidate them
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """A thread safe, size bounded cache with per entry time to live."""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, tables, value)
+        self._generations = {}  # table name -> number of invalidations
+        self._epoch = 0  # number of clear() calls
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """Returns the cached value, or None when missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[2]
+
+    def generation(self, tables):
+        """
+        Snapshot of the invalidation counters of tables.
+        Pass it to put() so that a result read before a concurrent write is not stored.
+        """
+        with self._lock:
+            return self._generation(tables)
+
+    def put(self, key, value, ttl, tables, generation=None):
+        """Stores value for ttl seconds, tagged with the tables it was read from."""
+        with self._lock:
+            if generation is not None and generation != self._generation(tables):
+                return
+            self._entries[key] = (time.monotonic() + ttl, tuple(tables), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, tables):
+        """Drops all entries read from any of tables."""
+        tables = set(tables)
+        with self._lock:
+            for t in tables:
+                self._generations[t] = self._generations.get(t, 0) + 1
+            stale = [key for key, entry in self._entries.items()
+                     if tables.intersection(entry[1])]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidations'] += len(stale)
+
+    def clear(self):
+        """Drops all entries, e.g. after the database has been restored."""
+        with self._lock:
+            self._epoch += 1
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def _generation(self, tables):
+        return (self._epoch,) + tuple(self._generations.get(t, 0) for t in tables)
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+        return stats
@@ -0,0 +1,28 @@
+'''
+Created on 18.10.2026
+Recompute the nested set indexes (lft, rgt) of the taxon table offline.
+@author: Museum fuer Naturkunde Berlin
+
+    Adding a taxon through the admin interface keeps the indexes up to date,
+    use this after importing or editing taxa by other means.
+
+    Example:
+    python RebuildNestedSet.py --config /src/.env
+
+'''
+import argparse
+import configparser
+from AdminQuery import RebuildNestedSetQuery
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rebuild the nested set indexes of the taxon table.')
+    parser.add_argument('--config', default='/src/.env',
+                        help='path to the admin configuration file')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    resp = RebuildNestedSetQuery(config).run()
+    print("Indexed %d taxa" % resp[0]['taxa'])
@@ -6,54 +6,286 @@ Handle database backups
 '''
 import logging
 import os
+import subprocess
+import tempfile
+import zlib
+import pymysql
+from data_import.ChangeJournal import ChangeJournal
+from data_import.Restore import Restore, DumpManifest, DumpDiff, statements
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BackupError(Exception):
+    """mysqldump failed, the dump is incomplete."""
+    pass
 
 
 class Backup:
+    DIFF_BATCH = 500
+    """Keys per DELETE and rows per INSERT statement of a differential dump."""
+
     def __init__(self, config):
+        self.config = config
         self.host = config.get('DEFAULT', 'DB_HOST')
         self.password = config.get('DEFAULT', 'DB_PASSWORD')
         self.username = config.get('DEFAULT', 'DB_USERNAME')
         self.database = config.get('DEFAULT', 'DB_DATABASE')
-        self.backup_file = '/tmp/backup.sql'
+        self.position = None
+
+    def stream(self, compress=None, chunk_size=65536):
+        """
+        Dump database, streaming the output of mysqldump.
+        Each call runs its own mysqldump process, the password is passed in the environment.
+        The dump starts with the change journal position, set in self.position,
+        differential backups of later changes start there (see diff()).
+
+        @param compress None, 'gzip' or 'zstd' (needs the zstandard package)
+        @param chunk_size int, bytes of dump statements sent at a time
+        @return generator of bytes, raising BackupError when mysqldump fails, after the statements read
+        @raise ValueError for an unknown or unavailable compression
+        """
+        compressor = self._compressor(compress)
+        self.position = self._journal_position()
+        return self._stream(compressor, chunk_size)
+
+    def diff(self, since, compress=None):
+        """
+        Differential dump of the rows changed since a journal position,
+        the position of a full dump or of the previous diff.
+        Changed rows are deleted by key and inserted again as they are now, deleted rows are only deleted.
+        Tables restored since are recorded as changed as a whole, and exported in full (see Restore).
+        The new journal position is set in self.position.
+
+        @param since int, journal position
+        @param compress None, 'gzip' or 'zstd' (needs the zstandard package)
+        @return generator of bytes
+        @raise ValueError for an unknown or unavailable compression, or a position ahead of the journal
+        """
+        compressor = self._compressor(compress)
+        self.position = self._journal_position()
+        if since > self.position:
+            raise ValueError("Position %d is ahead of the journal (%d)" % (since, self.position))
+        return self._diff(since, self.position, compressor)
 
-    def create(self):
-        """Dump database to file"""
+    def _compressor(self, compress):
+        if compress == 'gzip':
+            # wbits 31: gzip header and trailer
+            compressor = zlib.compressobj(wbits=31)
+        elif compress == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd compression needs the zstandard package")
+            compressor = zstandard.ZstdCompressor().compressobj()
+        elif compress is None:
+            compressor = None
+        else:
+            raise ValueError("Unknown compression %s" % compress)
+        return compressor
+
+    def _connect(self):
+        return pymysql.connect(
+            self.host, self.username, self.password, self.database, charset='utf8mb4')
+
+    def _journal_position(self):
+        """
+        Returns the last id of the change journal, 0 when there is none yet.
+        The read lock waits for write transactions still adding to the journal,
+        so no change with a smaller id can be committed later.
+        """
+        connection = self._connect()
         try:
-            command = "mysqldump -h %s -u %s -p%s %s > %s" % (
-                self.host, self.username, self.password, self.database, self.backup_file)
-            os.system(command)
-            return self.backup_file
-        except Exception as e:
-            logging.warning(e)
-            return False
-
-    def restore(self):
-        # drop all tables
-        self._drop_all_tables()
-        # restore the data from file
-        command = "mysql -h %s -u %s -p%s %s < %s" % (
-            self.host, self.username, self.password, self.database, self.backup_file)
-        os.system(command)
-
-    def _drop_all_tables(self):
-        """Drops all audiogram tables in the database"""
-        drop_tables_sql = """
-        drop table audiogram_data_point,
-        audiogram_experiment,
-        audiogram_publication,
-        facility,
-        individual_animal,
-        publication,
-        taxon,
-        test_animal,
-        sound_pressure_level_reference,
-        method;"""
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute("LOCK TABLES %s READ" % ChangeJournal.TABLE)
+                except pymysql.err.ProgrammingError:
+                    # no change recorded yet
+                    return 0
+                try:
+                    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM %s" % ChangeJournal.TABLE)
+                    return int(cursor.fetchone()[0])
+                finally:
+                    cursor.execute("UNLOCK TABLES")
+        finally:
+            connection.close()
+
+    def _diff(self, since, position, compressor):
+        connection = self._connect()
         try:
-            command = "mysql -h %s -u %s -p%s %s -Bse \"%s\"" % (
-                self.host, self.username, self.password, self.database,
-                drop_tables_sql)
-            os.system(command)
-            return True
+            with connection.cursor() as cursor:
+                # the changed rows are read as they were at one point in time
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                changes = self._changes(cursor, since, position)
+                yield from self._compress(compressor, DumpDiff.header(since, position))
+                yield from self._compress(compressor, b'SET foreign_key_checks=0;\n')
+                for table, keys in changes.items():
+                    for sql in self._diff_statements(connection, cursor, table, keys):
+                        yield from self._compress(compressor, sql.encode('utf-8') + b';\n')
+                yield from self._compress(compressor, b'SET foreign_key_checks=1;\n')
+                # checked by Restore, a diff cut short has no footer
+                yield from self._compress(compressor, DumpDiff.footer(position))
+                if compressor is not None:
+                    yield compressor.flush()
+            connection.rollback()
+        finally:
+            connection.close()
+
+    def _changes(self, cursor, since, position):
+        """
+        Reads the journal between two positions.
+
+        @return dict table: {key column: set of key values}, key column None when the whole table changed
+        """
+        cursor.execute(
+            """
+            select table_name, key_column, key_value
+            from change_journal
+            where id > %s and id <= %s
+            order by id
+            """,
+            (since, position))
+        changes = {}
+        for table, column, value in cursor.fetchall():
+            keys = changes.setdefault(table, {})
+            if None in keys:
+                continue
+            if column is None:
+                keys.clear()
+                keys[None] = None
+            else:
+                keys.setdefault(column, set()).add(value)
+        return changes
+
+    def _diff_statements(self, connection, cursor, table, keys):
+        """DELETE and INSERT statements bringing the changed rows of a table up to date."""
+        if None in keys:
+            yield "DELETE FROM `%s`" % table
+            cursor.execute("SELECT * FROM `%s`" % table)
+            yield from self._inserts(connection, cursor, table)
+            return
+        for column, values in keys.items():
+            values = sorted(values)
+            for i in range(0, len(values), Backup.DIFF_BATCH):
+                where = "`%s` IN (%s)" % (column, ", ".join(
+                    connection.escape(value) for value in values[i:i + Backup.DIFF_BATCH]))
+                yield "DELETE FROM `%s` WHERE %s" % (table, where)
+        # a row may be keyed by several columns, insert it once
+        where = " OR ".join(
+            "`%s` IN (%s)" % (column, ", ".join(connection.escape(value) for value in sorted(values)))
+            for column, values in keys.items())
+        cursor.execute("SELECT * FROM `%s` WHERE %s" % (table, where))
+        yield from self._inserts(connection, cursor, table)
+
+    def _inserts(self, connection, cursor, table):
+        """Multi-row INSERT statements of the rows selected by cursor."""
+        columns = ", ".join("`%s`" % column[0] for column in cursor.description)
+        while True:
+            rows = cursor.fetchmany(Backup.DIFF_BATCH)
+            if not rows:
+                return
+            yield "INSERT INTO `%s` (%s) VALUES %s" % (table, columns, ", ".join(
+                "(%s)" % ", ".join(connection.escape(value) for value in row) for row in rows))
+
+    def save(self, path, compress=None, progress=None):
+        """
+        Dump database to a file, see stream()
+
+        @param progress callable(String stage, float percent), percent estimated from estimated_size()
+        @return dict{'position', 'bytes', 'compress'}
+        @raise BackupError when mysqldump fails, the file is removed
+        """
+        chunks = self.stream(compress)
+        size = self.estimated_size()
+        written = 0
+        try:
+            with open(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+                    if progress is not None and size:
+                        # compressed dumps are smaller, the estimate is only a guess
+                        progress('dump', min(99, 100 * written / size))
+        except Exception:
+            os.remove(path)
+            raise
+        return {'position': self.position, 'bytes': written, 'compress': compress}
+
+    def estimated_size(self):
+        """Returns the size of data and indexes in bytes from information_schema, a rough guess of the dump size."""
+        try:
+            connection = self._connect()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "select sum(data_length + index_length) from information_schema.tables where table_schema=%s",
+                        (self.database,))
+                    size = cursor.fetchone()[0]
+                    return int(size) if size is not None else None
+            finally:
+                connection.close()
         except Exception as e:
             logging.warning(e)
-            return False
+            return None
+
+    def _compress(self, compressor, data):
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+
+    def _stream(self, compressor, chunk_size):
+        # the journal of the database, not part of the backup
+        command = ['mysqldump', '-h', self.host, '-u', self.username,
+                   '--single-transaction', '--quick',
+                   '--ignore-table=%s.%s' % (self.database, ChangeJournal.TABLE), self.database]
+        env = dict(os.environ, MYSQL_PWD=self.password)
+        # a file, so that a full stderr pipe can't block mysqldump while stdout is read
+        errors = tempfile.TemporaryFile()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=errors, env=env)
+        manifest = DumpManifest()
+        tables = []
+        buffer = []
+        size = 0
+        try:
+            yield from self._compress(compressor, b'%s%d\n' % (DumpManifest.POSITION, self.position))
+            for _, statement in statements(proc.stdout):
+                table = manifest.add(statement)
+                if table is not None and table not in tables:
+                    tables.append(table)
+                buffer.append(statement)
+                size += len(statement)
+                if size >= chunk_size:
+                    yield from self._compress(compressor, b''.join(buffer))
+                    buffer = []
+                    size = 0
+            proc.wait()
+            if proc.returncode != 0:
+                # aborts the download or fails the job, instead of ending a dump cut short
+                errors.seek(0)
+                raise BackupError("mysqldump failed with exit code %d: %s" % (
+                    proc.returncode, errors.read().decode('utf-8', 'replace').strip()))
+            # checked by Restore, a dump cut short has no manifest
+            buffer.append(manifest.comments(tables))
+            yield from self._compress(compressor, b''.join(buffer))
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            # the download was interrupted
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            errors.close()
+
+    def restore(self, path, workers=4, diffs=(), progress=None):
+        """
+        Restore a backup file, see Restore.run()
+        The tables are loaded in parallel into shadow tables, checked, and swapped with the live tables.
+        Then the differential backups are applied, oldest first.
+        """
+        report = Restore(self.config, workers).run(path, diffs, progress)
+        for table in report['tables']:
+            logging.info("%(table)s: %(rows)d rows in %(seconds).3fs, %(rows_per_second).0f rows/s" % table)
+        return report
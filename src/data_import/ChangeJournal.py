@@ -0,0 +1,82 @@
+"""
+Journal of the rows changed in the audiogram tables.
+* Written by the admin queries and the importer, in the transaction of the change
+* Read by differential backups, which export the rows changed since a journal position
+* Read by the ETags of the admin queries, so that writes of any process change them
+* Not part of backups, a position only means something in the database that wrote it
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import pymysql
+
+
+class ChangeJournal:
+    """SQL of the change_journal table, used with the caller's cursor."""
+
+    TABLE = 'change_journal'
+
+    CREATE = """
+        create table if not exists change_journal (
+           id bigint not null auto_increment,
+           table_name varchar(64) not null,
+           key_column varchar(64) default null,
+           key_value varchar(64) default null,
+           op varchar(8) not null,
+           changed_at timestamp not null default current_timestamp,
+           primary key (id),
+           key change_journal_table (table_name, id)
+        )
+        """
+
+    @staticmethod
+    def create(cursor):
+        """
+        Creates the journal table when missing.
+        A table definition commits the open transaction, call it before the change.
+        """
+        cursor.execute(ChangeJournal.CREATE)
+
+    @staticmethod
+    def versions(cursor, tables):
+        """
+        Returns the last journal id of each table, 0 for unchanged tables,
+        all 0 when the journal does not exist yet.
+        """
+        if not tables:
+            return ()
+        try:
+            cursor.execute(
+                """
+                select table_name, max(id)
+                from change_journal
+                where table_name in (%s)
+                group by table_name
+                """ % ", ".join(["%s"] * len(tables)),
+                tuple(tables))
+        except pymysql.err.ProgrammingError:
+            return tuple(0 for _ in tables)
+        last = dict(cursor.fetchall())
+        return tuple(last.get(table, 0) for table in tables)
+
+    @staticmethod
+    def record(cursor, table, op, key_column=None, key_values=()):
+        """
+        Records changed rows.
+
+        @param table String, changed table
+        @param op String, insert, update or delete
+        @param key_column String, column identifying the changed rows, None when any row may have changed
+        @param key_values values of key_column
+        """
+        if key_column is None:
+            rows = [(table, None, None, op)]
+        else:
+            rows = [(table, key_column, str(value), op) for value in key_values]
+        if rows:
+            cursor.executemany(
+                """
+                insert into change_journal(table_name, key_column, key_value, op)
+                values (%s, %s, %s, %s)
+                """,
+                rows)
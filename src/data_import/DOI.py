@@ -9,17 +9,20 @@ https://code.naturkundemuseum.berlin/Alvaro.Ortiz/Pinguine/issues/80
 Content-negociation
 @see: https://citation.crosscite.org/docs.html
 
-BibTeX parser
-@see: https://bibtexparser.readthedocs.io/en/master/tutorial.html#parse-a-string
+CSL-JSON
+@see: https://citeproc-js.readthedocs.io/en/latest/csl-json/markup.html
 
 Created on 12.02.2020
 @author: Alvaro.Ortiz for Museum fuer Naturkunde Berlin
 """
 import abc
+import json
+import logging
+import re
 import urllib.parse
-import requests
-import bibtexparser
-from bibtexparser.customization import convert_to_unicode
+from concurrent.futures import ThreadPoolExecutor
+from data_import.ResponseCache import ResponseCache
+from data_import.HttpClient import HttpClient
 
 
 class DOI(abc.ABC):
@@ -35,82 +38,168 @@ class DOI(abc.ABC):
         pass
 
     def send_request(self, url, headers):
-        response = requests.post(url, headers=headers)
-        if response.status_code != 200:
+        # the same DOI url answers differently per Accept header
+        status, text = ResponseCache.shared().fetch(
+            'doi', url, headers.get('Accept'),
+            lambda: HttpClient.shared().post(url, headers=headers),
+            DOI.cacheable)
+        if status != 200:
             raise Exception("Error %d getting %s" %
-                            (response.status_code, url))
-        return response.text.strip()
+                            (status, url))
+        return text.strip()
 
+    @staticmethod
+    def cacheable(text):
+        """False for anything but a CSL-JSON record, e.g. an HTML landing page answered with status 200."""
+        try:
+            response_json = json.loads(text)
+        except ValueError:
+            return False
+        return isinstance(response_json, dict)
 
-class Obtain_Bibtex(DOI):
-    """Get BibTeX data for a given DOI."""
 
-    def _run(self, param):
-        """
-        Calls DOI.org REST API service,
-        gets matching BibTeX information for the DOI given in param
-
-        @param param String, DOI to search
-        @return String, bibliographical information in BibTeX format
-        """
-        url = urllib.parse.urljoin(DOI.BASE_URL, param)
-        headers = {'Accept': "text/bibliography;style=bibtex"}
-        bibtex = self.send_request(url, headers)
+class Obtain_Publication(DOI):
+    """
+    Get long and short citation for a given DOI, or a list of DOIs.
+    Fetches CSL-JSON once per DOI and formats both citations locally.
+    """
 
-        return bibtex
+    MAX_WORKERS = 4
+    """Concurrent requests to doi.org for a list of DOIs."""
 
-
-class Obtain_Citation(DOI):
-    """Get APA citation for a given DOI."""
+    def __init__(self, max_workers=MAX_WORKERS):
+        """@param max_workers int, concurrent requests to doi.org for a list of DOIs"""
+        self.max_workers = max_workers
 
     def _run(self, param):
         """
         Calls DOI.org REST API service,
-        gets matching APA citation for the DOI given in param
+        gets matching CSL-JSON metadata for the DOI(s) given in param
+
+        @param param String DOI, or list of String DOIs
+        @return dict{'doi':String, 'citation_long':String, 'citation_short':String},
+            for a list: dict DOI: publication dict, or None when the DOI could not be resolved
+        """
+        if isinstance(param, str):
+            return self._publication(param)
+        dois = list(dict.fromkeys(param))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._try_publication, dois))
+        return dict(zip(dois, results))
+
+    def _try_publication(self, doi):
+        try:
+            return self._publication(doi)
+        except Exception as e:
+            logging.warning("Could not get citation for %s: %s" % (doi, e))
+            return None
+
+    def _publication(self, doi):
+        url = urllib.parse.urljoin(DOI.BASE_URL, doi)
+        headers = {'Accept': "application/vnd.citationstyles.csl+json"}
+        csl = json.loads(self.send_request(url, headers))
+        return {
+            'doi': doi,
+            'citation_long': Obtain_Publication.citation_long(csl),
+            'citation_short': Obtain_Publication.citation_short(csl)}
+
+    @staticmethod
+    def citation_long(csl):
+        """
+        Formats CSL-JSON metadata as APA citation, e.g.
+        Kastelein, R. A., Bunskoek, P., & de Haan, D. (2002). Title. Journal, 112(1), 334–344. https://doi.org/10.1121/1.1480835
 
-        @param param String, DOI to search
+        @param csl dict, CSL-JSON item
         @return String, citation in APA format
         """
-        url = urllib.parse.urljoin(DOI.BASE_URL, param)
-        headers = {'Accept': "text/bibliography;style=apa"}
-        citation = self.send_request(url, headers)
+        authors = [Obtain_Publication._apa_name(a) for a in csl.get('author', [])]
+        if len(authors) > 20:
+            authors = authors[:19] + ['...', authors[-1]]
+            author_str = ', '.join(authors)
+        elif len(authors) > 1:
+            author_str = "%s, & %s" % (', '.join(authors[:-1]), authors[-1])
+        else:
+            author_str = ''.join(authors)
+
+        citation = "%s (%s). %s." % (
+            author_str, Obtain_Publication._year(csl) or 'n.d.',
+            Obtain_Publication._text(csl.get('title')).rstrip('.'))
+        container = Obtain_Publication._text(csl.get('container-title'))
+        if container:
+            source = container
+            if csl.get('volume'):
+                source += ", %s" % csl['volume']
+                if csl.get('issue'):
+                    source += "(%s)" % csl['issue']
+            if csl.get('page'):
+                source += ", %s" % str(csl['page']).replace('-', '–')
+            citation += " %s." % source
+        elif csl.get('publisher'):
+            citation += " %s." % csl['publisher']
+        if csl.get('DOI'):
+            citation += " https://doi.org/%s" % csl['DOI']
+
         # Name ist falsch eingetragen beim Journal
         citation = citation.replace('Gotz', 'Götz')
         citation = citation.replace('Ã¢Â€Â“', '-')
-        return citation
-
+        return citation.strip()
 
-class Obtain_Citation_Short(DOI):
-    """Get short citation for a given DOI."""
-
-    def _run(self, param):
+    @staticmethod
+    def citation_short(csl):
         """
-        Calls DOI.org REST API service,
-        returns matching short citation for the DOI given in param
+        Formats CSL-JSON metadata as short citation:
+        up to 3 authors "A, B & C, year", more authors "A et al., year"
 
-        @param param String, DOI to search
+        @param csl dict, CSL-JSON item
         @return String, citation in short format
         """
-        bibtex = Obtain_Bibtex().run(param)
-        bibtexparser.customization = convert_to_unicode
-
-        # Name ist falsch eingetragen beim Journal
-        bibtex = bibtex.replace('Gotz', 'Götz')
-
-        bib_dict = bibtexparser.loads(bibtex)
-        author_str = bib_dict.entries[0]['author']
-        if "and" in author_str:
-            authors = author_str.split(' and ')
-            for i in range(0, len(authors)):
-                authors[i] = authors[i].split(',')[0].strip()
-                if len(authors) <= 3:
-                    author_str = ', '.join(authors)
-                    # replace last comma by &
-                    author_str = author_str[::-1].replace(" ,", " & ", 1)[::-1]
-                else:
-                    author_str = "%s et al." % authors[0]
+        authors = [Obtain_Publication._family(a) for a in csl.get('author', [])]
+        if len(authors) > 3:
+            author_str = "%s et al." % authors[0]
+        elif len(authors) > 1:
+            author_str = "%s & %s" % (', '.join(authors[:-1]), authors[-1])
         else:
-            author_str = author_str.split(',')[0].strip()
+            author_str = ''.join(authors)
 
-        year_str = str(bib_dict.entries[0]['year'])
-        return "%s, %s" % (author_str, year_str)
+        # Name ist falsch eingetragen beim Journal
+        author_str = author_str.replace('Gotz', 'Götz')
+        return "%s, %s" % (author_str, Obtain_Publication._year(csl))
+
+    @staticmethod
+    def _family(author):
+        if 'family' not in author:
+            return author.get('literal', author.get('name', '')).strip()
+        particle = author.get('non-dropping-particle')
+        family = author['family'].strip()
+        return "%s %s" % (particle, family) if particle else family
+
+    @staticmethod
+    def _apa_name(author):
+        """Family name and initials, e.g. Au, W. W. L."""
+        family = Obtain_Publication._family(author)
+        given = author.get('given', '').strip()
+        if not given or 'family' not in author:
+            return family
+        initials = []
+        for name in given.replace('.', '. ').split():
+            initials.append('-'.join("%s." % part[0]
+                                     for part in name.split('-') if part))
+        return "%s, %s" % (family, ' '.join(initials))
+
+    @staticmethod
+    def _year(csl):
+        for key in ('issued', 'published-print', 'published-online', 'created'):
+            try:
+                year = csl[key]['date-parts'][0][0]
+                if year:
+                    return str(year)
+            except (KeyError, IndexError, TypeError):
+                continue
+        return ''
+
+    @staticmethod
+    def _text(value):
+        """CSL strings may be lists and contain html markup."""
+        if isinstance(value, list):
+            value = value[0] if value else ''
+        return re.sub(r'<[^>]+>', '', value or '').strip()
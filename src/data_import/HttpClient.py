@@ -0,0 +1,140 @@
+"""
+HTTP client shared by the Tree of Life, DOI and Wikidata queries.
+* Keeps a session with a pool of keep-alive connections per host
+* Connect and read timeouts, so a slow API can't stall an import
+* Retries connection errors, timeouts and 429/5xx responses with jittered exponential backoff
+* Records latency per host
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import logging
+import random
+import threading
+import time
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpClient:
+    """Thread safe client, one requests.Session per host."""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    """Response status codes worth another try."""
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _settings = {'connect_timeout': 5, 'read_timeout': 30,
+                 'max_retries': 3, 'backoff': 0.5, 'pool_size': 8}
+
+    def __init__(self, connect_timeout=5, read_timeout=30, max_retries=3, backoff=0.5, pool_size=8):
+        """
+        @param connect_timeout float, seconds to establish a connection
+        @param read_timeout float, seconds to wait for data from the server
+        @param max_retries int, retries after the first attempt
+        @param backoff float, seconds, the n-th retry waits up to backoff * 2^n
+        @param pool_size int, keep-alive connections per host
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, config):
+        """
+        Sets up the shared client from the admin configuration.
+        Options: HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_MAX_RETRIES
+        """
+        with cls._shared_lock:
+            cls._settings = dict(
+                cls._settings,
+                connect_timeout=config.getfloat('DEFAULT', 'HTTP_CONNECT_TIMEOUT',
+                                                fallback=cls._settings['connect_timeout']),
+                read_timeout=config.getfloat('DEFAULT', 'HTTP_READ_TIMEOUT',
+                                             fallback=cls._settings['read_timeout']),
+                max_retries=config.getint('DEFAULT', 'HTTP_MAX_RETRIES',
+                                          fallback=cls._settings['max_retries']))
+            cls._shared = None
+
+    @classmethod
+    def shared(cls):
+        """The client used by the send_request methods of the API base classes."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = HttpClient(**cls._settings)
+            return cls._shared
+
+    def post(self, url, **kwargs):
+        """
+        Sends a POST request, retrying on failure.
+
+        @param kwargs passed to requests.Session.post, e.g. data, headers
+        @return requests.Response, the last response when retries are exhausted
+        @raise requests.RequestException when the last attempt failed to connect or timed out
+        """
+        host = urllib.parse.urlparse(url).netloc
+        session = self._session(host)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = session.post(url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, time.perf_counter() - start, error=True)
+                if attempt == self.max_retries:
+                    raise
+                logging.warning("%s, retrying %s" % (e, url))
+                self._wait(host, attempt, None)
+                continue
+            self._record(host, time.perf_counter() - start,
+                         error=response.status_code >= 400)
+            if response.status_code not in HttpClient.RETRY_STATUS or attempt == self.max_retries:
+                return response
+            logging.warning("Status %d, retrying %s" %
+                            (response.status_code, url))
+            self._wait(host, attempt, response.headers.get('Retry-After'))
+
+    def stats(self):
+        """Returns the metrics per host: calls, errors, retries, total, mean and max latency in seconds."""
+        with self._lock:
+            stats = {host: dict(metrics)
+                     for host, metrics in self._metrics.items()}
+        for metrics in stats.values():
+            metrics['mean_seconds'] = metrics['total_seconds'] / \
+                metrics['calls'] if metrics['calls'] else 0
+        return stats
+
+    def _session(self, host):
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+                self._metrics[host] = {'calls': 0, 'errors': 0, 'retries': 0,
+                                       'total_seconds': 0.0, 'max_seconds': 0.0}
+            return self._sessions[host]
+
+    def _record(self, host, seconds, error=False):
+        with self._lock:
+            metrics = self._metrics[host]
+            metrics['calls'] += 1
+            metrics['errors'] += 1 if error else 0
+            metrics['total_seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+    def _wait(self, host, attempt, retry_after):
+        """Sleeps before a retry, full jitter, or as long as the server asks (up to 30s)."""
+        with self._lock:
+            self._metrics[host]['retries'] += 1
+        try:
+            delay = min(float(retry_after), 30)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+        time.sleep(delay)
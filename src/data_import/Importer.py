@@ -10,17 +10,142 @@ Import audiogram data from a spreadsheet into a database
     python Converter.py --in spreadsheet.csv --out data.sql
 
 '''
+from data_import.ChangeJournal import ChangeJournal
+from data_import.NestedSet import NestedSet
 from data_import.SQLSerializer import SQLSerializer
 from data_import.Parser import Parser
+from data_import.Timer import Timer
+import csv
 import logging
-import subprocess
+import pymysql
+import simplejson
 
 
 class Importer():
+
+    LOAD_ORDER = [
+        "facility",
+        "taxon",
+        "publication",
+        "audiogram_experiment",
+        "audiogram_data_point",
+        "individual_animal",
+        "test_animal",
+        "audiogram_publication"]
+    """Tables in foreign key order, referenced tables first."""
+
+    REFERENCE_TABLES = ["method", "sound_pressure_level_reference"]
+    """Tables with the fixed ids of Model, expected in the database, not loaded."""
+
+    NATURAL_KEYS = {
+        "facility": ["name"],
+        "publication": ["doi", "citation_long"],
+        "audiogram_experiment": [],
+        "individual_animal": []}
+    """
+    Tables referenced by other tables of the import, their ids are assigned by the database.
+    Rows are looked up by the first of their columns with a value, and added when not found.
+    """
+
+    FOREIGN_KEYS = {
+        "audiogram_experiment": {"facility_id": "facility"},
+        "audiogram_data_point": {"audiogram_experiment_id": "audiogram_experiment"},
+        "test_animal": {"audiogram_experiment_id": "audiogram_experiment",
+                        "individual_animal_id": "individual_animal"},
+        "audiogram_publication": {"audiogram_experiment_id": "audiogram_experiment",
+                                  "publication_id": "publication"}}
+    """Columns holding ids of the Model, replaced by the database ids."""
+
+    PREVIEW_COLUMNS = ['Audiogram ID', 'Binomial name', 'Frequency (kHz)',
+                       'SPL (with reference level according to next field)', 'DOI', 'Source long']
+    """Columns checked by preview()."""
+
+    NUMERIC_COLUMNS = ['testtone_frequency_in_khz',
+                       'sound_pressure_level_in_decibel', 'testtone_duration_in_millisecond']
+    """Data point values that must be numbers."""
+
+    def __init__(self, config=None):
+        """@param config ConfigParser with the database credentials, needed by load() and import_file()"""
+        self.config = config
+
     def as_json(self, filepath):
-        """Returns a json representation of the csv file."""
-        json_data = []
-        return json_data
+        """Returns a json representation of the csv file, as a generator of json lines, see preview()."""
+        for record in self.preview(filepath):
+            yield simplejson.dumps(record) + "\n"
+
+    def preview(self, filepath):
+        """
+        Generates a preview of the csv file, reading it row by row, without calling external APIs.
+        Only the keys of experiments, taxa and publications already seen are kept in memory.
+
+        @return generator of dicts, each with a 'type':
+        * experiment: first row of an audiogram, mapped to database columns
+        * data_point: every row, mapped to database columns
+        * taxon, publication: first row with a binomial name, DOI or citation
+        * warning: a row with missing or invalid values
+        * counts: last record, number of rows, experiments, data points, taxa, publications and warnings
+        """
+        parser = Parser()
+        counts = {'rows': 0, 'experiments': 0, 'data_points': 0,
+                  'taxa': 0, 'publications': 0, 'warnings': 0}
+        experiments = set()
+        taxa = set()
+        publications = set()
+
+        def warning(line, message):
+            counts['warnings'] += 1
+            return {'type': 'warning', 'line': line, 'message': message}
+
+        with open(filepath) as csv_file:
+            csv_reader = csv.DictReader(csv_file, delimiter=',')
+            missing = [c for c in Importer.PREVIEW_COLUMNS
+                       if c not in (csv_reader.fieldnames or [])]
+            if missing:
+                yield warning(1, "Missing columns: %s" % ', '.join(missing))
+            # line 1 is the header
+            for line, row in enumerate(csv_reader, start=2):
+                counts['rows'] += 1
+                row = {k: (v or '') for k, v in row.items() if k is not None}
+                aid = row.get('Audiogram ID', '')
+                if parser.isna(aid):
+                    yield warning(line, "No audiogram ID")
+                    continue
+                if aid not in experiments:
+                    experiments.add(aid)
+                    counts['experiments'] += 1
+                    experiment = {val: row[key] for key, val in Parser.col_names.items()
+                                  if key in row and not parser.isna(row[key])}
+                    yield {'type': 'experiment', 'line': line, 'experiment': experiment}
+
+                point = {}
+                for key, val in Parser.data_point_names.items():
+                    if key in row and not parser.isna(row[key]):
+                        point[val] = parser.cast(row[key])
+                for key in Importer.NUMERIC_COLUMNS:
+                    if key in point and not isinstance(point[key], float):
+                        yield warning(line, "%s is not a number: %s" % (key, point[key]))
+                counts['data_points'] += 1
+                yield {'type': 'data_point', 'line': line, 'data_point': point}
+
+                name = row.get('Binomial name', '')
+                if parser.isna(name):
+                    yield warning(line, "No binomial name")
+                elif name not in taxa:
+                    taxa.add(name)
+                    counts['taxa'] += 1
+                    yield {'type': 'taxon', 'line': line, 'binomial_name': name}
+
+                publication = {val: row[key] for key, val in Parser.publication_names.items()
+                               if key in row and not parser.isna(row[key])}
+                key = publication.get('doi', publication.get('citation_long'))
+                if key is None:
+                    yield warning(line, "No DOI and no citation")
+                elif key not in publications:
+                    publications.add(key)
+                    counts['publications'] += 1
+                    yield {'type': 'publication', 'line': line, 'publication': publication}
+
+        yield dict(counts, type='counts')
 
     def convert(self, filepath):
         """Convert a csv file to SQL statements."""
@@ -32,16 +157,170 @@ class Importer():
         sql_string = serializer.process(model)
         return sql_string
 
-    def import_sql(self, sql_string):
-        """Import sql dump to database"""
-        with open('/tmp/dump.sql', 'w') as file:
-            file.write(sql_string)
-        command = "mysql -u%s -p%s -hdb audiogrambase < /tmp/dump.sql" % (
-            'root', 'qq0uei')
-        proc = subprocess.Popen(
-            (command).split(),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            shell=False)
-        out, err = proc.communicate()
-        logging.warning(err)
+    def convert_to(self, filepath, sink, batch_size=500):
+        """Convert a csv file to multi-row SQL statements, written to a file-like sink."""
+        model = Parser().process(filepath)
+        serializer = SQLSerializer(batch_size=batch_size, transactions=True)
+        return serializer.write(model, sink)
+
+    def import_file(self, filepath, progress=None):
+        """
+        Parse a csv file and load it into the database, see load().
+
+        @param progress callable(String stage, float percent), called between steps, e.g. Job.progress
+        """
+        progress = progress or (lambda stage, percent: None)
+        with Timer() as timer:
+            progress('parse', 0)
+            model = Parser().process(filepath)
+        report = self.load(model, progress)
+        report['parse_seconds'] = timer.interval
+        return report
+
+    def load(self, model, progress=None):
+        """
+        Load a parsed Model into a database that may hold other audiograms, in one transaction.
+        Tables are written in LOAD_ORDER, the reference tables are expected in the database.
+        Facilities, publications and taxa already in the database are used instead of added,
+        other rows get new ids, and the foreign keys of the Model are replaced by them.
+        Progress is reported from 50 percent on, after parsing.
+
+        @return dict{'tables': [{'table', 'rows', 'existing', 'seconds'}], 'rows': int, 'seconds': float,
+            'audiogram_experiment_ids': {Audiogram ID in the file: id in the database}}
+        """
+        attributes = {table: attribute for attribute,
+                      table in SQLSerializer.TABLES}
+        report = {'tables': [], 'rows': 0}
+        ids = {}  # table: {id in the Model: id in the database}
+        added_ids = {}  # table: ids of the added rows
+        connection = pymysql.connect(
+            host=self.config.get('DEFAULT', 'DB_HOST'),
+            user=self.config.get('DEFAULT', 'DB_USERNAME'),
+            password=self.config.get('DEFAULT', 'DB_PASSWORD'),
+            database=self.config.get('DEFAULT', 'DB_DATABASE'))
+        try:
+            with Timer() as total, connection.cursor() as cursor:
+                ChangeJournal.create(cursor)
+                for i, table in enumerate(Importer.LOAD_ORDER):
+                    if progress is not None:
+                        progress('load', 50 + 50 * i / len(Importer.LOAD_ORDER))
+                    model_rows = getattr(model, attributes[table]) or []
+                    rows = [self._remap(table, row, ids) for row in model_rows]
+                    with Timer() as timer:
+                        if table == 'taxon':
+                            added = self._load_taxa(cursor, rows)
+                        elif table in Importer.NATURAL_KEYS:
+                            added_ids[table] = self._load_referenced(
+                                cursor, table, rows, [row.get('id') for row in model_rows], ids)
+                            added = len(added_ids[table])
+                        else:
+                            for sql, values in self._batches(rows, table):
+                                cursor.executemany(sql, values)
+                            added = len(rows)
+                    report['tables'].append(
+                        {'table': table, 'rows': added, 'existing': len(rows) - added,
+                         'seconds': timer.interval})
+                    report['rows'] += added
+                    logging.info("Loaded %d rows into %s in %.3fs" %
+                                 (added, table, timer.interval))
+                self._journal(cursor, report, added_ids)
+                connection.commit()
+            report['seconds'] = total.interval
+            report['audiogram_experiment_ids'] = ids.get('audiogram_experiment', {})
+            return report
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def _remap(self, table, row, ids):
+        """Copy of a Model row without its generated id, with database ids as foreign keys."""
+        row = {k: v for k, v in row.items() if k != 'id'}
+        for column, referenced in Importer.FOREIGN_KEYS.get(table, {}).items():
+            if column in row:
+                row[column] = ids.get(referenced, {}).get(Importer._key(row[column]))
+        return row
+
+    def _load_taxa(self, cursor, rows):
+        """Adds the taxa missing in the database, and renumbers the tree. Returns the number added."""
+        if not rows:
+            return 0
+        ott_ids = [row['ott_id'] for row in rows]
+        cursor.execute("SELECT ott_id FROM taxon WHERE ott_id IN (%s)" %
+                       ','.join(['%s'] * len(ott_ids)), ott_ids)
+        existing = set(row[0] for row in cursor.fetchall())
+        added = [row for row in rows if row['ott_id'] not in existing]
+        for sql, values in self._batches(added, 'taxon'):
+            cursor.executemany(sql, values)
+        if added:
+            # the indexes of the file only number its own taxa
+            NestedSet.rebuild(cursor)
+        return len(added)
+
+    def _load_referenced(self, cursor, table, rows, model_ids, ids):
+        """
+        Finds or inserts the rows one by one, keeping their database ids in ids[table].
+        Returns the ids of the rows added.
+        """
+        table_ids = ids.setdefault(table, {})
+        added = []
+        for row, model_id in zip(rows, model_ids):
+            db_id = self._find(cursor, table, row)
+            if db_id is None:
+                for sql, values in self._batches([row], table):
+                    cursor.execute(sql, values[0])
+                db_id = cursor.lastrowid
+                added.append(db_id)
+            table_ids[Importer._key(model_id)] = db_id
+        return added
+
+    def _find(self, cursor, table, row):
+        """Returns the id of a row with the same natural key, or None."""
+        for column in Importer.NATURAL_KEYS[table]:
+            value = row.get(column)
+            if value is None or value in ('', 'NA', 'na'):
+                continue
+            cursor.execute("SELECT id FROM %s WHERE %s = %%s LIMIT 1" % (table, column), (value,))
+            found = cursor.fetchone()
+            return found[0] if found else None
+        return None
+
+    def _journal(self, cursor, report, added_ids):
+        """Records the added rows for differential backups."""
+        for table in Importer.NATURAL_KEYS:
+            ChangeJournal.record(cursor, table, 'insert', 'id', added_ids.get(table, []))
+        experiments = added_ids.get('audiogram_experiment', [])
+        for table in Importer.FOREIGN_KEYS:
+            if table != 'audiogram_experiment':
+                ChangeJournal.record(cursor, table, 'insert', 'audiogram_experiment_id', experiments)
+        if any(t['table'] == 'taxon' and t['rows'] for t in report['tables']):
+            ChangeJournal.record(cursor, 'taxon', 'update')
+
+    @staticmethod
+    def _key(value):
+        """Model ids are ints, or floats read from the spreadsheet."""
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return value
+
+    def _batches(self, rows, table):
+        """Yields an INSERT statement and its parameter tuples for each run of rows with the same keys."""
+        excluded = SQLSerializer.EXCLUDED_KEYS.get(table, ())
+        keys = None
+        values = []
+        for row in rows:
+            row_keys = tuple(k for k in row if k not in excluded)
+            if values and row_keys != keys:
+                yield self._insert(table, keys), values
+                values = []
+            keys = row_keys
+            values.append(tuple(None if row[k] in ('NA', 'na') else row[k]
+                                for k in keys))
+        if values:
+            yield self._insert(table, keys), values
+
+    def _insert(self, table, keys):
+        return "INSERT INTO %s (%s) VALUES (%s)" % (
+            table, ','.join(keys), ','.join(['%s'] * len(keys)))
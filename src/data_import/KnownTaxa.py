@@ -0,0 +1,60 @@
+"""
+Store of taxa with curated vernacular names.
+* Vernacular names found here are not looked up in Wikidata
+* Kept in a json file, taxa are added by editing it, without changing code
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import json
+import os
+import threading
+
+
+class KnownTaxa:
+    """A read only dict of latin name: {'ott_id', 'vernacular_name_english', 'vernacular_name_german'}."""
+
+    DEFAULT_PATH = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "known_taxa.json")
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _path = DEFAULT_PATH
+
+    def __init__(self, path=DEFAULT_PATH):
+        """@param path String, json file, an empty store when missing"""
+        self.path = path
+        self._taxa = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._taxa = json.load(f)
+
+    @classmethod
+    def configure(cls, config):
+        """Sets the file of the shared store from the admin configuration, option KNOWN_TAXA_PATH."""
+        with cls._shared_lock:
+            cls._path = config.get(
+                'DEFAULT', 'KNOWN_TAXA_PATH', fallback=cls._path)
+            cls._shared = None
+
+    @classmethod
+    def shared(cls):
+        """The store used by the Wikidata queries."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = KnownTaxa(cls._path)
+            return cls._shared
+
+    def __contains__(self, taxon_name):
+        return taxon_name in self._taxa
+
+    def __getitem__(self, taxon_name):
+        return dict(self._taxa[taxon_name])
+
+    def labels(self, taxon_name):
+        """Returns the vernacular names as {'de', 'en'}, or None for unknown taxa."""
+        taxon = self._taxa.get(taxon_name)
+        if taxon is None:
+            return None
+        return {'de': taxon['vernacular_name_german'],
+                'en': taxon['vernacular_name_english']}
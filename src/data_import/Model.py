@@ -6,9 +6,91 @@ Convert audiogram data from a spreadsheet into SQL
 '''
 
 
+class IndexedList(list):
+    """
+    A list of dicts with a hash index per key, so that rows can be found without scanning.
+
+    A key is a column name, or a tuple of column names for compound keys.
+    Like a linear search, a lookup returns the first row with a matching value.
+    """
+
+    def __init__(self, rows=(), keys=()):
+        super().__init__()
+        self._keys = list(keys)
+        self._indexes = {key: {} for key in self._keys}
+        self.extend(rows)
+
+    def lookup(self, key, value):
+        """Returns the first row where key has value, or None."""
+        return self._indexes[key].get(value)
+
+    def append(self, row):
+        super().append(row)
+        self._add_to_index(row)
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __iadd__(self, rows):
+        self.extend(rows)
+        return self
+
+    # other changes may reorder or remove rows, rebuild the indexes
+
+    def insert(self, i, row):
+        super().insert(i, row)
+        self._reindex()
+
+    def __setitem__(self, i, row):
+        super().__setitem__(i, row)
+        self._reindex()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self._reindex()
+
+    def pop(self, i=-1):
+        row = super().pop(i)
+        self._reindex()
+        return row
+
+    def remove(self, row):
+        super().remove(row)
+        self._reindex()
+
+    def clear(self):
+        super().clear()
+        self._reindex()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        super().reverse()
+        self._reindex()
+
+    def _reindex(self):
+        self._indexes = {key: {} for key in self._keys}
+        for row in self:
+            self._add_to_index(row)
+
+    def _add_to_index(self, row):
+        for key in self._keys:
+            if isinstance(key, tuple):
+                value = tuple(row.get(k) for k in key)
+            else:
+                value = row.get(key)
+            # keep the first row, as a linear search would
+            self._indexes[key].setdefault(value, row)
+
+
 class Model:
 
     def __init__(self):
+        self.taxon = []
+
         # Parse this from the file audiogram_data/audiogrambase_import_methods.csv
         self.methods = [
             {'id': 1,
@@ -59,7 +141,7 @@ class Model:
         ]
 
         # Parse this from the file audiogram_data/audiogrambase_impport_spl.csv
-        self.sound_pressure_level_reference = [
+        sound_pressure_level_reference = [
             {'id': 1, 'spl_reference_value': 1, 'spl_reference_unit': "μPa",
                 'spl_reference_significance': "current SPL reference in water"},
             {'id': 2, 'spl_reference_value': 1, 'spl_reference_unit': "μbar",
@@ -88,9 +170,11 @@ class Model:
         ]
 
         # concatenate label from parts
-        for i, entry in enumerate(self.sound_pressure_level_reference):
-            self.sound_pressure_level_reference[i]['spl_reference_display_label'] = ' '.join(
+        for i, entry in enumerate(sound_pressure_level_reference):
+            sound_pressure_level_reference[i]['spl_reference_display_label'] = ' '.join(
                 ['re', str(entry['spl_reference_value']), entry['spl_reference_unit']])
+        # assign after the labels are complete, the label is an index key
+        self.sound_pressure_level_reference = sound_pressure_level_reference
 
     """
     ===================================================
@@ -123,7 +207,7 @@ class Model:
     @facilities.setter
     def facilities(self, val):
         """val: list of dicts"""
-        self.__facilities = val
+        self.__facilities = Model._indexed(val, ['name'])
 
     @property
     def methods(self):
@@ -133,7 +217,7 @@ class Model:
     @methods.setter
     def methods(self, val):
         """val: list of dicts"""
-        self.__methods = val
+        self.__methods = Model._indexed(val, ['denomination'])
 
     @property
     def audiogram_experiments(self):
@@ -153,7 +237,7 @@ class Model:
     @sound_pressure_level_reference.setter
     def sound_pressure_level_reference(self, val):
         """val: list of dicts"""
-        self.__sound_pressure_level_reference = val
+        self.__sound_pressure_level_reference = Model._indexed(val, ['spl_reference_display_label'])
 
     @property
     def audiogram_data_point(self):
@@ -173,7 +257,7 @@ class Model:
     @taxon.setter
     def taxon(self, val):
         """val: list of dicts"""
-        self.__taxon = val
+        self.__taxon = Model._indexed(val, ['unique_name'])
 
     @property
     def individual_animal(self):
@@ -183,7 +267,7 @@ class Model:
     @individual_animal.setter
     def individual_animal(self, val):
         """val: list of dicts"""
-        self.__individual_animal = val
+        self.__individual_animal = Model._indexed(val, [('individual_name', 'taxon_id')])
 
     @property
     def test_animal(self):
@@ -203,7 +287,7 @@ class Model:
     @publication.setter
     def publication(self, val):
         """val: list of dicts"""
-        self.__publication = val
+        self.__publication = Model._indexed(val, ['doi', 'citation_long', 'citation_short'])
 
     @property
     def audiogram_publication(self):
@@ -215,6 +299,13 @@ class Model:
         """val: list of dicts"""
         self.__audiogram_publication = val
 
+    @staticmethod
+    def _indexed(val, keys):
+        """Wraps a list of dicts into an IndexedList on keys."""
+        if val is None:
+            return None
+        return IndexedList(val, keys)
+
     """
     ===================================================
     Search methods
@@ -223,72 +314,38 @@ class Model:
 
     def get_facility_by_name(self, name):
         """Returns the id of a facility."""
-        resp = None
-        for f in self.facilities:
-            if f['name'] == name:
-                resp = f['id']
-                break
-        return resp
+        return Model._id(self.facilities.lookup('name', name))
 
     def get_method_by_name(self, name):
         """Returns the id of a method."""
-        resp = None
-        for f in self.methods:
-            if f['denomination'] == name:
-                resp = f['id']
-                break
-        return resp
+        return Model._id(self.methods.lookup('denomination', name))
 
     def get_spl_reference_by_name(self, name):
         """Returns the id of a spl reference."""
-        resp = None
-        for f in self.sound_pressure_level_reference:
-            if f['spl_reference_display_label'] == name:
-                resp = f['id']
-                break
-        return resp
+        return Model._id(self.sound_pressure_level_reference.lookup(
+            'spl_reference_display_label', name))
 
     def get_taxon_by_name(self, binomial_name):
         """Returns the OTT id of a taxonomic species."""
-        resp = None
-        for s in self.taxon:
-            if s['unique_name'] == binomial_name:
-                resp = s
-                break
-        return resp
+        return self.taxon.lookup('unique_name', binomial_name)
 
     def get_individual_animal(self, name, taxon_id):
         """Returns the id of an animal."""
-        resp = None
-        for f in self.individual_animal:
-            if f['individual_name'] == name and f['taxon_id'] == taxon_id:
-                resp = f['id']
-                break
-        return resp
+        return Model._id(self.individual_animal.lookup(
+            ('individual_name', 'taxon_id'), (name, taxon_id)))
 
     def get_publication_by_doi(self, doi):
         """Returns the id of a publication by its doi"""
-        resp = None
-        for p in self.publication:
-            if p['doi'] == doi:
-                resp = p['id']
-                break
-        return resp
+        return Model._id(self.publication.lookup('doi', doi))
 
     def get_publication_by_citation(self, ct):
         """Returns the id of a publication by its citation_long"""
-        resp = None
-        for p in self.publication:
-            if p['citation_long'] == ct:
-                resp = p['id']
-                break
-        return resp
+        return Model._id(self.publication.lookup('citation_long', ct))
 
     def get_publication_by_citation_short(self, ct):
         """Returns the id of a publication by its citation_short"""
-        resp = None
-        for p in self.publication:
-            if p['citation_short'] == ct:
-                resp = p['id']
-                break
-        return resp
+        return Model._id(self.publication.lookup('citation_short', ct))
+
+    @staticmethod
+    def _id(row):
+        return None if row is None else row['id']
@@ -0,0 +1,100 @@
+'''
+Created on 18.10.2026
+Compute nested set indexes (lft, rgt) of the taxonomic tree
+@author: Museum fuer Naturkunde Berlin
+
+    Shared by the spreadsheet importer (Parser, Importer) and the admin queries (AdminQuery).
+    Builds an adjacency map once and walks it with an explicit stack,
+    so the cost is linear in the number of taxa and deep lineages can't hit the recursion limit.
+'''
+
+
+class NestedSet:
+
+    @staticmethod
+    def indexes(edges, roots=None):
+        """
+        Computes nested set indexes.
+
+        @param edges iterable of (id, parent id) tuples, siblings are numbered in this order
+        @param roots list of ids to number, default: every node without a known parent
+        @return dict id: (lft, rgt), numbering starts at 1 and continues across roots
+        """
+        edges = list(edges)
+        ids = set(node for node, _ in edges)
+        children = {}
+        found_roots = []
+        for node, parent in edges:
+            if parent is None or parent not in ids or parent == node:
+                found_roots.append(node)
+            else:
+                children.setdefault(parent, []).append(node)
+        if roots is None:
+            roots = found_roots
+
+        indexes = {}
+        lft = {}
+        index = 1
+        for root in roots:
+            if root in lft:
+                continue
+            lft[root] = index
+            index += 1
+            stack = [(root, iter(children.get(root, ())))]
+            while stack:
+                node, remaining = stack[-1]
+                child = next(remaining, None)
+                if child is None:
+                    indexes[node] = (lft[node], index)
+                    index += 1
+                    stack.pop()
+                elif child not in lft:  # ignore cycles
+                    lft[child] = index
+                    index += 1
+                    stack.append((child, iter(children.get(child, ()))))
+        return indexes
+
+    @staticmethod
+    def rebuild(cursor):
+        """Renumbers all taxa using cursor, returns the number of taxa."""
+        cursor.execute(
+            """
+                select
+                   ott_id,
+                   parent
+                from
+                   taxon
+                order by
+                   lft, ott_id
+            """
+        )
+        rows = cursor.fetchall()
+        indexes = NestedSet.indexes(rows)
+        if not indexes:
+            return 0
+
+        lft_cases = []
+        rgt_cases = []
+        params = {}
+        for i, (ott_id, (lft, rgt)) in enumerate(indexes.items()):
+            lft_cases.append('when %%(id%d)s then %%(lft%d)s' % (i, i))
+            rgt_cases.append('when %%(id%d)s then %%(rgt%d)s' % (i, i))
+            params['id%d' % i] = ott_id
+            params['lft%d' % i] = lft
+            params['rgt%d' % i] = rgt
+        cursor.execute(
+            """
+                update
+                   taxon
+                set
+                   lft = case ott_id {} end,
+                   rgt = case ott_id {} end
+                where
+                   ott_id in ({})
+            """.format(
+                ' '.join(lft_cases),
+                ' '.join(rgt_cases),
+                ','.join('%%(id%d)s' % i for i in range(len(indexes)))),
+            params
+        )
+        return len(indexes)
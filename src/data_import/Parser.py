@@ -7,9 +7,8 @@ Convert a data dictionary into Python objects
 import math
 import csv
 from data_import.Model import Model
-from data_import.Tree_of_Life import Obtain_OTT_ID, Obtain_Lineage
-from data_import.Wikidata import Obtain_Wikibase_Item_ID, Obtain_Vernacular_Name
-from data_import.DOI import Obtain_Citation, Obtain_Citation_Short
+from data_import.NestedSet import NestedSet
+from data_import.Resolver import Resolver
 import traceback
 
 
@@ -50,17 +49,28 @@ class Parser:
     publication_names = {
         'Source long': 'citation_long', 'Source short': 'citation_short', 'DOI': 'doi'
     }
+    # Columns used to group rows, indexed once after loading
+    index_columns = [
+        'Audiogram ID', 'Binomial name', 'DOI', 'Source long', 'Name of the facility'
+    ]
 
-    def __init__(self):
+    def __init__(self, resolver=None):
         """
         Initializes an empty Model object that will be filled when calling parse(filename)
+
+        @param resolver Resolver used to get taxonomy and bibliographical data, default: a new Resolver
         """
+        self.resolver = resolver if resolver is not None else Resolver()
         self.data_dict = []
         self.model = Model()
+        # column name: {value: list of rows}
+        self.rows_by_column = {}
 
     def process(self, path):
         """Parses the csv file."""
         self._load(path)
+        self._index()
+        self._resolve()
         self._parse()
         return self.model
 
@@ -77,6 +87,32 @@ class Parser:
             for row in csv_reader:
                 self.data_dict.append(row)
 
+    def _index(self):
+        """Group the rows by each of the index columns, in a single pass over data_dict."""
+        columns = [c for c in Parser.index_columns
+                   if self.data_dict and c in self.data_dict[0]]
+        self.rows_by_column = {c: {} for c in columns}
+        for row in self.data_dict:
+            for c in columns:
+                self.rows_by_column[c].setdefault(row[c], []).append(row)
+
+    def _group_by(self, name):
+        """Returns the rows grouped by column name, indexing the column on first use."""
+        if name not in self.rows_by_column:
+            groups = {}
+            for row in self.data_dict:
+                groups.setdefault(row[name], []).append(row)
+            self.rows_by_column[name] = groups
+        return self.rows_by_column[name]
+
+    def _resolve(self):
+        """
+        Get taxonomy and bibliographical data for all rows at once,
+        the external APIs are called concurrently.
+        """
+        dois = [doi for doi in self.unique_values('DOI') if doi != "NA"]
+        self.resolver.resolve(self.unique_values('Binomial name'), dois)
+
     def _parse(self):
         """
         Convert a data dictionary into Python objects.
@@ -110,8 +146,7 @@ class Parser:
         for i, name in enumerate(binomial_names):
             if not name:
                 continue
-            ott = Obtain_OTT_ID().run(name)
-            lineage = Obtain_Lineage().run(ott)
+            lineage = self.resolver.lineage(name)
             t_phylum = self._add_taxon(lineage, 'phylum')
             t_class = self._add_taxon(lineage, 'class')
             if t_class is None:
@@ -158,7 +193,7 @@ class Parser:
                 taxon['rank'] = rank
                 taxon['ott_id'] = lineage[rank]['ott_id']
                 if rank == "species":
-                    vernacular = Obtain_Vernacular_Name().run(taxon_name)
+                    vernacular = self.resolver.vernacular(taxon_name)
                     taxon['vernacular_name_english'] = vernacular['en']
                     taxon['vernacular_name_german'] = vernacular['de']
                 self.model.taxon.append(taxon)
@@ -175,21 +210,14 @@ class Parser:
             if taxon['rank'] == 'phylum':
                 root = taxon
                 break
-        index = 1
-        root['lft'] = index
-        index = self._nested_set_recurse(index, root)
-        root['rgt'] = index
-
-    def _nested_set_recurse(self, index, parent_node):
-        """Recurse the nodes of the tree, adding left and right indexes."""
-        index += 1
+        if root is None:
+            return
+        edges = [(taxon['ott_id'], taxon.get('parent'))
+                 for taxon in self.model.taxon]
+        indexes = NestedSet.indexes(edges, roots=[root['ott_id']])
         for taxon in self.model.taxon:
-            if 'parent' in taxon and taxon['parent'] == parent_node['ott_id']:
-                taxon['lft'] = index
-                index = self._nested_set_recurse(index, taxon)
-                taxon['rgt'] = index
-                index += 1
-        return index
+            if taxon['ott_id'] in indexes:
+                taxon['lft'], taxon['rgt'] = indexes[taxon['ott_id']]
 
     def parse_individual_animal(self):
         resp = []
@@ -408,8 +436,9 @@ class Parser:
             publication['doi'] = doi.strip()
             try:
                 # try to get publication data from DOI
-                publication['citation_long'] = Obtain_Citation().run(doi)
-                publication['citation_short'] = Obtain_Citation_Short().run(doi)
+                citation_long, citation_short = self.resolver.citations(doi)
+                publication['citation_long'] = citation_long
+                publication['citation_short'] = citation_short
             except Exception:
                 # if DOI is wrong, read data from table
                 print("Could not import bibliographical data for doi %s" % doi)
@@ -480,28 +509,16 @@ class Parser:
 
     def get_rows_by_column_value(self, name, val):
         """Returns a list of rows (dicts) where column name has value val."""
-        resp = []
-        for row in self.data_dict:
-            if row[name] == val:
-                resp.append(row)
-        return resp
+        return list(self._group_by(name).get(val, []))
 
     def get_rows_by_2column_value(self, name1, val1, name2, val2):
         """Returns a list of rows (dicts) where column name has value val."""
-        resp = []
-        for row in self.data_dict:
-            if (row[name1] == val1 and row[name2] == val2):
-                resp.append(row)
-        return resp
+        return [row for row in self._group_by(name1).get(val1, [])
+                if row[name2] == val2]
 
     def unique_values(self, name):
         """Returns a set of unique values for column name in data_dict."""
-        resp = []
-        for row in self.data_dict:
-            if not self.isna(row[name]):
-                resp.append(row[name])
-        resp = set(resp)
-        return resp
+        return set(val for val in self._group_by(name) if not self.isna(val))
 
     def isna(self, val):
         """Checks for NA values"""
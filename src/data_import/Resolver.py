@@ -0,0 +1,197 @@
+'''
+Created on 18.10.2026
+Resolve taxonomy and bibliographical data for a whole spreadsheet before parsing
+@author: Museum fuer Naturkunde Berlin
+
+    Import time is dominated by waiting for the Tree of Life, DOI and Wikidata APIs.
+    The Resolver sends these requests from a thread pool, with a limit
+    on concurrent requests per host, and keeps the results for the Parser.
+
+    The API base URLs are class attributes of Tree_of_Life, DOI and Wikidata,
+    point them to a local stub HTTP server to test without internet, see tests/test_resolver.py.
+
+    Example:
+    resolver = Resolver()
+    resolver.resolve(['Phoca vitulina'], ['10.1121/1.1234'])
+    lineage = resolver.lineage('Phoca vitulina')
+'''
+import contextlib
+import threading
+import urllib.parse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from data_import.Tree_of_Life import Tree_of_Life, Obtain_OTT_ID, Obtain_OTT_IDs, Obtain_Lineage
+from data_import.Wikidata import Wikidata, Obtain_Vernacular_Name, Obtain_Vernacular_Names
+from data_import.DOI import DOI, Obtain_Publication
+
+
+class Resolver:
+
+    def __init__(self, max_workers=8, per_host=4):
+        """
+        @param max_workers int, number of threads sending requests
+        @param per_host int, maximum concurrent requests to the same host
+        """
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._host_limits = {}
+        self._lock = threading.Lock()
+        # binomial name: ott id, from batched name resolution
+        self._ott_ids = {}
+        # name or doi: (value, exception)
+        self._lineages = {}
+        self._vernacular = {}
+        self._citations = {}
+
+    def resolve(self, binomial_names, dois):
+        """Fetches lineages, vernacular names and citations concurrently."""
+        binomial_names = [n for n in set(binomial_names) if n]
+        dois = [d for d in set(dois) if d]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # all names are resolved with a few match_names requests first
+            citations = executor.submit(self._resolve_publications, dois)
+            self._resolve_ott_ids(binomial_names)
+            lineages = [executor.submit(self._resolve_lineage, name)
+                        for name in binomial_names]
+            for future in lineages:
+                future.result()
+            # the Parser asks for vernacular names of species only
+            species_names = set()
+            for name in binomial_names:
+                lineage, error = self._lineages[name]
+                if error is None and lineage.get('species'):
+                    species_names.add(lineage['species']['name'])
+            self._resolve_vernaculars(sorted(species_names))
+            citations.result()
+
+    """
+    ===================================================
+    Results, fetched on demand when not resolved before
+    ===================================================
+    """
+
+    def lineage(self, binomial_name):
+        """Returns the lineage dict of Obtain_Lineage for a binomial name."""
+        if binomial_name not in self._lineages:
+            self._resolve_lineage(binomial_name)
+        return self._result(self._lineages[binomial_name])
+
+    def vernacular(self, species_name):
+        """Returns the vernacular names of Obtain_Vernacular_Name for a species name."""
+        if species_name not in self._vernacular:
+            self._resolve_vernacular(species_name)
+        return self._result(self._vernacular[species_name])
+
+    def citations(self, doi):
+        """Returns (citation_long, citation_short) for a DOI."""
+        if doi not in self._citations:
+            self._resolve_citations(doi)
+        return self._result(self._citations[doi])
+
+    """
+    ===================================================
+    Private methods
+    ===================================================
+    """
+
+    def _resolve_ott_ids(self, binomial_names):
+        with self._limit(Tree_of_Life.BASE_URL):
+            ott_ids = Obtain_OTT_IDs().run(binomial_names)
+        with self._lock:
+            self._ott_ids.update(ott_ids)
+
+    def _resolve_lineage(self, binomial_name):
+        def fetch():
+            ott = self._ott_ids.get(binomial_name)
+            if ott is None:
+                with self._limit(Tree_of_Life.BASE_URL):
+                    ott = Obtain_OTT_ID().run(binomial_name)
+            with self._limit(Tree_of_Life.BASE_URL):
+                return Obtain_Lineage().run(ott)
+        self._store(self._lineages, binomial_name, fetch)
+
+    def _resolve_vernacular(self, species_name):
+        if species_name in self._vernacular:
+            return
+
+        def fetch():
+            with self._limits(Wikidata.WIKIPEDIA_BASE_URL, Wikidata.WIKIDATA_BASE_URL):
+                return Obtain_Vernacular_Name().run(species_name)
+        self._store(self._vernacular, species_name, fetch)
+
+    def _resolve_vernaculars(self, species_names):
+        names = [n for n in species_names if n not in self._vernacular]
+        if not names:
+            return
+        try:
+            with self._limits(Wikidata.WIKIPEDIA_BASE_URL, Wikidata.WIKIDATA_BASE_URL):
+                labels = Obtain_Vernacular_Names().run(names)
+        except Exception as e:
+            logging.warning("Could not resolve vernacular names: %s" % e)
+            return
+        with self._lock:
+            for name in names:
+                self._vernacular[name] = (labels.get(name, 'NA'), None)
+
+    def _resolve_citations(self, doi):
+        def fetch():
+            with self._limit(DOI.BASE_URL):
+                publication = Obtain_Publication().run(doi)
+            return publication['citation_long'], publication['citation_short']
+        self._store(self._citations, doi, fetch)
+
+    def _resolve_publications(self, dois):
+        """Fetches the citations of all DOIs with one list call, per_host requests at a time."""
+        if not dois:
+            return
+        try:
+            publications = Obtain_Publication(self.per_host).run(dois)
+        except Exception as e:
+            logging.warning("Could not resolve citations: %s" % e)
+            return
+        with self._lock:
+            for doi in dois:
+                publication = publications.get(doi)
+                if publication is None:
+                    self._citations[doi] = (
+                        None, Exception("Could not get citation for %s" % doi))
+                else:
+                    self._citations[doi] = (
+                        (publication['citation_long'], publication['citation_short']), None)
+
+    def _store(self, results, key, fetch):
+        """Calls fetch, keeps its value or its exception under key."""
+        try:
+            entry = (fetch(), None)
+        except Exception as e:
+            logging.warning("Could not resolve %s: %s" % (key, e))
+            entry = (None, e)
+        with self._lock:
+            results[key] = entry
+
+    def _result(self, entry):
+        value, error = entry
+        if error is not None:
+            raise error
+        return value
+
+    @contextlib.contextmanager
+    def _limits(self, *urls):
+        """
+        Holds the semaphores of all hosts of urls, for queries calling several APIs.
+        Acquired in order of host name, so that two such queries can't deadlock.
+        """
+        hosts = sorted(set(urllib.parse.urlparse(url).netloc for url in urls))
+        with contextlib.ExitStack() as stack:
+            for host in hosts:
+                stack.enter_context(self._limit("//%s" % host))
+            yield
+
+    def _limit(self, url):
+        """Semaphore limiting concurrent requests to the host of url."""
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return self._host_limits[host]
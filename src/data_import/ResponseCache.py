@@ -0,0 +1,162 @@
+"""
+Persistent cache for Tree of Life, DOI and Wikidata responses.
+* Keeps response bodies in a SQLite file, so they survive restarts
+* Time to live per source, lineages and citations hardly ever change
+* Evicts the least recently used responses when full
+* Offline mode answers from the cache only, to re-import or test without internet
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class ResponseCacheMiss(Exception):
+    """Raised in offline mode when a response is not cached."""
+    pass
+
+
+class ResponseCache:
+    """A thread safe, size bounded response store keyed by source, url and request body."""
+
+    DAY = 24 * 3600
+    TTL = {'tree_of_life': 90 * DAY, 'doi': 365 * DAY, 'wikidata': 30 * DAY}
+    """Time to live in seconds per source."""
+    DEFAULT_TTL = 30 * DAY
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    _settings = {'path': "/tmp/aad_response_cache.sqlite",
+                 'max_entries': 50000,
+                 'offline': False}
+
+    def __init__(self, path, max_entries=50000, offline=False, ttl=None):
+        """
+        @param path String, SQLite file, ':memory:' for a throwaway cache
+        @param max_entries int, responses kept before evicting the least recently used
+        @param offline bool, never call the APIs, raise ResponseCacheMiss instead
+        @param ttl dict source: seconds, overrides TTL
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.offline = offline
+        self.ttl = dict(ResponseCache.TTL, **(ttl or {}))
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS response ("
+            "key TEXT PRIMARY KEY, source TEXT, url TEXT, body TEXT, "
+            "stored REAL, used REAL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS response_used ON response (used)")
+        self._db.commit()
+
+    @classmethod
+    def configure(cls, config):
+        """
+        Sets up the shared cache from the admin configuration.
+        Options: RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_OFFLINE
+        """
+        with cls._shared_lock:
+            cls._settings = {
+                'path': config.get('DEFAULT', 'RESPONSE_CACHE_PATH',
+                                   fallback=cls._settings['path']),
+                'max_entries': config.getint('DEFAULT', 'RESPONSE_CACHE_MAX_ENTRIES',
+                                             fallback=cls._settings['max_entries']),
+                'offline': config.getboolean('DEFAULT', 'RESPONSE_CACHE_OFFLINE',
+                                             fallback=cls._settings['offline'])}
+            cls._shared = None
+
+    @classmethod
+    def shared(cls):
+        """The cache used by the send_request methods of the API base classes."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = ResponseCache(**cls._settings)
+            return cls._shared
+
+    def fetch(self, source, url, body, request, cacheable=None):
+        """
+        Returns the cached response for (source, url, body),
+        or calls request and caches its response when the status is 200.
+
+        @param request callable returning a requests.Response
+        @param cacheable callable(String response text) returning False for error payloads,
+            which are answered with status 200 but must not be kept for the time to live
+        @return (int status code, String response text)
+        """
+        key = self._key(source, url, body)
+        text = self.get(source, key)
+        if text is not None:
+            return 200, text
+        if self.offline:
+            raise ResponseCacheMiss("Offline, no cached response for %s" % url)
+        response = request()
+        if response.status_code == 200 and (cacheable is None or cacheable(response.text)):
+            self.put(source, key, url, response.text)
+        return response.status_code, response.text
+
+    def get(self, source, key):
+        """Returns the cached response text, or None when missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, stored FROM response WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            # expired responses are still served offline
+            if not self.offline and row[1] + self.ttl.get(source, ResponseCache.DEFAULT_TTL) < now:
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._db.execute(
+                "UPDATE response SET used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._stats['hits'] += 1
+            return row[0]
+
+    def put(self, source, key, url, text):
+        """Stores a response, evicting the least recently used ones when full."""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "REPLACE INTO response (key, source, url, body, stored, used) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, source, url, text, now, now))
+            excess = self._count() - self.max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM response WHERE key IN "
+                    "(SELECT key FROM response ORDER BY used LIMIT ?)", (excess,))
+                self._stats['evictions'] += excess
+            self._db.commit()
+
+    def clear(self, source=None):
+        """Drops all responses, or those of one source."""
+        with self._lock:
+            if source is None:
+                self._db.execute("DELETE FROM response")
+            else:
+                self._db.execute(
+                    "DELETE FROM response WHERE source = ?", (source,))
+            self._db.commit()
+
+    def stats(self):
+        """Returns a copy of the counters, with the current number of entries."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._count()
+        stats['max_entries'] = self.max_entries
+        stats['offline'] = self.offline
+        return stats
+
+    def _count(self):
+        return self._db.execute("SELECT COUNT(*) FROM response").fetchone()[0]
+
+    def _key(self, source, url, body):
+        return hashlib.sha1(
+            ("%s\n%s\n%s" % (source, url, body or '')).encode('utf-8')).hexdigest()
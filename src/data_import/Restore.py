@@ -0,0 +1,570 @@
+'''
+Created on 18.10.2026
+Restore a mysqldump file, loading the tables in parallel
+@author: Museum fuer Naturkunde Berlin
+
+    The dump is split per table in a single pass, keeping only the CREATE TABLE statements
+    and the file offsets of the INSERT statements in memory.
+    Tables are created without secondary keys and foreign key constraints,
+    loaded by worker connections with foreign key and unique checks disabled,
+    and the keys and constraints are added when all tables are loaded.
+
+    The tables are loaded into shadow tables (_restore_<table>) next to the live tables,
+    and checked against the manifest of the dump and the rows it contains.
+    Only then are all tables swapped with one RENAME TABLE statement,
+    so readers never see empty or partly loaded tables, and a bad backup leaves the live tables untouched.
+
+    Dumps compressed by Backup.stream (.gz, .zst) are decompressed next to the file first,
+    the load reads the tables at their offsets in the plain dump.
+
+    Differential dumps (see Backup.diff) are applied on top of a restored dump,
+    ordered by their journal positions, each in one transaction.
+
+    The swap and each applied diff record their tables as changed in the change journal,
+    so a differential backup from a position before the restore exports these tables in full.
+
+    Example:
+    report = Restore(config, workers=4).run('/tmp/backup.sql')
+    report = Restore(config).run('/tmp/backup.sql', ['/tmp/diff_1.sql', '/tmp/diff_2.sql'])
+'''
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import pymysql
+from data_import.ChangeJournal import ChangeJournal
+from data_import.Timer import Timer
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class RestoreError(Exception):
+    """The dump was rejected, the live tables were not changed."""
+    pass
+
+
+def statements(lines):
+    """
+    Groups the lines of a dump into statements.
+
+    @param lines iterable of bytes, lines of a dump file
+    @return generator of (int offset, bytes), a statement, or a single comment or blank line
+    """
+    offset = 0
+    start = None
+    buffer = []
+    for line in lines:
+        if start is None and (not line.strip() or line.startswith(b'--') or line.startswith(b'/*')):
+            yield offset, line
+            offset += len(line)
+            continue
+        if start is None:
+            start = offset
+        offset += len(line)
+        buffer.append(line)
+        if line.rstrip().endswith(b';'):
+            yield start, b''.join(buffer)
+            start = None
+            buffer = []
+    if buffer:
+        yield start, b''.join(buffer)
+
+
+def decompress(path):
+    """
+    Decompresses a .gz or .zst dump next to path.
+
+    @return String, path of the plain dump, path itself when it is not compressed
+    @raise RestoreError when zstandard is missing for a .zst file
+    """
+    if path.endswith('.gz'):
+        plain = path[:-len('.gz')]
+        with gzip.open(path, 'rb') as source, open(plain, 'wb') as target:
+            shutil.copyfileobj(source, target)
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise RestoreError("%s needs the zstandard package" % path)
+        plain = path[:-len('.zst')]
+        with open(path, 'rb') as source, open(plain, 'wb') as target:
+            zstandard.ZstdDecompressor().copy_stream(source, target)
+    else:
+        return path
+    return plain
+
+
+class DumpManifest:
+    """
+    Number of rows and sha1 of the INSERT statements of each table in a dump.
+    Appended to backups as comments, checked on restore.
+    """
+
+    PREFIX = b'-- aad-manifest '
+    POSITION = b'-- aad-position '
+    INSERT = re.compile(rb"^(?:INSERT|REPLACE)\s+INTO\s+`?(\w+)`?", re.IGNORECASE)
+    VALUES = re.compile(rb"\bVALUES\b", re.IGNORECASE)
+    TOKENS = re.compile(rb"'(?:[^'\\]|\\.)*'|[()]", re.DOTALL)
+
+    def __init__(self):
+        self.tables = {}  # table: (rows, sha1) of the statements added
+        self.expected = {}  # table: (rows, sha1 hex digest) read from manifest comments
+        self.position = None  # change journal position of the dump, see Backup.stream()
+
+    def add(self, statement):
+        """
+        Adds a statement from statements(): counts the rows of INSERT statements,
+        reads manifest comments. Returns the table name of an INSERT statement, else None.
+        """
+        if statement.startswith(DumpManifest.POSITION):
+            self.position = int(statement[len(DumpManifest.POSITION):])
+            return None
+        if statement.startswith(DumpManifest.PREFIX):
+            table, rows, digest = statement[len(DumpManifest.PREFIX):].decode().split()
+            self.expected[table] = (int(rows), digest)
+            return None
+        insert = DumpManifest.INSERT.match(statement)
+        if insert is None:
+            return None
+        table = insert.group(1).decode()
+        if table not in self.tables:
+            self.tables[table] = (0, hashlib.sha1())
+        rows, digest = self.tables[table]
+        digest.update(statement)
+        self.tables[table] = (rows + DumpManifest.count_rows(statement), digest)
+        return table
+
+    def rows(self, table):
+        return self.tables.get(table, (0, None))[0]
+
+    def digest(self, table):
+        return self.tables[table][1].hexdigest() if table in self.tables else hashlib.sha1().hexdigest()
+
+    def comments(self, tables):
+        """Manifest comments for tables, to append to the dump."""
+        return b''.join(b'%s%s %d %s\n' % (
+            DumpManifest.PREFIX, table.encode(), self.rows(table), self.digest(table).encode())
+            for table in tables)
+
+    def check(self, tables):
+        """
+        Compares the statements added with the manifest comments, when the dump has them.
+
+        @raise RestoreError listing the tables that differ
+        """
+        if not self.expected:
+            logging.warning("The dump has no manifest")
+            return
+        differ = [table for table in sorted(set(tables) | set(self.expected))
+                  if self.expected.get(table) != (self.rows(table), self.digest(table))]
+        if differ:
+            raise RestoreError(
+                "The dump is incomplete or changed, check tables %s" % ', '.join(differ))
+
+    @staticmethod
+    def count_rows(statement):
+        """Number of value tuples in an INSERT statement, skipping quoted strings."""
+        values = DumpManifest.VALUES.search(statement)
+        if values is None:
+            return 0
+        rows = 0
+        depth = 0
+        for token in DumpManifest.TOKENS.finditer(statement, values.end()):
+            token = token.group()
+            if token == b'(':
+                if depth == 0:
+                    rows += 1
+                depth += 1
+            elif token == b')':
+                depth -= 1
+        return rows
+
+
+class DumpDiff:
+    """
+    Header and footer of a differential dump.
+    The footer is only written when the whole diff was exported.
+    """
+
+    HEADER = b'-- aad-diff '
+    FOOTER = b'-- aad-diff-end '
+
+    def __init__(self, path):
+        """
+        Reads the journal positions of a differential dump.
+
+        @param path String, differential dump file
+        @raise RestoreError when the file is not a differential dump or is incomplete
+        """
+        self.path = path
+        self.since = None
+        self.position = None
+        end = None
+        with open(path, 'rb') as dump:
+            for _, statement in statements(dump):
+                if statement.startswith(DumpDiff.HEADER):
+                    self.since, self.position = (
+                        int(value) for value in statement[len(DumpDiff.HEADER):].split())
+                elif statement.startswith(DumpDiff.FOOTER):
+                    end = int(statement[len(DumpDiff.FOOTER):])
+        if self.since is None:
+            raise RestoreError("%s is not a differential backup" % path)
+        if end != self.position:
+            raise RestoreError("%s is incomplete" % path)
+
+    @staticmethod
+    def header(since, position):
+        return b'%s%d %d\n' % (DumpDiff.HEADER, since, position)
+
+    @staticmethod
+    def footer(position):
+        return b'%s%d\n' % (DumpDiff.FOOTER, position)
+
+
+class DumpTable:
+    """The statements of one table in a dump file."""
+
+    SHADOW_PREFIX = '_restore_'
+    OLD_PREFIX = '_old_'
+
+    def __init__(self, name):
+        self.name = name
+        self.shadow = DumpTable.SHADOW_PREFIX + name
+        self.columns = []  # column and primary key definitions
+        self.keys = []  # secondary key definitions, added after the load
+        self.constraints = []  # foreign key constraints, added after the swap
+        self.options = ''  # table options, e.g. ENGINE=InnoDB
+        self.inserts = []  # (offset, length) of INSERT statements in the file
+        self.bytes = 0
+
+    def create_sql(self, name):
+        """CREATE TABLE statement without secondary keys and constraints."""
+        return "CREATE TABLE `%s` (\n%s\n)%s" % (
+            name, ",\n".join(self.columns), self.options)
+
+    def alter_sql(self, definitions, name):
+        """ALTER TABLE statement adding definitions, None when there are none."""
+        if not definitions:
+            return None
+        return "ALTER TABLE `%s` %s" % (
+            name, ", ".join("ADD %s" % d for d in definitions))
+
+
+class Restore:
+
+    TABLES = ['audiogram_data_point', 'audiogram_experiment', 'audiogram_publication',
+              'facility', 'individual_animal', 'publication', 'taxon', 'test_animal',
+              'sound_pressure_level_reference', 'method']
+    """Tables a backup must contain."""
+
+    CREATE = re.compile(r"^CREATE TABLE `?(\w+)`?", re.IGNORECASE)
+    INSERT = re.compile(r"^((?:INSERT|REPLACE)\s+INTO\s+)`?(\w+)`?", re.IGNORECASE)
+    DELETE = re.compile(r"^DELETE\s+FROM\s+`?(\w+)`?", re.IGNORECASE)
+    SECONDARY_KEY = re.compile(r"^(UNIQUE |FULLTEXT |SPATIAL )?KEY ", re.IGNORECASE)
+    CONSTRAINT = re.compile(r"^CONSTRAINT ", re.IGNORECASE)
+    DEFINITION_TOKENS = re.compile(
+        r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|[(),]", re.DOTALL)
+    """Quoted strings and identifiers, skipped, and the parentheses and commas of a CREATE TABLE statement."""
+
+    def __init__(self, config, workers=4):
+        """
+        @param config ConfigParser with the database credentials
+        @param workers int, tables loaded at the same time
+        """
+        self.host = config.get('DEFAULT', 'DB_HOST')
+        self.password = config.get('DEFAULT', 'DB_PASSWORD')
+        self.username = config.get('DEFAULT', 'DB_USERNAME')
+        self.database = config.get('DEFAULT', 'DB_DATABASE')
+        self.workers = workers
+
+    def run(self, path, diffs=(), progress=None):
+        """
+        Restores the tables of a dump file, replacing the live tables of the same name,
+        then applies the differential dumps made since.
+
+        @param path String, mysqldump file, may be compressed, see decompress()
+        @param diffs list of String, differential dump files, in any order, may be compressed
+        @param progress callable(String stage, float percent), called between steps, e.g. Job.progress
+        @return dict{'tables': [{'table', 'rows', 'bytes', 'seconds', 'rows_per_second', 'bytes_per_second'}],
+            'split_seconds', 'load_seconds', 'index_seconds', 'swap_seconds', 'diff_seconds', 'seconds',
+            'position': journal position of the restored data}
+        @raise RestoreError when the dump or a diff is rejected before the live tables were changed
+        """
+        plain = []
+        try:
+            for dump in [path] + list(diffs):
+                plain.append(decompress(dump))
+            return self._run(plain[0], plain[1:], progress)
+        finally:
+            for dump, original in zip(plain, [path] + list(diffs)):
+                if dump != original:
+                    os.remove(dump)
+
+    def _run(self, path, diffs, progress):
+        progress = progress or (lambda stage, percent: None)
+        report = {}
+        with Timer() as total:
+            with Timer() as timer:
+                progress('split', 0)
+                tables, manifest = self.split(path)
+                names = [table.name for table in tables]
+                missing = [name for name in Restore.TABLES if name not in names]
+                if missing:
+                    raise RestoreError("The dump has no tables %s" %
+                                       ', '.join(missing))
+                manifest.check(names)
+                chain = self.chain(manifest.position, diffs)
+            report['split_seconds'] = timer.interval
+
+            self._drop(DumpTable.SHADOW_PREFIX + name for name in names)
+            try:
+                loaded = []
+
+                def load(table):
+                    result = self._load_table(path, table)
+                    loaded.append(table)
+                    progress('load', 10 + 60 * len(loaded) / len(tables))
+                    return result
+
+                with Timer() as timer:
+                    progress('load', 10)
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        report['tables'] = list(executor.map(load, tables))
+                report['load_seconds'] = timer.interval
+
+                with Timer() as timer:
+                    progress('index', 70)
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        list(executor.map(self._execute, [
+                            table.alter_sql(table.keys, table.shadow) for table in tables]))
+                report['index_seconds'] = timer.interval
+
+                progress('check', 85)
+                self._check_rows(tables, manifest)
+            except Exception:
+                self._drop(table.shadow for table in tables)
+                raise
+
+            with Timer() as timer:
+                progress('swap', 90)
+                self._swap(tables)
+                for table in tables:
+                    self._execute(table.alter_sql(
+                        table.constraints, table.name))
+            report['swap_seconds'] = timer.interval
+
+            with Timer() as timer:
+                for i, diff in enumerate(chain):
+                    progress('diff', 95 + 5 * i / len(chain))
+                    self.apply(diff)
+            report['diff_seconds'] = timer.interval
+        report['seconds'] = total.interval
+        report['position'] = chain[-1].position if chain else manifest.position
+        return report
+
+    def chain(self, position, paths):
+        """
+        Reads the differential dumps, orders them by position
+        and checks that each one starts where the previous one ended, the first one at the position of the dump.
+
+        @return list of DumpDiff
+        @raise RestoreError when a diff is incomplete or does not follow on
+        """
+        chain = sorted((DumpDiff(path) for path in paths), key=lambda diff: diff.since)
+        if chain and position is None:
+            raise RestoreError("The dump has no journal position, differential backups can't be applied")
+        for diff in chain:
+            if diff.since != position:
+                raise RestoreError("%s starts at position %d, expected %d" % (
+                    diff.path, diff.since, position))
+            position = diff.position
+        return chain
+
+    def apply(self, diff):
+        """Applies a differential dump in one transaction, recording the tables it changed in the journal."""
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor, open(diff.path, 'rb') as dump:
+                ChangeJournal.create(cursor)
+                tables = []
+                for _, statement in statements(dump):
+                    if statement.startswith(b'--') or not statement.strip():
+                        continue
+                    sql = statement.decode('utf-8').rstrip().rstrip(';')
+                    changed = Restore.INSERT.match(sql) or Restore.DELETE.match(sql)
+                    if changed is not None and changed.groups()[-1] not in tables:
+                        tables.append(changed.groups()[-1])
+                    cursor.execute(sql)
+                for table in tables:
+                    ChangeJournal.record(cursor, table, 'update')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        logging.info("Applied %s, journal position %d" % (diff.path, diff.position))
+
+    def split(self, path):
+        """
+        Reads the dump file once, returns a DumpTable per table, in file order, and the DumpManifest of the file.
+        Statements other than CREATE TABLE and INSERT are skipped,
+        the workers set up their sessions themselves.
+        The change journal of a plain mysqldump is skipped too, its positions belong to the live database.
+        """
+        tables = {}
+        manifest = DumpManifest()
+        with open(path, 'rb') as dump:
+            for offset, statement in statements(dump):
+                name = manifest.add(statement)
+                if name == ChangeJournal.TABLE:
+                    continue
+                if name is not None:
+                    table = tables.setdefault(name, DumpTable(name))
+                    table.inserts.append((offset, len(statement)))
+                    table.bytes += len(statement)
+                    continue
+                create = Restore.CREATE.match(
+                    statement.decode('utf-8', 'replace'))
+                if create and create.group(1) != ChangeJournal.TABLE:
+                    table = tables.setdefault(
+                        create.group(1), DumpTable(create.group(1)))
+                    self._parse_create(table, statement.decode('utf-8'))
+        return list(tables.values()), manifest
+
+    def _parse_create(self, table, sql):
+        """
+        Splits a CREATE TABLE statement into the columns, keys and constraints of table, and its options.
+        The definition list ends at the parenthesis closing the first one,
+        parentheses and commas in quoted comments, defaults and names are skipped.
+        """
+        definitions = []
+        depth = 0
+        start = end = None
+        for token in Restore.DEFINITION_TOKENS.finditer(sql):
+            if token.group() == '(':
+                depth += 1
+                if depth == 1:
+                    start = token.end()
+            elif token.group() == ')':
+                depth -= 1
+                if depth == 0:
+                    end = token.start()
+                    break
+            elif token.group() == ',' and depth == 1:
+                definitions.append(sql[start:token.start()])
+                start = token.end()
+        if end is None:
+            raise RestoreError("Can't parse the definition of %s" % table.name)
+        definitions.append(sql[start:end])
+        table.options = sql[end + 1:].rstrip().rstrip(';')
+        for definition in definitions:
+            definition = definition.strip()
+            if not definition:
+                continue
+            if Restore.SECONDARY_KEY.match(definition):
+                table.keys.append(definition)
+            elif Restore.CONSTRAINT.match(definition):
+                table.constraints.append(definition)
+            else:
+                table.columns.append(definition)
+
+    def _load_table(self, path, table):
+        """Creates and loads the shadow table of one table in its own connection, returns its throughput."""
+        rows = 0
+        connection = self._connect()
+        try:
+            with Timer() as timer, connection.cursor() as cursor, open(path, 'rb') as dump:
+                cursor.execute(table.create_sql(table.shadow))
+                for offset, length in table.inserts:
+                    dump.seek(offset)
+                    sql = dump.read(length).decode('utf-8').rstrip().rstrip(';')
+                    sql = Restore.INSERT.sub(
+                        lambda m: "%s`%s`" % (m.group(1), table.shadow), sql, count=1)
+                    rows += cursor.execute(sql)
+                connection.commit()
+        finally:
+            connection.close()
+        logging.info("Restored %d rows into %s in %.3fs" %
+                     (rows, table.shadow, timer.interval))
+        seconds = timer.interval or 1e-9
+        return {'table': table.name, 'rows': rows, 'bytes': table.bytes,
+                'seconds': timer.interval,
+                'rows_per_second': rows / seconds,
+                'bytes_per_second': table.bytes / seconds}
+
+    def _check_rows(self, tables, manifest):
+        """Compares the rows in the shadow tables with the rows in the dump."""
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor:
+                for table in tables:
+                    cursor.execute("SELECT COUNT(*) FROM `%s`" % table.shadow)
+                    rows = cursor.fetchone()[0]
+                    if rows != manifest.rows(table.name):
+                        raise RestoreError("%s has %d rows, the dump has %d" % (
+                            table.name, rows, manifest.rows(table.name)))
+        finally:
+            connection.close()
+
+    def _swap(self, tables):
+        """
+        Replaces the live tables by the shadow tables in one atomic RENAME TABLE, then drops the old tables.
+        Foreign key constraint names are unique in the database,
+        so the constraints are only added once the old tables are gone.
+        Right after the rename, every swapped table is recorded as changed in the journal,
+        the rename commits on its own and can't share a transaction with it.
+        """
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor:
+                ChangeJournal.create(cursor)
+                cursor.execute(
+                    "SELECT table_name FROM information_schema.tables WHERE table_schema=%s",
+                    (self.database,))
+                live = set(row[0] for row in cursor.fetchall())
+                self._drop(DumpTable.OLD_PREFIX + table.name for table in tables)
+                renames = []
+                for table in tables:
+                    if table.name in live:
+                        renames.append("`%s` TO `%s%s`" % (
+                            table.name, DumpTable.OLD_PREFIX, table.name))
+                    renames.append("`%s` TO `%s`" % (table.shadow, table.name))
+                cursor.execute("RENAME TABLE %s" % ", ".join(renames))
+                for table in tables:
+                    ChangeJournal.record(cursor, table.name, 'update')
+            connection.commit()
+        finally:
+            connection.close()
+        self._drop(DumpTable.OLD_PREFIX + table.name for table in tables)
+
+    def _drop(self, names):
+        names = list(names)
+        if names:
+            self._execute("DROP TABLE IF EXISTS %s" %
+                          ", ".join("`%s`" % name for name in names))
+
+    def _execute(self, sql):
+        if sql is None:
+            return
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        """A connection with the session settings of a mysqldump replay, checks disabled."""
+        connection = pymysql.connect(
+            self.host, self.username, self.password, self.database, charset='utf8mb4')
+        with connection.cursor() as cursor:
+            cursor.execute("SET foreign_key_checks=0")
+            cursor.execute("SET unique_checks=0")
+            cursor.execute("SET sql_mode='NO_AUTO_VALUE_ON_ZERO'")
+            cursor.execute("SET autocommit=0")
+        return connection
@@ -8,57 +8,106 @@ Convert audiogram data from a spreadsheet into SQL
 class SQLSerializer:
     sql_str = None
 
-    def __init__(self):
+    TABLES = [
+        ('facilities', "facility"),
+        ('methods', "method"),
+        ('audiogram_experiments', "audiogram_experiment"),
+        ('audiogram_data_point', "audiogram_data_point"),
+        ('taxon', "taxon"),
+        ('individual_animal', "individual_animal"),
+        ('test_animal', "test_animal"),
+        ('publication', "publication"),
+        ('audiogram_publication', "audiogram_publication"),
+        ('sound_pressure_level_reference', "sound_pressure_level_reference")]
+    """Model attributes and the tables they are written to, in order."""
+
+    EXCLUDED_KEYS = {
+        "sound_pressure_level_reference": ('spl_reference_display_label',)}
+    """Model keys that are not database columns, per table."""
+
+    def __init__(self, batch_size=500, transactions=False):
+        """
+        @param batch_size int, rows per INSERT statement written by write() and statements()
+        @param transactions bool, wrap the rows of each table in SET autocommit=0 / COMMIT
+        """
         self.sql_str = ''
+        self.batch_size = batch_size
+        self.transactions = transactions
 
     def process(self, model):
-        if model.facilities:
-            self.sql_str += self.insert_sql(model.facilities, "facility")
-        if model.methods:
-            self.sql_str += self.insert_sql(model.methods, "method")
-        if model.audiogram_experiments:
-            self.sql_str += self.insert_sql(
-                model.audiogram_experiments, "audiogram_experiment")
-        if model.audiogram_data_point:
-            self.sql_str += self.insert_sql(model.audiogram_data_point,
-                                            "audiogram_data_point")
-        if model.taxon:
-            self.sql_str += self.insert_sql(model.taxon, "taxon")
-        if model.individual_animal:
-            self.sql_str += self.insert_sql(model.individual_animal,
-                                            "individual_animal")
-        if model.test_animal:
-            self.sql_str += self.insert_sql(model.test_animal, "test_animal")
-        if model.publication:
-            self.sql_str += self.insert_sql(model.publication, "publication")
-        if model.audiogram_publication:
-            self.sql_str += self.insert_sql(model.audiogram_publication,
-                                            "audiogram_publication")
-        if model.sound_pressure_level_reference:
-            for i, entry in enumerate(model.sound_pressure_level_reference):
-                del model.sound_pressure_level_reference[i]['spl_reference_display_label']
-            self.sql_str += self.insert_sql(
-                model.sound_pressure_level_reference, "sound_pressure_level_reference")
-
+        """Returns one INSERT statement per row, as a string."""
+        for attribute, table_name in SQLSerializer.TABLES:
+            value_set = getattr(model, attribute)
+            if value_set:
+                self.sql_str += self.insert_sql(value_set, table_name)
         return self.sql_str
 
     def insert_sql(self, value_set, table_name):
         """Write a set of values into a SQL statement"""
         resp = ''
         for i, entry in enumerate(value_set):
-            keys = []
-            vals = []
-            for k, v in entry.items():
-                if v == 'NA' or v == 'na':
-                    vals.append('NULL')
-                elif str(v).isdigit():
-                    vals.append(str(v))
-                else:
-                    v = str(v).replace("'", "''")  # escape apostrophes in SQL
-                    vals.append("'" + v + "'")
-                keys.append(k)
+            keys, vals = self._columns(entry, table_name)
             key_str = ','.join(keys)
             val_str = ','.join(vals)
             resp += "INSERT INTO %s (%s) VALUES (%s);\n" % (table_name,
                                                             key_str, val_str)
         return resp
+
+    def statements(self, model):
+        """
+        Generates multi-row INSERT statements, batch_size rows each.
+        Consecutive rows with the same keys share a statement.
+        """
+        for attribute, table_name in SQLSerializer.TABLES:
+            value_set = getattr(model, attribute)
+            if not value_set:
+                continue
+            if self.transactions:
+                yield "SET autocommit=0;\n"
+            key_str = None
+            rows = []
+            for entry in value_set:
+                keys, vals = self._columns(entry, table_name)
+                if rows and (','.join(keys) != key_str or len(rows) == self.batch_size):
+                    yield self._multi_row(table_name, key_str, rows)
+                    rows = []
+                key_str = ','.join(keys)
+                rows.append("(%s)" % ','.join(vals))
+            if rows:
+                yield self._multi_row(table_name, key_str, rows)
+            if self.transactions:
+                yield "COMMIT;\n"
+
+    def write(self, model, sink):
+        """
+        Writes the statements() to a file-like sink.
+
+        @return int, number of statements written
+        """
+        count = 0
+        for statement in self.statements(model):
+            sink.write(statement)
+            count += 1
+        return count
+
+    def _multi_row(self, table_name, key_str, rows):
+        return "INSERT INTO %s (%s) VALUES\n%s;\n" % (
+            table_name, key_str, ',\n'.join(rows))
+
+    def _columns(self, entry, table_name):
+        """Returns the column names and SQL values of a row."""
+        excluded = SQLSerializer.EXCLUDED_KEYS.get(table_name, ())
+        keys = []
+        vals = []
+        for k, v in entry.items():
+            if k in excluded:
+                continue
+            if v == 'NA' or v == 'na':
+                vals.append('NULL')
+            elif str(v).isdigit():
+                vals.append(str(v))
+            else:
+                v = str(v).replace("'", "''")  # escape apostrophes in SQL
+                vals.append("'" + v + "'")
+            keys.append(k)
+        return keys, vals
@@ -13,9 +13,9 @@ class Timer:
         self.interval = None
 
     def __enter__(self):
-        self.start = time.process_time()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, *args):
-        self.end = time.process_time()
+        self.end = time.perf_counter()
         self.interval = self.end - self.start
@@ -12,11 +12,11 @@ Created on 06.02.2020
 
 import abc
 import urllib.parse
-import requests
 import json
-import objectpath
 import traceback
 import logging
+from data_import.ResponseCache import ResponseCache
+from data_import.HttpClient import HttpClient
 
 
 class Tree_of_Life(abc.ABC):
@@ -34,8 +34,28 @@ class Tree_of_Life(abc.ABC):
 
     def send_request(self, url, data):
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(url, data=json.dumps(data), headers=headers)
-        return response.json()
+        body = json.dumps(data, sort_keys=True)
+        _, text = ResponseCache.shared().fetch(
+            'tree_of_life', url, body,
+            lambda: HttpClient.shared().post(url, data=body, headers=headers),
+            Tree_of_Life.cacheable)
+        return json.loads(text)
+
+    @staticmethod
+    def cacheable(text):
+        """
+        False for error messages and for name matches missing a name,
+        which may be a transient problem of the API, and are asked again next time.
+        """
+        try:
+            response_json = json.loads(text)
+        except ValueError:
+            return False
+        if not isinstance(response_json, dict) or 'message' in response_json or 'error' in response_json:
+            return False
+        if response_json.get('unmatched_names'):
+            return False
+        return all(result.get('matches') for result in response_json.get('results', []))
 
 
 class Obtain_OTT_ID(Tree_of_Life):
@@ -65,9 +85,48 @@ class Obtain_OTT_ID(Tree_of_Life):
             return 'NA'
 
 
+class Obtain_OTT_IDs(Tree_of_Life):
+    """Get the ott ids for a list of scientific names, with few requests."""
+
+    CHUNK_SIZE = 250
+    """Names sent per match_names request."""
+
+    def _run(self, param):
+        """
+        Calls Tree of Life API taxonomy name resolution (tnrs) service,
+        match_names with all species names given in param, CHUNK_SIZE names per request
+
+        @param param list of String, scientific names of species.
+        @return dict name: int ott id, or 'NA' for names without a match,
+            names of failed requests are left out, to be retried one by one
+        """
+        url = urllib.parse.urljoin(
+            Tree_of_Life.BASE_URL, "tnrs/match_names")
+        names = list(dict.fromkeys(param))  # unique, keep order
+        ott_ids = {}
+        for start in range(0, len(names), Obtain_OTT_IDs.CHUNK_SIZE):
+            chunk = names[start:start + Obtain_OTT_IDs.CHUNK_SIZE]
+            data = {'names': chunk, "do_approximate_matching": False}
+            try:
+                response_json = self.send_request(url, data)
+                matched = {name: 'NA' for name in chunk}
+                for result in response_json['results']:
+                    if result['matches'] and result['name'] in matched:
+                        matched[result['name']] = result['matches'][0]['taxon']['ott_id']
+            except Exception:
+                logging.warning(
+                    "Could not match names %s\n%s" % (', '.join(chunk), traceback.format_exc()))
+                continue
+            ott_ids.update(matched)
+        return ott_ids
+
+
 class Obtain_Lineage(Tree_of_Life):
     """Get genus, family order and class by ott_id"""
-    tree_obj = None
+
+    RANKS = ('subspecies', 'species', 'genus',
+             'family', 'order', 'class', 'phylum')
+    """Ranks returned in the lineage dict."""
 
     def _run(self, param):
         """
@@ -80,29 +139,36 @@ class Obtain_Lineage(Tree_of_Life):
             Tree_of_Life.BASE_URL, "taxonomy/taxon_info")
         data = {'ott_id': param, "include_lineage": True}
         response_json = self.send_request(url, data)
+        return Obtain_Lineage.parse(response_json)
 
-        # use objectpath to search the tree for interesting taxa
-        self.tree_obj = objectpath.Tree(response_json)
-
-        lineage = dict()
-        lineage['unique_name'] = self.tree_obj.execute("$.*['unique_name']")
-        lineage['subspecies'] = self._get_taxon_by_rank("subspecies")
-        lineage['species'] = self._get_taxon_by_rank("species")
-        lineage['genus'] = self._get_taxon_by_rank("genus")
-        lineage['family'] = self._get_taxon_by_rank("family")
-        lineage['order'] = self._get_taxon_by_rank("order")
-        lineage['class'] = self._get_taxon_by_rank("class")
-        lineage['phylum'] = self._get_taxon_by_rank("phylum")
-        return lineage
+    @staticmethod
+    def parse(taxon_info):
+        """
+        Builds the lineage dict from a taxon_info response, walking it once.
+        The first taxon found for a rank wins: the queried taxon, then its lineage from the closest ancestor up.
 
-    def _get_taxon_by_rank(self, rank):
-        """Search the tree for entry with given rank name (e.g. 'genus')"""
-        obj_name = tuple(self.tree_obj.execute(
-            '$..*[@.rank is "%s"]["name"]' % rank))
-        if obj_name:
-            name = obj_name[0]
-            ott_id = tuple(self.tree_obj.execute(
-                '$..*[@.rank is "%s"]["ott_id"]' % rank))[0]
-            return {'name': name, 'ott_id': ott_id}
-        else:
-            return None
+        @param taxon_info dict, json response of taxonomy/taxon_info
+        @return dict{'unique_name':String, rank:{'name':String, 'ott_id':int} or None}
+        """
+        taxa = dict.fromkeys(Obtain_Lineage.RANKS)
+        missing = len(taxa)
+        stack = [taxon_info]
+        while stack and missing:
+            node = stack.pop()
+            if isinstance(node, dict):
+                rank = node.get('rank')
+                if rank in taxa and taxa[rank] is None:
+                    taxa[rank] = {
+                        'name': node.get('name'), 'ott_id': node.get('ott_id')}
+                    missing -= 1
+                children = node.values()
+            elif isinstance(node, list):
+                children = node
+            else:
+                continue
+            # reversed, so that the walk is preorder in document order
+            stack.extend(reversed(list(children)))
+
+        lineage = {'unique_name': taxon_info.get('unique_name')}
+        lineage.update(taxa)
+        return lineage
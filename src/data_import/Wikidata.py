@@ -11,9 +11,12 @@ Created on 06.02.2020
 """
 import abc
 import urllib.parse
-import requests
 import json
 import traceback
+import logging
+from data_import.ResponseCache import ResponseCache
+from data_import.HttpClient import HttpClient
+from data_import.KnownTaxa import KnownTaxa
 
 
 class Wikidata(abc.ABC):
@@ -21,152 +24,8 @@ class Wikidata(abc.ABC):
     WIKIPEDIA_BASE_URL = "https://en.wikipedia.org/w/api.php"
     WIKIDATA_BASE_URL = "https://www.wikidata.org/w/api.php"
 
-    known_taxa = {
-        'Lipotes vexillifer': {
-            'ott_id': 5269,
-            'vernacular_name_english': "Baiji",
-            'vernacular_name_german': "Chinesischer Flussdelfin"},
-        'Mesoplodon densirostris': {
-            'ott_id': 6470,
-            'vernacular_name_english': "Blainville's beaked whale",
-            'vernacular_name_german': "Blainville-Schnabelwal"},
-        'Zalophus californianus': {
-            'ott_id': 95364,
-            'vernacular_name_english': "California sea lion",
-            'vernacular_name_german': "Kalifornischer Seelöwe"},
-        'Globicephala melas': {
-            'ott_id': 124212,
-            'vernacular_name_english': "Long-finned pilot whale",
-            'vernacular_name_german': "Grindwal"},
-        'Orcinus orca': {
-            'ott_id': 124215,
-            'vernacular_name_english': "Orca",
-            'vernacular_name_german': "Schwertwal"},
-        'Stenella coeruleoalba': {
-            'ott_id': 124224,
-            'vernacular_name_english': "Striped dolphin",
-            'vernacular_name_german': "Blau-Weißer Delfin"},
-        'Tursiops truncatus': {
-            'ott_id': 124230,
-            'vernacular_name_english': "Common bottlenose dolphin",
-            'vernacular_name_german': "Großer Tümmler"},
-        'Grampus griseus': {
-            'ott_id': 154711,
-            'vernacular_name_english': "Risso's dolphin",
-            'vernacular_name_german': "Rundkopfdelfin"},
-        'Pusa hispida': {
-            'ott_id': 175251,
-            'vernacular_name_english': "Ringed seal",
-            'vernacular_name_german': "Ringelrobbe"},
-        'Mirounga angustirostris': {
-            'ott_id': 175268,
-            'vernacular_name_english': "Northern elephant seal",
-            'vernacular_name_german': "Nördlicher See-Elefant"},
-        'Neomonachus schauinslandi': {
-            'ott_id': 180367,
-            'vernacular_name_english': "Hawaiian monk seal",
-            'vernacular_name_german': "Hawaii-Mönchsrobbe"},
-        'Sousa chinensis': {
-            'ott_id': 187220,
-            'vernacular_name_english': "Chinese white dolphin",
-            'vernacular_name_german': "Chinesischer Weißer Delfin"},
-        'Pseudorca crassidens': {
-            'ott_id': 209644,
-            'vernacular_name_english': "False killer whale",
-            'vernacular_name_german': "Kleiner Schwertwal"},
-        'Trichechus manatus': {
-            'ott_id': 226178,
-            'vernacular_name_english': "West Indian manatee",
-            'vernacular_name_german': "Karibik-Manati"},
-        'Trichechus inunguis': {
-            'ott_id': 226185,
-            'vernacular_name_english': "Amazonian manatee",
-            'vernacular_name_german': "Amazonas-Manati"},
-        'Tursiops aduncus': {
-            'ott_id': 257323,
-            'vernacular_name_english': "Indo-Pacific bottlenose dolphin",
-            'vernacular_name_german': "Indopazifischer Großer Tümmler"},
-        'Sotalia fluviatilis': {
-            'ott_id': 336231,
-            'vernacular_name_english': "Tucuxio",
-            'vernacular_name_german': "Amazonas-Sotalia"},
-        'Phoca vitulina vitulina': {
-            'ott_id': 553449,
-            'vernacular_name_english': "Harbour seal (subsp. vitulina)",
-            'vernacular_name_german': "Seehund (Unterart vitulina)"},
-        'Phoca groenlandica': {
-            'ott_id': 664062,
-            'vernacular_name_english': "Harp seal",
-            'vernacular_name_german': "Sattelrobbe"},
-        'Inia geoffrensis': {
-            'ott_id': 698411,
-            'vernacular_name_english': "Amazon river dolphin",
-            'vernacular_name_german': "Amazonasdelfin"},
-        'Phoca vitulina': {
-            'ott_id': 698422,
-            'vernacular_name_english': "Harbour seal",
-            'vernacular_name_german': "Seehund"},
-        'Odobenus rosmarus': {
-            'ott_id': 749644,
-            'vernacular_name_english': "Walrus",
-            'vernacular_name_german': "Walross"},
-        'Trichechus manatus latirostris': {
-            'ott_id': 816446,
-            'vernacular_name_english': "West Indian manatee, subsp. latirostris",
-            'vernacular_name_german': "Karibik-Manati, unterart latirostris"},
-        'Phocoena phocoena': {
-            'ott_id': 851312,
-            'vernacular_name_english': "Harbour porpoise",
-            'vernacular_name_german': "Gewöhnlicher Schweinswal"},
-        'Delphinapterus leucas': {
-            'ott_id': 851318,
-            'vernacular_name_english': "Beluga whale",
-            'vernacular_name_german': "Weißwal"},
-        'Callorhinus ursinus': {
-            'ott_id': 949693,
-            'vernacular_name_english': "Northern fur seal",
-            'vernacular_name_german': "Nördlicher Seebär"},
-        'Halichoerus grypus': {
-            'ott_id': 1040694,
-            'vernacular_name_english': "Grey seal",
-            'vernacular_name_german': "Kegelrobbe"},
-        'Globicephala macrorhynchus': {
-            'ott_id': 535886,
-            'vernacular_name_english': "Short-finned pilot whale",
-            'vernacular_name_german': "Kurzflossen-Grindwal"},
-        'Phalacrocorax carbo': {
-            'ott_id': 969841,
-            'vernacular_name_english': "Great cormorant",
-            'vernacular_name_german': "Kormoran"},
-        'Phalacrocorax carbo sinensis': {
-            'ott_id': 5859705,
-            'vernacular_name_english': "Great cormorant subsp. sinensis",
-            'vernacular_name_german': "Kormoran, Unterart sinensis"},
-        'Neophocaena asiaeorientalis asiaeorientalis': {
-            'ott_id': 5846401,
-            'vernacular_name_english': "Narrow-ridged finless porpoise, subsp. asiaeorientalis",
-            'vernacular_name_german': "Östlicher Glattschweinswal, Unterart asiaeorientalis"},
-        'Eumetopias jubatus': {
-            'ott_id': 949686,
-            'vernacular_name_english': "Steller's sea lion",
-            'vernacular_name_german': "Stellerscher Seelöwe"},
-        'Sciaena umbra': {
-            'ott_id': 3634399,
-            'vernacular_name_english': "Brown meagre",
-            'vernacular_name_german': "Meerrabe"},
-        'Eretmochelys imbricata': {
-            'ott_id': 430337,
-            'vernacular_name_english': "Hawksbill sea turtle",
-            'vernacular_name_german': "Echte Karettschildkröte"},
-        'Caretta caretta': {
-            'ott_id': 392505,
-            'vernacular_name_english': "Loggerhead sea turtle",
-            'vernacular_name_german': "Unechte Karettschildkröte"},
-        'Enhydra lutris': {
-            'ott_id': 949676,
-            'vernacular_name_english': "Sea otter",
-            'vernacular_name_german': "Seeotter"}
-    }
+    BATCH_SIZE = 50
+    """Titles per Wikipedia query and ids per wbgetentities call, the API limit."""
 
     def run(self, taxon_name):
         results = self._run(taxon_name)
@@ -178,8 +37,21 @@ class Wikidata(abc.ABC):
 
     def send_request(self, url, data=None):
         headers = {'Content-Type': 'application/json'}
-        response = requests.post(url, data=json.dumps(data), headers=headers)
-        return response.json()
+        body = json.dumps(data, sort_keys=True)
+        _, text = ResponseCache.shared().fetch(
+            'wikidata', url, body,
+            lambda: HttpClient.shared().post(url, data=body, headers=headers),
+            Wikidata.cacheable)
+        return json.loads(text)
+
+    @staticmethod
+    def cacheable(text):
+        """False for error responses, e.g. too many requests, answered with status 200."""
+        try:
+            response_json = json.loads(text)
+        except ValueError:
+            return False
+        return isinstance(response_json, dict) and 'error' not in response_json
 
 
 class Obtain_Wikibase_Item_ID(Wikidata):
@@ -227,24 +99,93 @@ class Obtain_Vernacular_Name(Wikidata):
         @param taxon_name String, latin name
         @return dict vernacular names in German and English
         """
-        labels = dict()
-        # get taxon name from known_taxa array
-        if taxon_name in Wikidata.known_taxa:
-            labels['de'] = Wikidata.known_taxa[taxon_name]['vernacular_name_german']
-            labels['en'] = Wikidata.known_taxa[taxon_name]['vernacular_name_english']
-            return labels
-        # get taxon names from Wikidata
-        else:
-            wd_id = Obtain_Wikibase_Item_ID().run(taxon_name)
-            url = urllib.parse.urljoin(Wikidata.WIKIDATA_BASE_URL,
-                                       "?action=wbgetentities&props=labels&ids=%s&languages=de|en&format=json" % wd_id)
-            response_json = None
+        return Obtain_Vernacular_Names().run([taxon_name])[taxon_name]
+
+
+class Obtain_Vernacular_Names(Wikidata):
+    """Get the vernacular names for a list of taxa, with few requests."""
+
+    def _run(self, taxon_names):
+        """
+        Looks up known_taxa first, then calls Wikipedia API service
+        to get the wikibase items of the remaining names, BATCH_SIZE titles per request,
+        and Wikidata API service to get their German and English labels, BATCH_SIZE ids per request.
+
+        @param taxon_names list of String, latin names
+        @return dict latin name: dict vernacular names in German and English, or 'NA'
+        """
+        names = list(dict.fromkeys(taxon_names))  # unique, keep order
+        labels = {}
+        remaining = []
+        for name in names:
+            known = KnownTaxa.shared().labels(name)
+            if known is not None:
+                labels[name] = known
+            else:
+                remaining.append(name)
+
+        items = {}
+        for chunk in self._chunks(remaining):
+            items.update(self._wikibase_items(chunk))
+        entities = {}
+        for chunk in self._chunks(sorted(set(items.values()))):
+            entities.update(self._entity_labels(chunk))
+
+        for name in remaining:
+            labels[name] = entities.get(items.get(name), 'NA')
+        return labels
+
+    def _wikibase_items(self, titles):
+        """Returns a dict title: wikibase item id, following normalization and redirects."""
+        params = {'action': 'query', 'prop': 'pageprops', 'ppprop': 'wikibase_item',
+                  'redirects': 1, 'titles': '|'.join(titles), 'format': 'json'}
+        url = "%s?%s" % (Wikidata.WIKIPEDIA_BASE_URL,
+                         urllib.parse.urlencode(params))
+        try:
+            query = self.send_request(url)['query']
+        except Exception:
+            logging.warning("Could not get wikibase items for %s\n%s" % (
+                ', '.join(titles), traceback.format_exc()))
+            return {}
+        renamed = {}
+        for entry in query.get('normalized', []) + query.get('redirects', []):
+            renamed[entry['from']] = entry['to']
+        page_items = {}
+        for page in query.get('pages', {}).values():
+            if 'wikibase_item' in page.get('pageprops', {}):
+                page_items[page['title']] = page['pageprops']['wikibase_item']
+        items = {}
+        for title in titles:
+            target = title
+            # normalized, then redirected, guard against loops
+            for _ in range(3):
+                target = renamed.get(target, target)
+            if target in page_items:
+                items[title] = page_items[target]
+        return items
+
+    def _entity_labels(self, ids):
+        """Returns a dict wikibase item id: {'de', 'en'} for items labeled in both languages."""
+        params = {'action': 'wbgetentities', 'props': 'labels', 'ids': '|'.join(ids),
+                  'languages': 'de|en', 'format': 'json'}
+        url = "%s?%s" % (Wikidata.WIKIDATA_BASE_URL,
+                         urllib.parse.urlencode(params))
+        try:
+            entities = self.send_request(url)['entities']
+        except Exception:
+            logging.warning("Could not get labels for %s\n%s" % (
+                ', '.join(ids), traceback.format_exc()))
+            return {}
+        labels = {}
+        for wd_id, entity in entities.items():
             try:
-                response_json = self.send_request(url)
-                labels['de'] = response_json['entities'][wd_id]['labels']['de']['value']
-                labels['en'] = response_json['entities'][wd_id]['labels']['en']['value']
-                return labels
-            except:
-                print(response_json)
-                traceback.format_exc()
-                return 'NA'
+                labels[wd_id] = {
+                    'de': entity['labels']['de']['value'],
+                    'en': entity['labels']['en']['value']}
+            except KeyError:
+                continue
+        return labels
+
+    def _chunks(self, values):
+        for start in range(0, len(values), Wikidata.BATCH_SIZE):
+            yield values[start:start + Wikidata.BATCH_SIZE]
@@ -10,5 +10,16 @@ class AbstractDAO {
         xmlHttp.send( null );
         return xmlHttp.responseText;
     }
+
+    /**
+       Sends an object as JSON in a HTTP POST request, returns response text.
+    */
+    httpPostJson(theUrl, obj){
+        var xmlHttp = new XMLHttpRequest();
+        xmlHttp.open( "POST", theUrl, false );
+        xmlHttp.setRequestHeader('Content-Type', 'application/json;charset=utf-8');
+        xmlHttp.send( JSON.stringify(obj) );
+        return xmlHttp.responseText;
+    }
 }
 
@@ -53,26 +53,31 @@ class DataPointController extends AbstractController {
             this._toggleSaveThrobber();
             var expId = this._parseAudiogramId();
 
-            // Save existing and new datapoints
+            // Collect existing and new datapoints
             var dpEls = this._allDataPoints();
             if (dpEls.length == 0) throw 'No data points, enter the id of the audiogram to edit and click on edit';
+            var creates = [];
+            var updates = [];
             for (var i = 0; i < dpEls.length; i++) {
                 var dpEl = dpEls[i];
                 var dataPoint = this._parseDataPoint(expId, dpEl);
                 if (!dataPoint) continue; // ignore datapoints without frequency or SPL
                 
                 if (dataPoint.id == -1) // new data point has id=-1
-                    dataPoint.create();
+                    creates.push(dataPoint);
                 else
-                    dataPoint.save(); // save existing data point
+                    updates.push(dataPoint); // save existing data point
             }
             
-            // Deleted data points marked for deletion
+            // Data points marked for deletion
+            var deletes = [];
             var delEls = this._delDataPoints();
             for (var i = 0; i < delEls.length; i++) {
-                var id = parseInt(delEls[i].id.split('_')[1]);
-                new DataPointDAO(id).delete()
+                deletes.push(parseInt(delEls[i].id.split('_')[1]));
             }
+
+            // Send all changes in one request
+            this.dao.saveBatch(expId, creates, updates, deletes);
             
             // make sure the edit input is showing the correct id, reload data from server
             document.getElementById('edit_id').value = expId;
@@ -44,6 +44,38 @@ class DataPointDAO extends AbstractDAO {
         var resp = this.httpGet(url);
     }
 
+    /**
+     * Creates, saves and deletes data points of an audiogram in a single request.
+     * @param expId: int id of an audiogram
+     * @param creates: list of DataPointDAO objects to create
+     * @param updates: list of DataPointDAO objects to save
+     * @param deletes: list of int ids of data points to delete
+     */
+    saveBatch(expId, creates, updates, deletes) {
+        var url = `/admin/v1/data_points/batch`;
+        var diff = {
+            'audiogram_experiment_id': expId,
+            'create': creates.map(dataPoint => dataPoint.toJson()),
+            'update': updates.map(dataPoint => dataPoint.toJson()),
+            'delete': deletes
+        };
+        var resp = this.httpPostJson(url, diff);
+        if (resp == 'False') throw `Error while saving data points of audiogram ${expId}`;
+        return resp;
+    }
+
+    /**The data point's fields, as sent to the server*/
+    toJson() {
+        return {
+            'id': this.id,
+            'testtone_frequency_in_khz': this.testtone_frequency_in_khz,
+            'sound_pressure_level_in_decibel': this.sound_pressure_level_in_decibel,
+            'testtone_duration_in_millisecond': this.testtone_duration_in_millisecond,
+            'sound_pressure_level_reference': this.sound_pressure_level_reference,
+            'sound_pressure_level_reference_method': this.sound_pressure_level_reference_method
+        };
+    }
+
     /**Deletes a data point from the database*/
     delete() {
         var url = `/admin/v1/delete_data_point?id=${this.id}`;
@@ -23,7 +23,7 @@ class ExperimentController extends AbstractController {
             var json = this.dao.save();
             if (json == 'False') throw('Error while saving data');
             var jsonObj = JSON.parse(json)[0];
-            var newId = jsonObj['max(id)'];
+            var newId = jsonObj['id'];
             alert(`Audiogram id ${newId} has been created`);
             this.dao.id = newId;
             window.location.replace(`/admin/v1/edit_experiment_metadata?newid=${newId}`);
@@ -65,7 +65,7 @@ class PublicationController extends AbstractController {
                 var jsonObj = JSON.parse(resp);
                 // make sure the DOI input is showing the correct DOI, reload data from server
                 document.getElementById('doi').value = this.dao.doi;
-                this.read(jsonObj[0]['max(id)']);
+                this.read(jsonObj[0]['id']);
             }
         } catch(e) {
             alert(e);
@@ -0,0 +1,10 @@
+"""
+Test setup: the admin service modules are imported from src, as when running Admin.py.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
@@ -0,0 +1,55 @@
+"""
+Result cache of the admin queries shared with other processes through the change journal.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import configparser
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from AdminQuery import AdminQuery  # noqa: E402
+from QueryCache import QueryCache  # noqa: E402
+
+
+class Pool:
+    def acquire(self):
+        return None
+
+    def release(self, connection, discard=False):
+        pass
+
+
+class CountingQuery(AdminQuery):
+    cache_ttl = 300
+    tables_read = ('facility',)
+    runs = 0
+    journal = [0]
+
+    def versions(self):
+        return tuple(CountingQuery.journal)
+
+    def _run(self, param=None):
+        CountingQuery.runs += 1
+        return {'headers': ['run'], 'results': [[CountingQuery.runs]]}
+
+
+@pytest.fixture
+def query(monkeypatch):
+    monkeypatch.setattr(AdminQuery, 'pool', Pool())
+    monkeypatch.setattr(AdminQuery, 'cache', QueryCache())
+    monkeypatch.setattr(CountingQuery, 'journal', [0])
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'DB_HOST': 'localhost', 'DB_PASSWORD': '',
+                         'DB_USERNAME': 'aad', 'DB_DATABASE': 'aad'}
+    return CountingQuery(config)
+
+
+def test_cached_result_is_used_until_the_journal_moves(query):
+    first = query.run()
+    assert query.run() == first
+    # a write of another process, not invalidated in this process's cache
+    CountingQuery.journal[0] = 1
+    assert query.run() != first
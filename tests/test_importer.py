@@ -0,0 +1,129 @@
+"""
+Importer.load against a MySQL database already holding audiograms.
+Runs when AAD_TEST_DB_HOST, AAD_TEST_DB_USERNAME, AAD_TEST_DB_PASSWORD and AAD_TEST_DB_DATABASE
+name a scratch database, its tables are dropped and created.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import configparser
+import os
+
+import pytest
+
+pymysql = pytest.importorskip('pymysql')
+
+from data_import.Importer import Importer  # noqa: E402
+from data_import.Model import Model  # noqa: E402
+
+SETTINGS = {option: os.environ.get('AAD_TEST_%s' % option)
+            for option in ('DB_HOST', 'DB_USERNAME', 'DB_PASSWORD', 'DB_DATABASE')}
+
+pytestmark = pytest.mark.skipif(
+    not all(SETTINGS.values()), reason="no test database, set AAD_TEST_DB_*")
+
+SCHEMA = [
+    "create table facility (id int not null auto_increment, name varchar(255), primary key (id))",
+    "create table taxon (ott_id int not null, parent int, lft int, rgt int, "
+    "binomial_name varchar(255), primary key (ott_id))",
+    "create table publication (id int not null auto_increment, doi varchar(255), "
+    "citation_long text, primary key (id))",
+    "create table audiogram_experiment (id int not null auto_increment, facility_id int, "
+    "taxon_id int, primary key (id))",
+    "create table audiogram_data_point (id int not null auto_increment, audiogram_experiment_id int, "
+    "testtone_frequency_in_khz double, primary key (id))",
+    "create table individual_animal (id int not null auto_increment, individual_name varchar(255), "
+    "taxon_id int, primary key (id))",
+    "create table test_animal (id int not null auto_increment, audiogram_experiment_id int, "
+    "individual_animal_id int, primary key (id))",
+    "create table audiogram_publication (audiogram_experiment_id int, publication_id int)"]
+
+# rows with the ids the Parser generates for a single file, taken by the first import
+EXISTING = [
+    "insert into facility values (1, 'Zoo A')",
+    "insert into taxon values (1, null, 1, 4, 'Testus'), (10, 1, 2, 3, 'Testus alpha')",
+    "insert into publication values (1, '10.0000/old', 'Old, 2000')",
+    "insert into audiogram_experiment values (1, 1, 10)",
+    "insert into audiogram_data_point values (1, 1, 1.0)",
+    "insert into individual_animal values (1, 'Anna', 10)",
+    "insert into test_animal values (1, 1, 1)",
+    "insert into audiogram_publication values (1, 1)"]
+
+
+@pytest.fixture
+def importer():
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = SETTINGS
+    connection = pymysql.connect(
+        host=SETTINGS['DB_HOST'], user=SETTINGS['DB_USERNAME'],
+        password=SETTINGS['DB_PASSWORD'], database=SETTINGS['DB_DATABASE'])
+    with connection.cursor() as cursor:
+        for table in Importer.LOAD_ORDER + ['change_journal']:
+            cursor.execute("drop table if exists %s" % table)
+        for sql in SCHEMA + EXISTING:
+            cursor.execute(sql)
+    connection.commit()
+    yield Importer(config), connection
+    connection.close()
+
+
+def model():
+    """A file with a new facility and an existing one, new and existing taxa and publications."""
+    model = Model()
+    model.facilities = [{'id': 1, 'name': 'Zoo B'}, {'id': 2, 'name': 'Zoo A'}]
+    model.taxon = [
+        {'ott_id': 1, 'lft': 1, 'rgt': 6, 'binomial_name': 'Testus'},
+        {'ott_id': 10, 'parent': 1, 'lft': 2, 'rgt': 3, 'binomial_name': 'Testus alpha'},
+        {'ott_id': 11, 'parent': 1, 'lft': 4, 'rgt': 5, 'binomial_name': 'Testus beta'}]
+    model.publication = [{'id': 1, 'doi': '10.0000/new', 'citation_long': 'New, 2020'},
+                         {'id': 2, 'doi': '10.0000/old', 'citation_long': 'Old, 2000'},
+                         {'id': 3, 'doi': 'NA', 'citation_long': 'Old, 2000'}]
+    model.audiogram_experiments = [{'id': 1, 'facility_id': 1, 'taxon_id': 11},
+                                   {'id': 7, 'facility_id': 2, 'taxon_id': 10}]
+    model.audiogram_data_point = [
+        {'id': 1, 'audiogram_experiment_id': 1, 'testtone_frequency_in_khz': 1.0},
+        {'id': 2, 'audiogram_experiment_id': 7.0, 'testtone_frequency_in_khz': 2.0}]
+    model.individual_animal = [{'id': 1, 'individual_name': 'Bert', 'taxon_id': 11}]
+    model.test_animal = [{'audiogram_experiment_id': 1, 'individual_animal_id': 1}]
+    model.audiogram_publication = [{'audiogram_experiment_id': 1, 'publication_id': 1},
+                                   {'audiogram_experiment_id': 7, 'publication_id': 3}]
+    return model
+
+
+def rows(connection, sql):
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+
+def test_load_into_non_empty_database(importer):
+    importer, connection = importer
+    report = importer.load(model())
+    connection.commit()  # see the rows committed by the importer
+
+    counts = {t['table']: (t['rows'], t['existing']) for t in report['tables']}
+    assert counts['facility'] == (1, 1)
+    assert counts['taxon'] == (1, 2)
+    assert counts['publication'] == (1, 2)
+    assert rows(connection, "select id, name from facility order by id") == ((1, 'Zoo A'), (2, 'Zoo B'))
+    assert rows(connection, "select count(*) from publication") == ((2,),)
+
+    experiments = report['audiogram_experiment_ids']
+    assert sorted(experiments) == [1, 7]
+    assert 1 not in experiments.values()
+    # foreign keys point to the database ids
+    assert rows(connection, "select facility_id from audiogram_experiment where id = %d" %
+                experiments[1]) == ((2,),)
+    assert rows(connection, "select facility_id from audiogram_experiment where id = %d" %
+                experiments[7]) == ((1,),)
+    assert rows(connection, "select audiogram_experiment_id from audiogram_data_point "
+                            "where testtone_frequency_in_khz = 2.0") == ((experiments[7],),)
+    assert rows(connection, "select audiogram_experiment_id, publication_id from audiogram_publication "
+                            "order by audiogram_experiment_id") == (
+        (1, 1), (experiments[1], 2), (experiments[7], 1))
+    assert rows(connection, "select i.individual_name from test_animal t join individual_animal i "
+                            "on i.id = t.individual_animal_id where t.audiogram_experiment_id = %d" %
+                experiments[1]) == (('Bert',),)
+    # the new taxon is numbered within the existing tree
+    assert rows(connection, "select ott_id, lft, rgt from taxon order by lft") == (
+        (1, 1, 6), (10, 2, 3), (11, 4, 5))
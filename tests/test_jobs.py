@@ -0,0 +1,101 @@
+"""
+Job runners of several processes sharing a job file.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('simplejson')
+
+from Jobs import JobRunner  # noqa: E402
+
+
+def record(job, path, seconds):
+    """Work function appending its start and end time to path."""
+    start = time.time()
+    time.sleep(seconds)
+    with open(path, 'a') as f:
+        f.write('%f %f\n' % (start, time.time()))
+
+
+OTHER_PROCESS = """
+import sys
+sys.path[:0] = sys.argv[1:3]
+from Jobs import JobRunner
+from test_jobs import record, wait
+runner = JobRunner(sys.argv[3], sys.argv[4])
+wait(runner, runner.submit('test', record, sys.argv[5], 0.3, exclusive=True))
+"""
+
+
+def wait(runner, job_id):
+    while runner.get(job_id)['state'] not in ('done', 'failed'):
+        time.sleep(0.05)
+    return runner.get(job_id)
+
+
+def test_exclusive_jobs_of_two_processes_do_not_overlap(tmp_path):
+    job_path, result_dir = str(tmp_path / 'jobs.sqlite'), str(tmp_path / 'results')
+    intervals = str(tmp_path / 'intervals')
+    runner = JobRunner(job_path, result_dir)
+    job_id = runner.submit('test', record, intervals, 0.3, exclusive=True)
+    tests = os.path.dirname(os.path.abspath(__file__))
+    other = subprocess.Popen([sys.executable, '-c', OTHER_PROCESS,
+                              os.path.join(tests, '..', 'src'), tests, job_path, result_dir, intervals])
+    assert other.wait(10) == 0
+
+    assert wait(runner, job_id)['state'] == 'done'
+    with open(intervals) as f:
+        (start1, end1), (start2, end2) = sorted(tuple(map(float, line.split())) for line in f)
+    assert end1 <= start2
+
+
+def test_restart_fails_only_jobs_of_processes_gone(tmp_path):
+    job_path, result_dir = str(tmp_path / 'jobs.sqlite'), str(tmp_path / 'results')
+    runner = JobRunner(job_path, result_dir)
+    gone = subprocess.Popen([sys.executable, '-c', 'pass'])
+    gone.wait()
+    alive = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        owners = {'gone': (socket.gethostname(), gone.pid),
+                  'alive': (socket.gethostname(), alive.pid),
+                  'other_host': ('%s-other' % socket.gethostname(), os.getpid()),
+                  'no_owner': (None, None)}
+        for job_id, (host, pid) in owners.items():
+            runner._db.execute(
+                "INSERT INTO job (id, kind, state, stage, percent, created, host, pid) "
+                "VALUES (?, 'test', 'running', 'running', 0, ?, ?, ?)",
+                (job_id, time.time(), host, pid))
+        runner._db.commit()
+
+        restarted = JobRunner(job_path, result_dir)
+        states = {job_id: restarted.get(job_id)['state'] for job_id in owners}
+    finally:
+        alive.kill()
+        alive.wait()
+    assert states == {'gone': 'failed', 'alive': 'running',
+                      'other_host': 'running', 'no_owner': 'failed'}
+
+
+def test_second_runner_of_a_process_keeps_its_jobs(tmp_path):
+    job_path, result_dir = str(tmp_path / 'jobs.sqlite'), str(tmp_path / 'results')
+    runner = JobRunner(job_path, result_dir)
+    job_id = runner.submit('test', record, str(tmp_path / 'intervals'), 0.5)
+    # left by an earlier process with the pid of this one
+    runner._db.execute(
+        "INSERT INTO job (id, kind, state, stage, percent, created, host, pid, runner) "
+        "VALUES ('earlier', 'test', 'running', 'running', 0, ?, ?, ?, 'gone')",
+        (time.time(), socket.gethostname(), os.getpid()))
+    runner._db.commit()
+
+    reconfigured = JobRunner(job_path, result_dir)
+    assert reconfigured.get('earlier')['state'] == 'failed'
+    assert reconfigured.get(job_id)['state'] in ('queued', 'running')
+    assert wait(runner, job_id)['state'] == 'done'
@@ -0,0 +1,192 @@
+"""
+Resolver against local stub HTTP servers, one per API host.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import configparser
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('requests')
+
+from data_import.DOI import DOI  # noqa: E402
+from data_import.HttpClient import HttpClient  # noqa: E402
+from data_import.Resolver import Resolver  # noqa: E402
+from data_import.ResponseCache import ResponseCache  # noqa: E402
+from data_import.Tree_of_Life import Tree_of_Life  # noqa: E402
+from data_import.Wikidata import Wikidata  # noqa: E402
+
+NAMES = ['Testus %s' % epithet for epithet in
+         ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta')]
+BROKEN_NAME = 'Testus brokenus'
+DOIS = ['10.0000/test.%d' % i for i in range(6)]
+BROKEN_DOI = '10.0000/missing'
+LANDING_PAGE_DOI = '10.0000/landing'
+SLOW = 0.1
+
+
+class StubServer(ThreadingHTTPServer):
+    """Answers POST requests with answer(path, query, body), records the concurrent requests."""
+
+    daemon_threads = True
+
+    def __init__(self, answer):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.answer = answer
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.paths = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.paths.append(self.path)
+        try:
+            time.sleep(SLOW)
+            url = urllib.parse.urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8') if length else ''
+            status, payload = server.answer(
+                urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query), body)
+        finally:
+            with server.lock:
+                server.active -= 1
+        data = payload.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def tree_of_life(path, query, body):
+    request = json.loads(body)
+    if path.endswith('tnrs/match_names'):
+        return 200, json.dumps({'results': [
+            {'name': name, 'matches': [{'taxon': {'ott_id': 1000 + (NAMES + [BROKEN_NAME]).index(name)}}]}
+            for name in request['names']]})
+    name = (NAMES + [BROKEN_NAME])[request['ott_id'] - 1000]
+    if name == BROKEN_NAME:
+        return 500, 'taxon_info failed'
+    return 200, json.dumps({
+        'name': name, 'unique_name': name, 'rank': 'species', 'ott_id': request['ott_id'],
+        'lineage': [{'name': 'Testus', 'rank': 'genus', 'ott_id': 1}]})
+
+
+def wikipedia(path, query, body):
+    titles = query['titles'][0].split('|')
+    return 200, json.dumps({'query': {'pages': {
+        str(i): {'title': title, 'pageprops': {'wikibase_item': 'Q%d' % i}}
+        for i, title in enumerate(titles)}}})
+
+
+def wikidata(path, query, body):
+    ids = query['ids'][0].split('|')
+    return 200, json.dumps({'entities': {
+        wd_id: {'labels': {'de': {'value': 'Test %s' % wd_id}, 'en': {'value': 'test %s' % wd_id}}}
+        for wd_id in ids}})
+
+
+def doi(path, query, body):
+    if path.strip('/') == BROKEN_DOI:
+        return 404, 'not found'
+    if path.strip('/') == LANDING_PAGE_DOI:
+        return 200, '<html><body>Landing page</body></html>'
+    return 200, json.dumps({
+        'author': [{'family': 'Muster', 'given': 'Max'}],
+        'issued': {'date-parts': [[2020]]}, 'title': path.strip('/')})
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    servers = {'tree_of_life': StubServer(tree_of_life), 'wikipedia': StubServer(wikipedia),
+               'wikidata': StubServer(wikidata), 'doi': StubServer(doi)}
+    monkeypatch.setattr(Tree_of_Life, 'BASE_URL', servers['tree_of_life'].url + 'v3/')
+    monkeypatch.setattr(Wikidata, 'WIKIPEDIA_BASE_URL', servers['wikipedia'].url + 'w/api.php')
+    monkeypatch.setattr(Wikidata, 'WIKIDATA_BASE_URL', servers['wikidata'].url + 'w/api.php')
+    monkeypatch.setattr(DOI, 'BASE_URL', servers['doi'].url)
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'RESPONSE_CACHE_PATH': ':memory:', 'HTTP_MAX_RETRIES': '0'}
+    ResponseCache.configure(config)
+    HttpClient.configure(config)
+    yield servers
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+    ResponseCache._shared = None
+    HttpClient._shared = None
+
+
+def test_requests_per_host_are_capped(servers):
+    resolver = Resolver(max_workers=8, per_host=2)
+    resolver.resolve(NAMES, DOIS)
+
+    for name in servers:
+        assert servers[name].max_active <= 2, name
+    # the lineages and citations were fetched concurrently, up to the cap
+    assert servers['tree_of_life'].max_active == 2
+    assert servers['doi'].max_active == 2
+    assert resolver.lineage('Testus alpha')['genus'] == {'name': 'Testus', 'ott_id': 1}
+    assert resolver.vernacular('Testus alpha')['en'].startswith('test Q')
+    assert resolver.citations(DOIS[0]) == (
+        'Muster, M. (2020). %s.' % DOIS[0], 'Muster, 2020')
+
+
+def test_vernacular_lookup_holds_both_hosts(servers):
+    resolver = Resolver(per_host=1)
+    wikipedia = resolver._limit(Wikidata.WIKIPEDIA_BASE_URL)
+    wikipedia.acquire()
+    done = threading.Event()
+    threading.Thread(target=lambda: (resolver.vernacular('Testus alpha'), done.set()),
+                     daemon=True).start()
+    # waits for the Wikipedia host, although most of the work is on Wikidata
+    assert not done.wait(3 * SLOW)
+    assert servers['wikipedia'].paths == []
+    wikipedia.release()
+    assert done.wait(10)
+
+
+def test_stored_errors_are_raised(servers):
+    resolver = Resolver(per_host=2)
+    resolver.resolve(NAMES[:2] + [BROKEN_NAME], DOIS[:2] + [BROKEN_DOI])
+    requests = len(servers['tree_of_life'].paths) + len(servers['doi'].paths)
+
+    with pytest.raises(ValueError) as first:
+        resolver.lineage(BROKEN_NAME)
+    with pytest.raises(ValueError) as second:
+        resolver.lineage(BROKEN_NAME)
+    assert first.value is second.value
+    with pytest.raises(Exception, match=BROKEN_DOI):
+        resolver.citations(BROKEN_DOI)
+    # the errors are kept, not fetched again
+    assert len(servers['tree_of_life'].paths) + len(servers['doi'].paths) == requests
+    assert resolver.lineage(NAMES[0])['species']['name'] == NAMES[0]
+
+
+def test_landing_pages_are_not_cached(servers):
+    for _ in range(2):
+        resolver = Resolver(per_host=1)
+        resolver.resolve([], [LANDING_PAGE_DOI])
+        with pytest.raises(Exception, match=LANDING_PAGE_DOI):
+            resolver.citations(LANDING_PAGE_DOI)
+    # asked again, the record may be fixed upstream
+    assert len(servers['doi'].paths) == 2
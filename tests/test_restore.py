@@ -0,0 +1,82 @@
+"""
+Parsing of the CREATE TABLE statements of a dump.
+
+Created on 18.10.2026
+@author: Museum fuer Naturkunde Berlin
+"""
+import configparser
+import gzip
+
+import pytest
+
+pytest.importorskip('pymysql')
+
+from data_import.ChangeJournal import ChangeJournal  # noqa: E402
+from data_import.Restore import DumpTable, Restore, RestoreError, decompress  # noqa: E402
+
+CREATE = """CREATE TABLE `publication` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `citation_long` text COMMENT 'authors (year), title; ''quoted)''',
+  `doi` varchar(255) DEFAULT ',',
+  `pages` decimal(10,2) DEFAULT NULL,
+  PRIMARY KEY (`id`,
+    `doi`),
+  UNIQUE KEY `doi` (`doi`),
+  CONSTRAINT `fk` FOREIGN KEY (`id`) REFERENCES `other` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='publications (cited)';
+"""
+
+
+@pytest.fixture
+def restore():
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'DB_HOST': 'localhost', 'DB_PASSWORD': '',
+                         'DB_USERNAME': 'aad', 'DB_DATABASE': 'aad'}
+    return Restore(config)
+
+
+def test_parse_create(restore):
+    table = DumpTable('publication')
+    restore._parse_create(table, CREATE)
+
+    assert table.columns == [
+        "`id` int(11) NOT NULL AUTO_INCREMENT",
+        "`citation_long` text COMMENT 'authors (year), title; ''quoted)'''",
+        "`doi` varchar(255) DEFAULT ','",
+        "`pages` decimal(10,2) DEFAULT NULL",
+        "PRIMARY KEY (`id`,\n    `doi`)"]
+    assert table.keys == ["UNIQUE KEY `doi` (`doi`)"]
+    assert table.constraints == ["CONSTRAINT `fk` FOREIGN KEY (`id`) REFERENCES `other` (`id`)"]
+    assert table.options == " ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='publications (cited)'"
+
+
+def test_parse_incomplete_create(restore):
+    with pytest.raises(RestoreError):
+        restore._parse_create(DumpTable('publication'), "CREATE TABLE `publication` (\n  `id` int(11)")
+
+
+def test_split_skips_the_change_journal(restore, tmp_path):
+    dump = tmp_path / 'backup.sql'
+    dump.write_text(
+        "-- MySQL dump\n"
+        "CREATE TABLE `change_journal` (\n  `id` bigint NOT NULL AUTO_INCREMENT,\n  PRIMARY KEY (`id`)\n);\n"
+        "INSERT INTO `change_journal` VALUES (1),(2);\n"
+        "CREATE TABLE `facility` (\n  `id` int NOT NULL,\n  PRIMARY KEY (`id`)\n);\n"
+        "INSERT INTO `facility` VALUES (1);\n")
+    tables, manifest = restore.split(str(dump))
+
+    assert [table.name for table in tables] == ['facility']
+    assert ChangeJournal.TABLE in manifest.tables
+    assert len(tables[0].inserts) == 1
+
+
+def test_decompress(tmp_path):
+    plain = str(tmp_path / 'backup.sql')
+    with gzip.open(plain + '.gz', 'wb') as f:
+        f.write(b"INSERT INTO `facility` VALUES (1);\n")
+
+    assert decompress(plain + '.gz') == plain
+    with open(plain, 'rb') as f:
+        assert f.read() == b"INSERT INTO `facility` VALUES (1);\n"
+    # a plain dump is read where it is
+    assert decompress(plain) == plain